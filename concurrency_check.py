@@ -0,0 +1,95 @@
+import argparse
+import concurrent.futures
+import random
+import sys
+import numpy as np
+import llm_benchmark
+
+## Concurrency check for the wrappers: requests with different prompts and run configurations sent from many threads
+## at once must get exactly the responses and captured scores they get when sent one by one.
+
+
+def make_cases(rng:random.Random, n:int)->list[tuple]:
+    """
+    Build requests as (prompt, process_logits, run_config), each with its own prompt and settings (output length, stop
+    sequence, logits capture). Every fifth request is a left padded batch of prompts of different lengths, as sent by
+    /batch and the scheduler. Scores are returned inline (logits_format="json") so they can be compared.
+    """
+    cases = []
+    for i in range(n):
+        run_config = {"max_new_tokens": rng.randint(2, 12), "logits_format": "json"}
+        if i % 3 == 1:
+            run_config["stop"] = rng.choice(llm_benchmark.WORDS)
+        if i % 4 == 3:
+            run_config["logits_capture"] = {"top_k": 5}
+        if i % 5 == 2:
+            prompt = [llm_benchmark.make_prompt(rng, rng.randint(3, 20)) for _ in range(4)]
+        else:
+            prompt = llm_benchmark.make_prompt(rng, rng.randint(3, 20))
+        cases.append((prompt, i % 2 == 0 or "logits_capture" in run_config, run_config))
+    return cases
+
+
+def run(wrapper, case)->dict:
+    prompt, process_logits, run_config = case
+    if isinstance(prompt, list):
+        return {"texts": [(res["response"], res["usage"], res["finish_reason"]) for res in wrapper.generate_texts(prompt, wrapper.generation_kwargs(run_config))]}
+    res = wrapper.request(prompt, process_logits, run_config)
+    ## Scores are copied right away, so a processor shared by mistake cannot change them afterwards.
+    return {"texts": (res["response"], res["usage"], res["finish_reason"]), "scores": np.array(res["scores"], dtype=np.float32), "score_ids": res.get("score_ids", None)}
+
+
+def compare(expected:dict, actual:dict, tolerance:float)->str:
+    """
+    Returns:
+        str: What differs from the sequential result, or None if they match (scores within the tolerance).
+    """
+    if expected["texts"] != actual["texts"]:
+        return f"response {actual['texts']!r}, expected {expected['texts']!r}"
+    if expected.get("score_ids", None) != actual.get("score_ids", None):
+        return "score ids differ"
+    if "scores" in expected:
+        a, b = expected["scores"], actual["scores"]
+        if a.shape != b.shape:
+            return f"scores of shape {b.shape}, expected {a.shape}"
+        if not np.allclose(a, b, atol=tolerance, rtol=0, equal_nan=True):
+            return f"scores differ by up to {np.nanmax(np.abs(a - b)):.3g}"
+    return None
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check that concurrent requests on the wrappers do not mix up their outputs or captured scores.")
+    parser.add_argument("--wrappers", nargs="+", default=list(llm_benchmark.WRAPPERS), choices=list(llm_benchmark.WRAPPERS))
+    parser.add_argument("--requests", type=int, default=24)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=2)
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="Largest difference allowed between concurrent and sequential scores")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    tokenizer = llm_benchmark.tiny_tokenizer()
+    model = llm_benchmark.tiny_model(tokenizer, seed=args.seed)
+
+    mismatches = 0
+    total = 0
+    for kind in args.wrappers:
+        wrapper = llm_benchmark.WRAPPERS[kind](kind, tokenizer, model, {"max_new_tokens": 8})
+        rng = random.Random(args.seed)
+        cases = make_cases(rng, args.requests)
+        reference = [run(wrapper, case) for case in cases]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
+            for round in range(args.rounds):
+                order = list(range(len(cases)))
+                rng.shuffle(order)
+                results = dict(zip(order, executor.map(lambda i: run(wrapper, cases[i]), order)))
+                for i, expected in enumerate(reference):
+                    total += 1
+                    difference = compare(expected, results[i], args.tolerance)
+                    if difference is not None:
+                        mismatches += 1
+                        print(f"--- {kind}, round {round}, request {i}: {cases[i][0]!r} {cases[i][2]}\n{difference}")
+
+    print(f"{total} concurrent requests on {args.threads} threads ({', '.join(args.wrappers)}): {total - mismatches} matched the sequential responses and scores, {mismatches} mismatched")
+    sys.exit(0 if mismatches == 0 else 1)
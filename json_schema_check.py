@@ -0,0 +1,104 @@
+import argparse
+import json
+import sys
+import llm_json_schema
+
+## Grammar cases as (name, schema, accepted documents, rejected documents[, max_whitespace]).
+CASES = [
+    ("string", {"type": "object", "properties": {"content": {"type": "string"}}, "required": ["content"]},
+     ['{"content": "a   b"}', '{"content":"tab\\t \\u00e9 \\"quoted\\""}', '{ "content" : "" }'],
+     ['{"content": "a\nb"}', '{"content": 1}', '{"content":' + " " * 17 + '"a"}', '{"other": "a"}', '{"content": "a"']),
+    ("maxLength", {"type": "string", "maxLength": 3},
+     ['"abc"', '"a\\n"', '"\\u00e9bc"'],
+     ['"abcd"', '"ab\\nc"']),
+    ("number", {"type": "number"},
+     ["0", "-1.5e+3", "12", "0.25", "1E9"],
+     ["01", "1.", "-", "1e", ".5", "+1"]),
+    ("integer", {"type": "integer"},
+     ["-42", "0"],
+     ["4.2", "1e3"]),
+    ("anyOf", {"anyOf": [{"type": "integer"}, {"type": "string"}, {"type": "null"}]},
+     ["7", '"x"', "null"],
+     ["true", "[1]", "nul"]),
+    ("array", {"type": "array", "items": {"type": "integer"}, "minItems": 1, "maxItems": 3},
+     ["[1]", "[1, 2,3]", "[ 1 ]"],
+     ["[]", "[1,2,3,4]", "[1,]", '["a"]']),
+    ("prefixItems", {"type": "array", "prefixItems": [{"type": "string"}, {"type": "boolean"}], "items": False},
+     ['["a", true]', '["a"]'],
+     ['["a", true, 1]', '[true]']),
+    ("pretty", {"type": "object", "properties": {"rows": {"type": "array", "items": {"type": "object", "properties": {"id": {"type": "integer"}}}}}},
+     [json.dumps({"rows": [{"id": 1}, {"id": 2}]}, indent=2), json.dumps({"rows": [{"id": 1}]}, indent=4)],
+     ['{"rows":' + " " * 17 + '[]}']),
+    ("compact", {"type": "array", "items": {"type": "integer"}},
+     ["[1,2]", "[]"],
+     ["[1, 2]", "[ ]", "[1,\n2]"], 0),
+]
+
+
+def check_grammar(name:str, schema:dict, accepted:list[str], rejected:list[str], max_whitespace:int=llm_json_schema.MAX_WHITESPACE)->list[str]:
+    """
+    Check that a schema accepts and rejects the given documents; every prefix of an accepted document must keep a live state.
+    Returns:
+        list[str]: The failures.
+    """
+    grammar = llm_json_schema.JsonSchemaGrammar(schema, max_whitespace)
+    failures = []
+    for doc in accepted:
+        state = grammar.initial
+        for i, ch in enumerate(doc):
+            state = grammar.step(state, ch)
+            if not state:
+                failures.append(f"{name}: {doc!r} rejected at {i}")
+                break
+        if state and not grammar.can_end(state):
+            failures.append(f"{name}: {doc!r} not complete")
+    for doc in rejected:
+        if grammar.can_end(grammar.feed(grammar.initial, doc)):
+            failures.append(f"{name}: {doc!r} accepted")
+    return failures
+
+
+def check_cutoff(wrapper, schema:dict)->list[str]:
+    """
+    Check that the parsed value is returned when generation stops at max_new_tokens right on the last token of the document.
+    Returns:
+        list[str]: The failures.
+    """
+    full = wrapper.request("select name from products", False, {"json_schema": schema, "max_new_tokens": 64})
+    if full["json"] is None:
+        return [f"{wrapper.name}: no value without a cutoff ({full['response']!r})"]
+    ## The last token generated before the end of sequence token completes the document.
+    n = full["usage"]["completion_tokens"] - (1 if full["finish_reason"] == "stop" else 0)
+    cut = wrapper.request("select name from products", False, {"json_schema": schema, "max_new_tokens": n})
+    if cut["json"] != full["json"]:
+        return [f"{wrapper.name}: cut at {n} tokens got {cut['json']!r} from {cut['response']!r}, expected {full['json']!r}"]
+    return []
+
+
+## Correctness check for constrained decoding: the grammar cases, and the cutoff at max_new_tokens on the tiny benchmark model.
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check the JSON schema grammar and constrained generation.")
+    parser.add_argument("--grammar-only", action="store_true", help="Skip the generation checks on the tiny model")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    failures = []
+    for case in CASES:
+        failures += check_grammar(*case)
+    print(f"Grammar: {len(CASES)} schemas, {sum(len(case[2]) + len(case[3]) for case in CASES)} documents")
+
+    if not args.grammar_only:
+        import llm_benchmark
+
+        tokenizer = llm_benchmark.tiny_tokenizer()
+        model = llm_benchmark.tiny_model(tokenizer, seed=args.seed)
+        schema = {"const": {"name": "select", "total": [1, 2]}}
+        for kind, cls in llm_benchmark.WRAPPERS.items():
+            failures += check_cutoff(cls(kind, tokenizer, model, {}), schema)
+        print(f"Cutoff: {len(llm_benchmark.WRAPPERS)} wrappers")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    print("OK" if not failures else f"{len(failures)} failures")
+    sys.exit(0 if not failures else 1)
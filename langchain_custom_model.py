@@ -1,25 +1,108 @@
 from pydantic import  Field
-from typing import Optional, List, Any, Dict, Sequence, Union, Callable, Literal
-from langchain_core.callbacks import CallbackManagerForLLMRun
+from typing import Optional, List, Any, Dict, Sequence, Union, Callable, Literal, Iterator, AsyncIterator
+from langchain_core.callbacks import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
 from langchain_core.language_models import BaseChatModel
-from langchain_core.messages import (AIMessage, BaseMessage)
-from langchain_core.outputs import ChatResult, ChatGeneration
+from langchain_core.messages import (AIMessage, AIMessageChunk, BaseMessage)
+from langchain_core.outputs import ChatResult, ChatGeneration, ChatGenerationChunk
 from langchain_core.runnables import Runnable
 from langchain_core.tools import BaseTool, StructuredTool
 from langchain_core.language_models import LanguageModelInput
+import asyncio
+import concurrent.futures
 import json 
 import logging
+import re
+import uuid
 
 
 logging.basicConfig(filemode="w", filename=f"log.txt", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+## Name of the pseudo tool the model uses to respond directly when tool calls are constrained to a schema.
+RESPOND_TOOL = "respond"
+
+class _AnswerStream(object):
+    """
+    Splits a streamed step response into answer text that can be surfaced right away and tool calls, which are held back.
+    Plain text is passed on as it arrives; a JSON response is held back unless it is a direct response call, whose content
+    is decoded as it arrives.
+    """
+    RESPOND_PREFIX = re.compile(r'^\s*\{\s*"name"\s*:\s*"' + RESPOND_TOOL + r'"\s*,\s*"parameters"\s*:\s*\{\s*"content"\s*:\s*"')
+    CALL_NAME = re.compile(r'^\s*\{\s*"name"\s*:\s*"([^"\\]*)"')
+
+    def __init__(self, tools: bool):
+        """
+        Parameters:
+            tools (bool): Whether the response can contain tool calls (otherwise it is all answer text).
+        """
+        self.text = ""
+        self.sent = ""
+        self.mode = None if tools else "text"
+        self.content = 0
+
+    def feed(self, token: str) -> str:
+        """
+        Add streamed text. Returns the answer text that can be surfaced now.
+        """
+        self.text += token
+        if self.mode is None:
+            stripped = self.text.lstrip()
+            if not stripped:
+                return ""
+            if stripped[0] not in "{[`":
+                self.mode = "text"
+            elif self.RESPOND_PREFIX.match(self.text):
+                self.mode = "respond"
+                self.content = self.RESPOND_PREFIX.match(self.text).end()
+            else:
+                name = self.CALL_NAME.match(self.text)
+                if stripped[0] != "{" or (name and name.group(1) != RESPOND_TOOL):
+                    self.mode = "held"
+
+        if self.mode == "text":
+            text, self.sent = self.text[len(self.sent):], self.text
+            return text
+        if self.mode == "respond":
+            content = json.loads('"' + _string_prefix(self.text[self.content:]) + '"', strict=False)
+            text, self.sent = content[len(self.sent):], content
+            return text
+        return ""
+
+    def remaining(self, answer: str) -> str:
+        """
+        Get the part of the final answer that was not surfaced while streaming.
+        """
+        return answer[len(self.sent):] if answer.startswith(self.sent) else ""
+
+
+def _string_prefix(raw: str) -> str:
+    """
+    Get the longest complete part of a streamed JSON string body (up to the closing quote, without a partial escape).
+    """
+    i = 0
+    while i < len(raw):
+        if raw[i] == '"':
+            break
+        if raw[i] != "\\":
+            i += 1
+            continue
+        n = 6 if raw[i+1:i+2] == "u" else 2
+        ## The high half of a surrogate pair is only decoded together with the low half.
+        if n == 6 and re.match(r"[dD][89abAB]", raw[i+2:i+4]):
+            n = 12
+        if i + n > len(raw):
+            break
+        i += n
+    return raw[:i]
+
+
 class LangChainCustomModel(BaseChatModel):
     
     """Custom Model wrapped by Gen AI Web Server"""
 
     model_name: str = Field(default="custom", alias="model", description="Name of the custom model")
     client: Any = Field(default=None, description="Client to send requests to the custom model")
+    async_client: Any = Field(default=None, description="Async client (llm_client.AsyncClient) used by ainvoke, abatch and astream")
     tools: Optional[Sequence[Dict[str, Any]]] = Field(
         default=[], 
         description="Tools to be used by the custom model"
@@ -28,71 +111,296 @@ class LangChainCustomModel(BaseChatModel):
         default="",
         description="Prompt to be used for the tools"
     )
+    constrained_decoding: bool = Field(
+        default=True,
+        description="Constrain tool call generation on the server to the JSON schema of the bound tools"
+    )
+    tool_registry: Dict[str, Any] = Field(
+        default={},
+        description="Bound tools by name, ready to invoke"
+    )
+    tool_schema: Optional[Dict[str, Any]] = Field(
+        default=None,
+        description="JSON schema of the tool calls for the bound tools"
+    )
+    max_tool_steps: int = Field(
+        default=8,
+        description="Maximum number of tool calling steps (LLM round trips after the first) per generation"
+    )
+    use_sessions: bool = Field(
+        default=True,
+        description="Keep the conversation of the tool loop cached on the server between steps"
+    )
+    max_tool_workers: int = Field(
+        default=4,
+        description="Maximum number of tool calls of one step run concurrently"
+    )
     
 
-    def __init__(self, _client):
+    def __init__(self, _client, _async_client=None):
         super().__init__()
         self.client = _client
+        self.async_client = _async_client
         self.tools = None
         self.tool_prompt = ""
+        self.tool_registry = {}
+        self.tool_schema = None
 
     def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
         """
-        Generate a response from the custom model.
+        Generate a response from the custom model. Each step of the tool loop is one request to the LLM: all tool calls
+        in a response are run (concurrently when there are several) and their results are sent back in a single follow-up request.
         """
-        # Build the static tool description part of the prompt.
-        if self.tools and self.tool_prompt == "":
-            tool_prompt = """
-            \nRespond to the user directly or use tools where appropriate. To use tool, return JSON with key name: name of the tool, key parameter: parameters mapped to variables and nothing else. 
-            Available tools: """
-            for tool in self.tools:
-                tool_prompt += f"Name:{tool.name} \n Description:{tool.description} \nSchema:{tool.input_schema.model_json_schema()} "
+        #Opening request to the LLM (user -> LLM), constrained to valid tool calls when the server supports it
+        prompt, run_config = self.opening_request(messages, stop)
+        session_id = self.new_session_id()
+        try:
+            for step in range(self.max_tool_steps + 1):
+                response = self.client.send_request(prompt, run_config=run_config, session_id=session_id)
+                tool_calls, text = self.read_step(self.client.extract_response(response), response.get("json", None) if run_config.get("json_schema") else None)
+                if not tool_calls or step == self.max_tool_steps:
+                    break
 
-        
-        #Assemble the prompt for the LLM
-        prompt = [{"role": "user", "content": messages[0].content + tool_prompt}]  
+                #Invoke the tools, the calls of one response do not depend on each other.
+                prompt = self.follow_up_request(prompt, text, tool_calls, self.invoke_tools(tool_calls))
+        finally:
+            self.end_session(session_id)
+
+        message = AIMessage(content=text)
+        return ChatResult(generations=[ChatGeneration(message=message)])
 
-        #Opening request to the LLM (user -> LLM)
-        response = self.client.send_request(prompt)
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        """
+        Generate a response from the custom model with the async client, so many conversations can run from one event loop.
+        Without an async client the synchronous path runs in a thread.
+        """
+        if self.async_client is None:
+            return await super()._agenerate(messages, stop, run_manager, **kwargs)
 
-        # Extracting the text
-        text = self.client.extract_response(response)
-        while self.tools:
-            try:
-                text = text.replace("```json", "")
-                text = text.replace("```", "")
-                # Parsing the JSON response - otherwise it is not a tool call
-                tool_data = json.loads(text)
-                tool_name = tool_data.get("name")
-                args = tool_data.get("parameters", {})
-                logger.info(f"Tool Name: {tool_name}, Args: {args}")
-
-                # Find the correct tool match 
-                _tool = None
-                for tool in self.tools:
-                    if tool.name == tool_name:
-                        _tool = tool
-                        break
-
-                #Invoke the matched tool.
-                tool_response = StructuredTool.from_function(_tool.func).invoke(args)
-                logger.info(f"Tool Response: {tool_response}")
-
-                # Result from the tool is put in a prompt
-                tool_res = f"\nOriginal Message:\n {messages[0].content}\nTool Response: {tool_response}"# or do I use further tools?\n{tool_prompt} "
-                logger.info(f"Tool Response: {tool_name} -- {tool_res}")
-
-                # Send the tool result prompt back to the LLM
-                response = self.client.send_request([{"role": "user", "content": tool_res}])
-                text = self.client.extract_response(response)
-                logger.info(f"Tool Response: {text}")
-            except json.JSONDecodeError:
-                break
-            
+        prompt, run_config = self.opening_request(messages, stop)
+        session_id = self.new_session_id()
+        try:
+            for step in range(self.max_tool_steps + 1):
+                response = await self.async_client.send_request(prompt, run_config=run_config, session_id=session_id)
+                tool_calls, text = self.read_step(self.async_client.extract_response(response), response.get("json", None) if run_config.get("json_schema") else None)
+                if not tool_calls or step == self.max_tool_steps:
+                    break
+                prompt = self.follow_up_request(prompt, text, tool_calls, await self.ainvoke_tools(tool_calls))
+        finally:
+            await self.aend_session(session_id)
 
         message = AIMessage(content=text)
         return ChatResult(generations=[ChatGeneration(message=message)])
-    
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        """
+        Stream the response of the custom model. Tool calls are held back and run between steps; the text of the final
+        answer (including the content of a direct response call) is surfaced as the tokens arrive.
+        """
+        prompt, run_config = self.opening_request(messages, stop)
+        for step in range(self.max_tool_steps + 1):
+            answer = _AnswerStream(bool(self.tools))
+            for token in self.client.stream_request(prompt, run_config):
+                text = answer.feed(token)
+                if text:
+                    chunk = ChatGenerationChunk(message=AIMessageChunk(content=text))
+                    if run_manager:
+                        run_manager.on_llm_new_token(text, chunk=chunk)
+                    yield chunk
+
+            tool_calls, text = self.read_step(answer.text, None)
+            if not tool_calls or step == self.max_tool_steps:
+                text = answer.remaining(text)
+                if text:
+                    chunk = ChatGenerationChunk(message=AIMessageChunk(content=text))
+                    if run_manager:
+                        run_manager.on_llm_new_token(text, chunk=chunk)
+                    yield chunk
+                return
+            prompt = self.follow_up_request(prompt, answer.text, tool_calls, self.invoke_tools(tool_calls))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        """
+        Stream the response of the custom model with the async client. Without an async client the synchronous stream runs in a thread.
+        """
+        if self.async_client is None:
+            async for chunk in super()._astream(messages, stop, run_manager, **kwargs):
+                yield chunk
+            return
+
+        prompt, run_config = self.opening_request(messages, stop)
+        for step in range(self.max_tool_steps + 1):
+            answer = _AnswerStream(bool(self.tools))
+            async for token in self.async_client.stream_request(prompt, run_config):
+                text = answer.feed(token)
+                if text:
+                    chunk = ChatGenerationChunk(message=AIMessageChunk(content=text))
+                    if run_manager:
+                        await run_manager.on_llm_new_token(text, chunk=chunk)
+                    yield chunk
+
+            tool_calls, text = self.read_step(answer.text, None)
+            if not tool_calls or step == self.max_tool_steps:
+                text = answer.remaining(text)
+                if text:
+                    chunk = ChatGenerationChunk(message=AIMessageChunk(content=text))
+                    if run_manager:
+                        await run_manager.on_llm_new_token(text, chunk=chunk)
+                    yield chunk
+                return
+            prompt = self.follow_up_request(prompt, answer.text, tool_calls, await self.ainvoke_tools(tool_calls))
+
+    def opening_request(self, messages: List[BaseMessage], stop: Optional[List[str]] = None) -> tuple:
+        """
+        Assemble the opening prompt (user -> LLM) and its run configuration: constrained to valid tool calls when tools are
+        bound and constrained decoding is on, otherwise cut at the stop sequences.
+        Returns:
+            tuple: The prompt and the run configuration, which the follow-up requests reuse.
+        """
+        prompt = [{"role": "user", "content": messages[0].content + self.tool_prompt}]
+        if self.tools and self.constrained_decoding:
+            return prompt, {"json_schema": self.tool_schema}
+        return prompt, ({"stop": stop} if stop else {})
+
+    def read_step(self, text: str, tool_data: Any = None) -> tuple:
+        """
+        Read the response of one step: either tool calls to run or the answer.
+        Parameters:
+            text (str): The response text.
+            tool_data (Any): The response parsed by constrained decoding, if any.
+        Returns:
+            tuple: The tool calls (empty for an answer) and the answer text (the response text if it has tool calls).
+        """
+        if not self.tools:
+            return [], text
+        try:
+            calls = self.parse_tool_calls(text if tool_data is None else tool_data)
+        except (json.JSONDecodeError, AttributeError, KeyError, TypeError):
+            # Not a tool call - the text is the response
+            return [], text
+        logger.info(f"Tool Calls: {calls}")
+
+        # The model chose to respond directly
+        tool_calls = [(name, args) for name, args in calls if name != RESPOND_TOOL]
+        if not tool_calls:
+            return [], "\n".join(str(args.get("content", "")) for _, args in calls)
+        return tool_calls, text
+
+    def follow_up_request(self, prompt: List[dict], text: str, tool_calls: List[tuple], tool_responses: List[Any]) -> List[dict]:
+        """
+        Continue the conversation with the tool calls of the model and the results from the tools in one message, which can
+        call further tools. The conversation only grows at the end, so a server session reuses the cache of the earlier turns.
+        """
+        logger.info(f"Tool Responses: {tool_responses}")
+        tool_res = "Tool Responses:\n" + "\n".join(
+            f"{name} {json.dumps(args)}: {tool_response}" for (name, args), tool_response in zip(tool_calls, tool_responses)
+        )
+        return prompt + [{"role": "assistant", "content": text}, {"role": "user", "content": tool_res}]
+
+    def new_session_id(self) -> Optional[str]:
+        """
+        Get a session id for one tool loop, so the server keeps the conversation cached between steps (servers without sessions ignore it).
+        """
+        return uuid.uuid4().hex if self.tools and self.use_sessions else None
+
+    def end_session(self, session_id: Optional[str]) -> None:
+        """
+        End the session of a tool loop, so the server frees the cached conversation right away instead of at its idle timeout.
+        Called once the loop is done or has failed; a failure to close is logged rather than raised.
+        """
+        if session_id is None:
+            return
+        try:
+            self.client.close_session(session_id)
+        except Exception as e:
+            logger.warning(f"Could not close session {session_id}: {e}")
+
+    async def aend_session(self, session_id: Optional[str]) -> None:
+        """
+        End the session of a tool loop with the async client (see end_session).
+        """
+        if session_id is None:
+            return
+        try:
+            await self.async_client.close_session(session_id)
+        except Exception as e:
+            logger.warning(f"Could not close session {session_id}: {e}")
+
+    def parse_tool_calls(self, data: Any) -> List[tuple]:
+        """
+        Get the tool calls from a model response: one call ({"name": ..., "parameters": ...}) or a list of calls,
+        either parsed already (constrained decoding) or as JSON text.
+        Returns:
+            List[tuple]: (name, parameters) of each call.
+        """
+        if isinstance(data, str):
+            data = json.loads(data.replace("```json", "").replace("```", ""))
+        calls = data if isinstance(data, list) else [data]
+        if not calls:
+            raise TypeError("No tool calls")
+        return [(call["name"], call.get("parameters", {})) for call in calls]
+
+    def invoke_tools(self, calls: List[tuple]) -> List[Any]:
+        """
+        Invoke tool calls from the registry, on a thread pool when there are several. Unknown tools and tool errors are
+        returned as the tool response so the model can react to them.
+        Returns:
+            List[Any]: The response of each call, in order.
+        """
+        def invoke(call):
+            name, args = call
+            tool = self.tool_registry.get(name, None)
+            if tool is None:
+                return f"Error: unknown tool {name}"
+            try:
+                return tool.invoke(args)
+            except Exception as e:
+                return f"Error: {e}"
+
+        if len(calls) == 1:
+            return [invoke(calls[0])]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(calls), self.max_tool_workers)) as executor:
+            return list(executor.map(invoke, calls))
+
+    async def ainvoke_tools(self, calls: List[tuple]) -> List[Any]:
+        """
+        Invoke tool calls from the registry concurrently on the event loop (at most max_tool_workers at once).
+        Returns:
+            List[Any]: The response of each call, in order.
+        """
+        semaphore = asyncio.Semaphore(self.max_tool_workers)
+
+        async def invoke(call):
+            name, args = call
+            tool = self.tool_registry.get(name, None)
+            if tool is None:
+                return f"Error: unknown tool {name}"
+            try:
+                async with semaphore:
+                    return await tool.ainvoke(args)
+            except Exception as e:
+                return f"Error: {e}"
+
+        return list(await asyncio.gather(*[invoke(call) for call in calls]))
+
+    def tool_call_schema(self) -> Dict[str, Any]:
+        """
+        JSON schema of a tool call to one of the bound tools ({"name": ..., "parameters": ...}), a list of such calls or a direct response.
+        """
+        calls = [
+            {
+                "type": "object",
+                "properties": {"name": {"const": name}, "parameters": tool.input_schema.model_json_schema()},
+                "required": ["name", "parameters"],
+            }
+            for name, tool in self.tool_registry.items()
+        ]
+        respond = {
+            "type": "object",
+            "properties": {"name": {"const": RESPOND_TOOL}, "parameters": {"type": "object", "properties": {"content": {"type": "string"}}, "required": ["content"]}},
+            "required": ["name", "parameters"],
+        }
+        return {"anyOf": calls + [respond, {"type": "array", "items": {"anyOf": calls}, "minItems": 1}]}
 
     def bind_tools(
         self,
@@ -105,16 +413,31 @@ class LangChainCustomModel(BaseChatModel):
     ) -> Runnable[LanguageModelInput, BaseMessage]:
         
         """
-        Bind tools to the model.
+        Bind tools to the model. The tool prompt, the tool call schema and a registry of the tools by name are built
+        once here rather than on every call.
         """
+        registry = {}
+        for tool in tools:
+            if not isinstance(tool, BaseTool):
+                if not callable(tool) or isinstance(tool, type):
+                    raise ValueError(f"Tool {tool!r} cannot be invoked, bind a tool or a function")
+                tool = StructuredTool.from_function(tool)
+            registry[tool.name] = tool
 
-        self.tools = tools
-        
-        # for tool in tools:
-        #     print(tool.)
-        #     print(tool.name)
-        #     print(tool.description)
-        #     print(tool.input_schema.model_json_schema())
+        self.tools = list(registry.values())
+        self.tool_registry = registry
+
+        # Build the static tool description part of the prompt.
+        tool_prompt = """
+            \nRespond to the user directly or use tools where appropriate. To use tool, return JSON with key name: name of the tool, key parameter: parameters mapped to variables and nothing else. 
+            To use several tools at once, return a JSON list of such objects. 
+            Available tools: """
+        for tool in self.tools:
+            tool_prompt += f"Name:{tool.name} \n Description:{tool.description} \nSchema:{tool.input_schema.model_json_schema()} "
+        if self.constrained_decoding:
+            tool_prompt += f"\nTo respond to the user directly, use name: {RESPOND_TOOL} with parameter content: your response. "
+        self.tool_prompt = tool_prompt
+        self.tool_schema = self.tool_call_schema()
         return self
     
     @property
@@ -0,0 +1,436 @@
+import asyncio
+import concurrent.futures
+import hmac
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+import llm_metrics
+import llm_registry
+
+
+## Bytes read from a file per response body message.
+CHUNK_BYTES = 1 << 20
+
+
+def byte_range(header:str, size:int):
+    """
+    Parse an HTTP Range header with a single byte range ("bytes=start-end", "bytes=start-" or "bytes=-suffix").
+    Returns:
+        tuple: (start, stop) of the bytes to send, None to send the whole file (no or unsupported header), or () if the range cannot be satisfied.
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", (header or "").strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        start, stop = max(size - int(last), 0), size
+    else:
+        start, stop = int(first), min(int(last) + 1, size) if last else size
+    if start >= size or start >= stop:
+        return ()
+    return start, stop
+
+
+class AsyncLLM_Server(object):
+    """
+    ASGI server for a wrapped language model with admission control.
+
+    Serves /request, /stream, /logits/<id>, /sessions/<id>, /info, /vocab, /metrics and / as LLM_Server does, including
+    model selection by name. The other LLM_Server routes (/batch, /tokenize, /detokenize, /prefix, /profiles) are only
+    served by LLM_Server. Model work runs in a dedicated thread pool;
+    requests beyond the queue bound are rejected with 429, requests are rejected with 503 while the model is warming
+    up or the server is shutting down, and requests that exceed the timeout get 504. On shutdown the server stops
+    admitting new requests and drains the in-flight generations before exiting.
+    """
+    def __init__(self, models, port:int=5000, max_workers:int=1, max_queue:int=32, timeout:float=300.0, drain_timeout:float=None):
+        """
+        Parameters:
+            models (llm_registry.ModelRegistry): The models to serve (a single Wrapper is also accepted).
+            port (int): The port to serve the language model on. Default=5000
+            max_workers (int): Number of threads running model work. Default=1
+            max_queue (int): Maximum number of admitted requests (running and waiting) before returning 429. Default=32
+            timeout (float): Seconds a request may take (including queueing) before returning 504. Default=300
+            drain_timeout (float): Seconds to wait for in-flight requests on shutdown. Default=None (wait for all)
+        """
+        if not isinstance(models, llm_registry.ModelRegistry):
+            registry = llm_registry.ModelRegistry()
+            if models is not None:
+                registry.add(models)
+            models = registry
+        self.registry = models
+        self.port = port
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.drain_timeout = drain_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-worker")
+        self.pending = 0
+        self.accepting = True
+        self.idle = None
+        self.loop = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.handle(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """
+        Handle the ASGI lifespan protocol: start up the admission state and drain in-flight requests on shutdown.
+        """
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def startup(self):
+        """
+        Set up the admission state on the running event loop. Called on lifespan startup, or on the first model call
+        when the server runs without the lifespan protocol (e.g. lifespan="off" or a test harness).
+        """
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            self.idle = asyncio.Event()
+            self.idle.set()
+
+    async def shutdown(self):
+        """
+        Stop admitting requests, wait for in-flight generations and stop the worker threads.
+        """
+        self.accepting = False
+        if self.idle is not None:
+            try:
+                await asyncio.wait_for(self.idle.wait(), self.drain_timeout)
+            except asyncio.TimeoutError:
+                print(f"Shutting down with {self.pending} requests still in flight")
+        self.executor.shutdown(wait=self.pending == 0, cancel_futures=True)
+
+    async def handle(self, scope, receive, send):
+        path = scope["path"]
+        method = scope["method"]
+        query = urllib.parse.parse_qs(scope.get("query_string", b"").decode("utf-8"))
+        name = query.get("model", [None])[0]
+
+        headers = dict(scope.get("headers", []))
+        try:
+            if path == "/request" and method == "POST":
+                body = await self.read_body(receive)
+                status, res = await self.request(body, headers.get(b"x-admin-token", b"").decode("utf-8"))
+            elif path == "/stream" and method == "POST":
+                body = await self.read_body(receive)
+                ## The events are sent from stream itself.
+                return await self.stream(send, receive, body)
+            elif path.startswith("/logits/") and method in ("GET", "DELETE"):
+                error = self.check_model(name)
+                if error is None:
+                    ## The file is sent from logits itself.
+                    return await self.logits(send, name, path[len("/logits/"):], method, headers.get(b"range", b"").decode("latin-1"))
+                status, res = error
+            elif path == "/info" and method == "GET":
+                status, res = self.check_model(name) or (200, await self.run(lambda: self.info(name)))
+            elif path == "/vocab" and method == "GET":
+                status, res = self.check_model(name) or (200, await self.run(lambda: self.registry.get(name).get_vocab()))
+            elif path.startswith("/sessions/") and method == "DELETE":
+                status, res = self.check_model(name) or self.close_session(name, path[len("/sessions/"):])
+            elif path == "/metrics" and method == "GET":
+                status, res = 200, llm_metrics.metrics.snapshot() if query.get("format", [None])[0] == "json" else llm_metrics.metrics.render()
+            elif path == "/" and method == "GET":
+                status, res = self.check_model(name) or self.ping(name)
+            else:
+                status, res = 404, "Not found"
+        except Exception as e:
+            status, res = 500, str(e)
+
+        await self.respond(send, status, res)
+
+    def check_model(self, name:str=None):
+        """
+        Returns:
+            tuple: An error (status, message) if the model is unknown or there is no model, otherwise None.
+        """
+        if name is not None and name not in self.registry:
+            return 404, f"Unknown model: {name}"
+        if name is None and self.registry.default is None:
+            return 500, "Model is not loaded"
+        return None
+
+    def close_session(self, name:str, session_id:str):
+        """
+        End a conversation session and free its key/value cache. Models that are not loaded have no sessions.
+        """
+        model = self.registry.peek(name or self.registry.default)
+        if model is None or not model.close_session(session_id):
+            return 404, "Session not found"
+        return 200, f"Session closed: {session_id}"
+
+    def info(self, name:str=None)->dict:
+        ## Like ping, info reports a model that is not loaded instead of loading it.
+        name = name or self.registry.default
+        model = self.registry.peek(name)
+        if model is None:
+            return {"name": name, "loaded": False, "models": self.registry.info()}
+        return {**model.info(), "loaded": True, "models": self.registry.info()}
+
+    def ping(self, name:str=None):
+        name = name or self.registry.default
+        if not self.accepting:
+            return 503, f"Server is shutting down: {name}"
+        ## Only report readiness for models that are loaded, pinging must not trigger a load.
+        model = self.registry.peek(name)
+        if model is None:
+            return 200, f"ping: {name} (not loaded)"
+        if not getattr(model, "ready", True):
+            return 503, f"Model is warming up: {name}"
+        return 200, f"ping: {name}"
+
+    async def request(self, body:bytes, admin_token:str=""):
+        """
+        Admit a generation request and run it on the worker threads.
+        Parameters:
+            body (bytes): The JSON request body.
+            admin_token (str): The X-Admin-Token header, required for profiled requests.
+        Returns:
+            tuple: The response (status, body).
+        """
+        if not self.accepting:
+            return 503, "Server is shutting down"
+        if self.pending >= self.max_queue:
+            return 429, "Server is busy, retry later"
+
+        try:
+            data = json.loads(body)
+        except json.JSONDecodeError:
+            return 400, "Invalid JSON"
+        prompt = data.get("prompt", None)
+        process_logits = data.get("process_logits", False) ## Optional parameter to process logits and scores from the language model.
+        run_config = data.get("run_config", {})
+        name = data.get("model", None)
+        if prompt is None:
+            return 400, "Prompt is required"
+        error = self.check_model(name)
+        if error:
+            return error
+
+        model = self.registry.peek(name)
+        if model is not None and not getattr(model, "ready", True):
+            return 503, "Model is warming up"
+        if run_config.get("profile", False):
+            token = model.profiler.admin_token if model is not None else None
+            if token is None or not hmac.compare_digest(admin_token, token):
+                return 403, "Admin token required"
+
+        name = name or self.registry.default
+        submitted = time.perf_counter()
+
+        def run():
+            ## Time spent waiting for a free worker thread.
+            llm_metrics.metrics.observe_stage(name, "queue_wait", time.perf_counter() - submitted)
+            ## The model is resolved on the worker thread as it may have to be loaded first.
+            return self.registry.get(name).request(prompt, process_logits, run_config, data.get("session_id", None))
+
+        try:
+            with llm_metrics.metrics.track(name):
+                res = await self.run(run, timeout=self.timeout)
+            with llm_metrics.metrics.stage(name, "serialize"):
+                return 200, json.dumps(res).encode("utf-8")
+        except asyncio.TimeoutError:
+            return 504, "Request timed out"
+        except ValueError as e:
+            ## Invalid run configuration, e.g. max_new_tokens or stop.
+            return 400, str(e)
+
+    async def stream(self, send, receive, body:bytes):
+        """
+        Stream a response as server-sent events like LLM_Server /stream: a data event per text chunk, then an end (or error) event.
+        The stream is admitted like a request and holds a worker thread while the model generates; the chunks are passed
+        to the event loop as they arrive. Generation stops early if the client disconnects. An invalid run configuration
+        gets a 400 response before the stream starts.
+        """
+        if not self.accepting:
+            return await self.respond(send, 503, "Server is shutting down")
+        if self.pending >= self.max_queue:
+            return await self.respond(send, 429, "Server is busy, retry later")
+        try:
+            data = json.loads(body)
+        except json.JSONDecodeError:
+            return await self.respond(send, 400, "Invalid JSON")
+        prompt = data.get("prompt", None)
+        run_config = data.get("run_config", {})
+        name = data.get("model", None)
+        if prompt is None:
+            return await self.respond(send, 400, "Prompt is required")
+        error = self.check_model(name)
+        if error:
+            return await self.respond(send, *error)
+        model = self.registry.peek(name)
+        if model is not None and not getattr(model, "ready", True):
+            return await self.respond(send, 503, "Model is warming up")
+
+        name = name or self.registry.default
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        stopped = threading.Event()
+
+        def produce():
+            ## Runs on a worker thread, the model is resolved here as it may have to be loaded first.
+            try:
+                with llm_metrics.metrics.track(name):
+                    try:
+                        chunks = self.registry.get(name).stream(prompt, run_config)
+                    except ValueError as e:
+                        ## Invalid run configuration, reported before the stream starts.
+                        loop.call_soon_threadsafe(events.put_nowait, ("invalid", str(e)))
+                        return
+                    for text in chunks:
+                        if stopped.is_set():
+                            return
+                        loop.call_soon_threadsafe(events.put_nowait, ("token", text))
+            except Exception as e:
+                loop.call_soon_threadsafe(events.put_nowait, ("error", str(e)))
+                return
+            loop.call_soon_threadsafe(events.put_nowait, ("end", None))
+
+        async def watch():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            stopped.set()
+            events.put_nowait(("disconnect", None))
+
+        generation = asyncio.ensure_future(self.run(produce))
+        watcher = asyncio.ensure_future(watch())
+        try:
+            started = False
+            while True:
+                event, value = await events.get()
+                if event == "invalid":
+                    return await self.respond(send, 400, value)
+                if event == "disconnect":
+                    return
+                ## The response starts with the first event, once the run configuration has been checked.
+                if not started:
+                    await send({"type": "http.response.start", "status": 200,
+                                "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]})
+                    started = True
+                if event == "token":
+                    await send({"type": "http.response.body", "body": f"data: {json.dumps({'token': value})}\n\n".encode(), "more_body": True})
+                    continue
+                if event == "error":
+                    await send({"type": "http.response.body", "body": f"event: error\ndata: {json.dumps({'error': value})}\n\n".encode()})
+                elif event == "end":
+                    await send({"type": "http.response.body", "body": b"event: end\ndata: {}\n\n"})
+                return
+        finally:
+            stopped.set()
+            watcher.cancel()
+            await generation
+
+    async def logits(self, send, name:str, array_id:str, method:str, range_header:str=""):
+        """
+        Send (GET, with single byte range Range requests) or delete binary scores saved with logits_format="npy".
+        Files are read on the default executor, not on the model worker threads. Models that are not loaded have no scores.
+        """
+        model = self.registry.peek(name or self.registry.default)
+        files = getattr(model, "logits_files", None)
+        if method == "DELETE":
+            if files is None or not files.delete(array_id):
+                return await self.respond(send, 404, "Logits not found")
+            return await self.respond(send, 204, "")
+
+        path = files.path(array_id) if files is not None else None
+        try:
+            f = open(path, "rb") if path is not None else None
+        except FileNotFoundError:
+            f = None
+        if f is None:
+            return await self.respond(send, 404, "Logits not found")
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            span = byte_range(range_header, size)
+            if span == ():
+                return await self.respond(send, 416, "Range not satisfiable", [(b"content-range", f"bytes */{size}".encode())])
+            start, stop = span or (0, size)
+            headers = [(b"content-type", b"application/octet-stream"), (b"content-length", str(stop - start).encode()), (b"accept-ranges", b"bytes")]
+            if span is not None:
+                headers.append((b"content-range", f"bytes {start}-{stop - 1}/{size}".encode()))
+            await send({"type": "http.response.start", "status": 206 if span is not None else 200, "headers": headers})
+
+            loop = asyncio.get_running_loop()
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = await loop.run_in_executor(None, f.read, min(CHUNK_BYTES, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                ## The file was truncated while it was sent, end the response.
+                await send({"type": "http.response.body", "body": b""})
+
+    async def run(self, fn, *args, timeout:float=None):
+        """
+        Run a model call on the worker threads. The call counts against the queue bound until it actually finishes,
+        even if the caller has already timed out.
+        """
+        self.startup()
+        self.pending += 1
+        self.idle.clear()
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self.loop.call_soon_threadsafe(self.release))
+
+        ## Shield so a timeout does not cancel the wrapped future (a call still waiting in the queue is cancelled below).
+        wrapped = asyncio.wrap_future(future)
+        try:
+            return await asyncio.wait_for(asyncio.shield(wrapped), timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise
+
+    def release(self):
+        self.pending -= 1
+        if self.pending == 0:
+            self.idle.set()
+
+    async def read_body(self, receive)->bytes:
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body", False):
+                return body
+
+    async def respond(self, send, status:int, res, headers:list=None):
+        if isinstance(res, (dict, list)):
+            body = json.dumps(res).encode("utf-8")
+            content_type = b"application/json"
+        elif isinstance(res, bytes):
+            ## Responses already serialized to JSON.
+            body = res
+            content_type = b"application/json"
+        else:
+            body = str(res).encode("utf-8")
+            content_type = b"text/plain; charset=utf-8"
+
+        headers = [(b"content-type", content_type), (b"content-length", str(len(body)).encode())] + list(headers or [])
+        if status in (429, 503):
+            headers.append((b"retry-after", b"1"))
+
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    def start(self):
+        """
+        Start the ASGI server on the configured port using uvicorn.
+        """
+        import uvicorn
+
+        uvicorn.run(self, port=self.port, lifespan="on")
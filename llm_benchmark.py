@@ -0,0 +1,216 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import random
+import threading
+import time
+import numpy as np
+import torch
+import transformers
+import werkzeug.serving
+import llm_client
+import llm_registry
+import llm_server
+
+WORDS = "select name price quantity from products customers sales where order by group having join on and or the total of each region date".split()
+
+WRAPPERS = {
+    "model": llm_server.LLM_Server_Wrapper,
+    "pipe": llm_server.LLM_Server_Pipe_Wrapper,
+}
+
+## Scenarios are (wrapper, path): "request" and "logits" use /request with process_logits off/on, "stream" uses /stream (time-to-first-token).
+SCENARIOS = [(wrapper, path) for wrapper in WRAPPERS for path in ("request", "logits", "stream")]
+
+
+def tiny_tokenizer():
+    """
+    Train a small byte-level BPE tokenizer locally so the benchmark runs without downloads.
+    """
+    import tokenizers
+    from tokenizers import decoders, models, pre_tokenizers, trainers
+
+    tokenizer = tokenizers.Tokenizer(models.BPE(unk_token=None))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=512, special_tokens=["<|endoftext|>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator([" ".join(WORDS)] * 16, trainer)
+    return transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|endoftext|>", pad_token="<|endoftext|>", bos_token="<|endoftext|>")
+
+
+def tiny_model(tokenizer, n_layer:int=2, n_embd:int=64, seed:int=0):
+    """
+    Build a small randomly initialized GPT-2 model. End of sequence is disabled so every request generates exactly max_new_tokens tokens.
+    """
+    config = transformers.GPT2Config(vocab_size=len(tokenizer), n_positions=2048, n_embd=n_embd, n_layer=n_layer, n_head=4,
+                                     eos_token_id=tokenizer.eos_token_id, bos_token_id=tokenizer.bos_token_id)
+    torch.manual_seed(seed)
+    model = transformers.GPT2LMHeadModel(config)
+    model.generation_config.eos_token_id = None
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    ## Randomly initialized models start in training mode (dropout on), which makes the outputs nondeterministic.
+    model.eval()
+    return model
+
+
+def build_registry(tokenizer, model, output_lengths:list[int], logits_format:str="json")->llm_registry.ModelRegistry:
+    """
+    Register one wrapper per wrapper type and output length, named "<wrapper>-<max_new_tokens>". All wrappers share the model.
+    """
+    registry = llm_registry.ModelRegistry()
+    for kind, cls in WRAPPERS.items():
+        for n in output_lengths:
+            registry.add(cls(f"{kind}-{n}", tokenizer, model, {"max_new_tokens": n, "logits_format": logits_format}))
+    return registry
+
+
+def start_server(registry:llm_registry.ModelRegistry, port:int=0):
+    """
+    Start LLM_Server in a background thread.
+    Returns:
+        tuple: The werkzeug server (call shutdown to stop it) and its base URL.
+    """
+    server = llm_server.LLM_Server(registry=registry, port=port)
+    http = werkzeug.serving.make_server("127.0.0.1", port, server.app, threaded=True)
+    threading.Thread(target=http.serve_forever, name="benchmark-server", daemon=True).start()
+    return http, f"http://127.0.0.1:{http.server_port}"
+
+
+def make_prompt(rng:random.Random, n_words:int)->str:
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def send(client:llm_client.Client, model:str, path:str, prompt:str)->dict:
+    """
+    Send one request and time it.
+    Returns:
+        dict: latency and ttft (seconds, ttft only for streams) and the generated text.
+    """
+    start = time.perf_counter()
+    if path == "stream":
+        ttft = None
+        chunks = []
+        data = {"prompt": prompt, "model": model, "run_config": {"do_sample": False}}
+        with client.session.post(client.stream_url, data=json.dumps(data), headers=client.headers, stream=True, timeout=client.timeout) as response:
+            response.raise_for_status()
+            event = "message"
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    if event == "error":
+                        raise RuntimeError(line[len("data:"):])
+                    if event == "end":
+                        break
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    chunks.append(json.loads(line[len("data:"):])["token"])
+                elif line == "":
+                    event = "message"
+        return {"latency": time.perf_counter() - start, "ttft": ttft, "text": "".join(chunks)}
+
+    data = {"prompt": prompt, "model": model, "process_logits": path == "logits", "run_config": {"do_sample": False}}
+    response = client.session.post(client.request_url, data=json.dumps(data), headers=client.headers, timeout=client.timeout)
+    response.raise_for_status()
+    text = response.json()["response"]
+    return {"latency": time.perf_counter() - start, "ttft": None, "text": text}
+
+
+def percentiles(values:list[float])->dict:
+    """
+    Get p50/p95/p99 and mean of a list of seconds, in milliseconds.
+    """
+    if not values:
+        return None
+    ms = np.array(values) * 1000.0
+    return {"p50": float(np.percentile(ms, 50)), "p95": float(np.percentile(ms, 95)), "p99": float(np.percentile(ms, 99)), "mean": float(ms.mean())}
+
+
+def run_scenario(base_url:str, wrapper:str, path:str, args, seed:int)->dict:
+    """
+    Drive one scenario at the configured concurrency and summarize throughput and latency.
+    """
+    rng = random.Random(seed)
+    jobs = [(f"{wrapper}-{rng.choice(args.output_lengths)}", make_prompt(rng, rng.choice(args.prompt_lengths))) for _ in range(args.requests)]
+    client = llm_client.Client(base_url, pool_size=args.concurrency, timeout=args.timeout)
+
+    ## Warm up each wrapper once so model initialization is not counted.
+    for model in sorted({model for model, _ in jobs}):
+        send(client, model, path, make_prompt(rng, 4))
+
+    results = []
+    errors = []
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {executor.submit(send, client, model, path, prompt): model for model, prompt in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results.append({**future.result(), "tokens": int(futures[future].rsplit("-", 1)[1])})
+            except Exception as e:
+                errors.append(str(e))
+    duration = time.perf_counter() - start
+
+    ## End of sequence is disabled for the tiny model, so every request generates exactly max_new_tokens tokens.
+    tokens = sum(r["tokens"] for r in results)
+    return {
+        "wrapper": wrapper,
+        "path": path,
+        "process_logits": path == "logits",
+        "concurrency": args.concurrency,
+        "requests": len(jobs),
+        "errors": len(errors),
+        "error_samples": errors[:3],
+        "duration_s": duration,
+        "requests_per_s": len(results) / duration if duration > 0 else None,
+        "tokens_per_s": tokens / duration if duration > 0 else None,
+        "output_tokens": tokens,
+        "latency_ms": percentiles([r["latency"] for r in results]),
+        "ttft_ms": percentiles([r["ttft"] for r in results if r["ttft"] is not None]),
+    }
+
+
+## Load-testing and latency benchmark for LLM_Server, using a tiny randomly initialized model (runs offline).
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark LLM_Server throughput and latency with a tiny random model.")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=32, help="Requests per scenario")
+    parser.add_argument("--prompt-lengths", type=int, nargs="+", default=[8, 32, 128], help="Prompt lengths in words, sampled uniformly")
+    parser.add_argument("--output-lengths", type=int, nargs="+", default=[16, 64], help="max_new_tokens values, sampled uniformly")
+    parser.add_argument("--wrappers", nargs="+", default=list(WRAPPERS), choices=list(WRAPPERS))
+    parser.add_argument("--paths", nargs="+", default=["request", "logits", "stream"], choices=["request", "logits", "stream"])
+    parser.add_argument("--logits-format", default="json", choices=["json", "npy"], help="Format of the scores returned with process_logits")
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--hidden", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write the JSON report to this file as well as stdout")
+    args = parser.parse_args()
+
+    ## Keep the per-request access log out of the JSON report.
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    tokenizer = tiny_tokenizer()
+    model = tiny_model(tokenizer, args.layers, args.hidden, args.seed)
+    http, base_url = start_server(build_registry(tokenizer, model, args.output_lengths, args.logits_format))
+
+    try:
+        scenarios = [run_scenario(base_url, wrapper, path, args, args.seed + i)
+                     for i, (wrapper, path) in enumerate(SCENARIOS) if wrapper in args.wrappers and path in args.paths]
+    finally:
+        http.shutdown()
+
+    report = {
+        "timestamp": time.time(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "threads": torch.get_num_threads(),
+        "config": vars(args),
+        "scenarios": scenarios,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
@@ -0,0 +1,467 @@
+import bisect
+import collections
+import copy
+import gzip
+import hashlib
+import json
+import sqlite3
+import string
+import threading
+import time
+import torch
+import transformers
+
+
+def cache_nbytes(cache)->int:
+    """
+    Get the memory used by the key/value tensors of a transformers cache.
+    """
+    tensors = []
+    for layer in getattr(cache, "layers", []):
+        tensors += [layer.keys, layer.values]
+    if not tensors:
+        tensors = list(getattr(cache, "key_cache", [])) + list(getattr(cache, "value_cache", []))
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+
+def template_prefix(template:str)->str:
+    """
+    Get the fixed text at the start of a format template (everything before the first {placeholder}).
+    """
+    for literal, field, _, _ in string.Formatter().parse(template):
+        return literal
+    return ""
+
+
+class _PrefixEntry(object):
+    """
+    Precomputed key/value cache for a registered prefix.
+    """
+    def __init__(self, text, input_ids, cache):
+        self.text = text
+        self.input_ids = input_ids
+        self.cache = cache
+        self.nbytes = cache_nbytes(cache)
+
+
+class PrefixCache(object):
+    """
+    LRU cache of precomputed past_key_values for registered prompt prefixes (decoder-only models).
+
+    A prompt reuses a prefix cache when its token ids start with the prefix token ids, so prefill only runs over
+    the remaining tokens.
+
+    Methods:
+        register: Precompute and store the key/value cache for a prefix.
+        lookup: Find the cache for the longest registered prefix of an encoded prompt.
+        info: Get statistics about the cache.
+    """
+    def __init__(self, model, tokenizer, max_bytes:int=1 << 30):
+        """
+        Parameters:
+            model: The language model (from Transformers library).
+            tokenizer: The tokenizer for the language model.
+            max_bytes (int): Memory budget for all cached prefixes, least recently used prefixes are evicted first. Default=1GB
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def register(self, prefix:str)->bool:
+        """
+        Run prefill over the prefix and store the resulting key/value cache.
+        Parameters:
+            prefix (str): The prompt prefix to cache.
+        Returns:
+            bool: True if the prefix is cached (False if it is empty or larger than the memory budget).
+        """
+        input_ids = self.tokenizer.encode(prefix, return_tensors="pt").to(self.model.device)
+
+        ## The last token is left out as it may merge with the text that follows the prefix.
+        input_ids = input_ids[:, :-1]
+        if input_ids.shape[1] == 0:
+            return False
+
+        cache = transformers.DynamicCache()
+        with torch.no_grad():
+            self.model(input_ids, past_key_values=cache, use_cache=True)
+
+        entry = _PrefixEntry(prefix, input_ids[0], cache)
+        if entry.nbytes > self.max_bytes:
+            return False
+
+        with self.lock:
+            old = self.entries.pop(prefix, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.entries[prefix] = entry
+            self.nbytes += entry.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+        return True
+
+    def lookup(self, prompt:str, input_ids):
+        """
+        Find the longest registered prefix of the prompt.
+        Parameters:
+            prompt (str): The prompt text.
+            input_ids (torch.Tensor): The encoded prompt of shape (1, length).
+        Returns:
+            DynamicCache: A copy of the prefix key/value cache that generate may extend, or None if no prefix matches.
+        """
+        if not isinstance(prompt, str) or input_ids.shape[0] != 1:
+            return None
+
+        with self.lock:
+            match = None
+            for entry in self.entries.values():
+                n = entry.input_ids.shape[0]
+                if n >= input_ids.shape[1] or not prompt.startswith(entry.text):
+                    continue
+                if match is not None and n <= match.input_ids.shape[0]:
+                    continue
+                if torch.equal(input_ids[0, :n], entry.input_ids):
+                    match = entry
+
+            if match is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(match.text)
+
+        ## Generate extends the cache in place, so every request gets its own copy.
+        return copy.deepcopy(match.cache)
+
+    def info(self)->dict:
+        """
+        Get statistics about the prefix cache.
+        """
+        with self.lock:
+            return {
+                "prefixes": len(self.entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class _SessionEntry(object):
+    """
+    Key/value cache of a conversation and the token ids it covers.
+    """
+    def __init__(self, input_ids, cache):
+        self.input_ids = input_ids
+        self.cache = cache
+        self.nbytes = cache_nbytes(cache)
+        self.last_used = time.time()
+
+
+class SessionCache(object):
+    """
+    Key/value caches of conversations kept between requests (decoder-only models), so a follow-up turn only prefills
+    the tokens added since the previous turn.
+
+    A session is taken out of the cache while a request uses it and stored again with the extended cache afterwards.
+    The cache is cut back to the longest common prefix of the stored tokens and the new prompt, so a prompt that drops
+    or rewrites the end of the conversation still reuses the part before it.
+
+    Methods:
+        lookup: Take the cache of a session for an encoded prompt.
+        store: Keep the cache of a session after generation.
+        close: Drop a session.
+        info: Get statistics about the cache.
+    """
+    def __init__(self, max_bytes:int=1 << 30, idle_timeout:float=600.0, on_event=None):
+        """
+        Parameters:
+            max_bytes (int): Memory budget for all sessions, least recently used sessions are evicted first. Default=1GB
+            idle_timeout (float): Seconds after which an unused session is dropped. Default=600 (None to keep sessions until evicted)
+            on_event (Callable): Called with an event name (hits, misses, evictions, expirations, reused_tokens) and a count, e.g. to update metrics. Default=None
+        """
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self.on_event = on_event
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.reused_tokens = 0
+        self.lock = threading.Lock()
+
+    def _event(self, name:str, count:int=1):
+        if self.on_event is not None and count:
+            self.on_event(name, count)
+
+    def _expire(self)->int:
+        ## Entries are kept in order of last use, so idle sessions are at the front.
+        expired = 0
+        if self.idle_timeout is not None:
+            now = time.time()
+            while self.entries and now - next(iter(self.entries.values())).last_used > self.idle_timeout:
+                _, entry = self.entries.popitem(last=False)
+                self.nbytes -= entry.nbytes
+                expired += 1
+        self.expirations += expired
+        return expired
+
+    def lookup(self, session_id:str, input_ids):
+        """
+        Take the cache of a session for an encoded prompt.
+        Parameters:
+            session_id (str): The session id.
+            input_ids (torch.Tensor): The encoded prompt of shape (1, length).
+        Returns:
+            tuple: The key/value cache cut back to the tokens it shares with the prompt (None on a miss) and the number of reused tokens.
+        """
+        with self.lock:
+            expired = self._expire()
+            entry = self.entries.pop(session_id, None)
+            if entry is not None:
+                self.nbytes -= entry.nbytes
+        self._event("expirations", expired)
+
+        ## At least the last prompt token is left for prefill so generate has logits to start from.
+        common = 0
+        if entry is not None:
+            n = min(entry.input_ids.shape[0], input_ids.shape[1] - 1)
+            same = entry.input_ids[:n] == input_ids[0, :n].to(entry.input_ids.device)
+            common = n if bool(same.all()) else int(same.int().argmin())
+
+        with self.lock:
+            if common == 0:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.reused_tokens += common
+        if common == 0:
+            self._event("misses")
+            return None, 0
+        self._event("hits")
+        self._event("reused_tokens", common)
+
+        if common < entry.cache.get_seq_length():
+            entry.cache.crop(common)
+        return entry.cache, common
+
+    def store(self, session_id:str, input_ids, cache)->bool:
+        """
+        Keep the cache of a session after generation.
+        Parameters:
+            session_id (str): The session id.
+            input_ids (torch.Tensor): The generated sequence (prompt and new tokens) of shape (length,).
+            cache: The key/value cache extended by generate.
+        Returns:
+            bool: True if the session is kept (False if it is larger than the memory budget).
+        """
+        entry = _SessionEntry(input_ids[:cache.get_seq_length()].clone(), cache)
+        if entry.nbytes > self.max_bytes:
+            return False
+
+        evicted = 0
+        with self.lock:
+            old = self.entries.pop(session_id, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.entries[session_id] = entry
+            self.nbytes += entry.nbytes
+            while self.nbytes > self.max_bytes:
+                _, dropped = self.entries.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+                evicted += 1
+            self.evictions += evicted
+        self._event("evictions", evicted)
+        return True
+
+    def close(self, session_id:str)->bool:
+        """
+        Drop a session.
+        Returns:
+            bool: True if the session was cached.
+        """
+        with self.lock:
+            entry = self.entries.pop(session_id, None)
+            if entry is not None:
+                self.nbytes -= entry.nbytes
+        return entry is not None
+
+    def info(self)->dict:
+        """
+        Get statistics about the session cache.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "sessions": len(self.entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "idle_timeout": self.idle_timeout,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "reused_tokens": self.reused_tokens,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class ResponseCache(object):
+    """
+    Exact-match LRU cache of responses for deterministic requests.
+
+    Entries are keyed on the model name, the normalized prompt and the effective generation kwargs. Entries can
+    expire after a TTL and can optionally be persisted to a SQLite file so they survive restarts.
+
+    Methods:
+        key: Build the cache key for a request (None if the request must not be cached).
+        get: Get a cached response.
+        put: Store a response.
+        info: Get hit/miss counters.
+    """
+    def __init__(self, max_entries:int=1024, ttl:float=None, path:str=None):
+        """
+        Parameters:
+            max_entries (int): Maximum number of cached responses, least recently used are evicted first. Default=1024
+            ttl (float): Seconds after which an entry expires. Default=None (never)
+            path (str): SQLite file to persist entries to. Default=None (memory only)
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+        self.db = None
+
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("create table if not exists responses (key text primary key not null, response text not null, created real not null)")
+            rows = self.db.execute("select key, response, created from responses order by created desc limit ?", (max_entries,)).fetchall()
+            for key, response, created in reversed(rows):
+                self.entries[key] = (json.loads(response), created)
+
+    def key(self, model_name:str, prompt, kwargs:dict):
+        """
+        Build the cache key for a request.
+        Parameters:
+            model_name (str): The name of the wrapped model.
+            prompt: The prompt (text or list of chat messages).
+            kwargs (dict): The effective generation kwargs.
+        Returns:
+            str: The cache key, or None if the request samples and must not be cached.
+        """
+        if kwargs.get("do_sample", False):
+            with self.lock:
+                self.bypasses += 1
+            return None
+
+        ## Chat prompts are normalized by serializing with sorted keys; text prompts are used as-is since whitespace changes the output.
+        settings = {k: v for k, v in kwargs.items() if k != "logits_processor"}
+        data = json.dumps({"model": model_name, "prompt": prompt, "kwargs": settings}, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(self, key:str)->dict:
+        """
+        Get a cached response.
+        Returns:
+            dict: A copy of the cached response, or None on a miss.
+        """
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None and self.ttl is not None and time.time() - entry[1] > self.ttl:
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return dict(entry[0])
+
+    def put(self, key:str, response:dict):
+        """
+        Store a response.
+        """
+        created = time.time()
+        with self.lock:
+            self.entries[key] = (dict(response), created)
+            self.entries.move_to_end(key)
+            if self.db is not None:
+                self.db.execute("insert or replace into responses (key, response, created) values (?, ?, ?)", (key, json.dumps(response), created))
+            while len(self.entries) > self.max_entries:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+            if self.db is not None:
+                self.db.commit()
+
+    def _remove(self, key:str):
+        self.entries.pop(key, None)
+        if self.db is not None:
+            self.db.execute("delete from responses where key = ?", (key,))
+            self.db.commit()
+
+    def info(self)->dict:
+        """
+        Get statistics about the response cache.
+        """
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "persistent": self.path is not None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class VocabCache(object):
+    """
+    Vocabulary of a tokenizer computed once and kept pre-serialized (plain and gzip compressed) with an ETag.
+
+    Methods:
+        page: Get the part of the vocabulary with ids in a range.
+    """
+    def __init__(self, vocab:dict):
+        """
+        Parameters:
+            vocab (dict): Mapping of token to id (from tokenizer.get_vocab()).
+        """
+        self.vocab = vocab
+        self.items = sorted(vocab.items(), key=lambda item: item[1])
+        self.ids = [token_id for _, token_id in self.items]
+        self.json = json.dumps(vocab).encode("utf-8")
+        self.gzip = gzip.compress(self.json)
+        self.etag = hashlib.sha1(self.json).hexdigest()
+
+    def page(self, start:int=None, stop:int=None)->dict:
+        """
+        Get the tokens with start <= id < stop.
+        Returns:
+            dict: Mapping of token to id for the range.
+        """
+        lo = bisect.bisect_left(self.ids, start) if start is not None else 0
+        hi = bisect.bisect_left(self.ids, stop) if stop is not None else len(self.ids)
+        return dict(self.items[lo:hi])
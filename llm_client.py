@@ -1,17 +1,43 @@
 import requests
+import requests.adapters
 import json
+import os
+import tempfile
+import numpy as np
+import llm_logits
 
 
 class Client(object):
-    def __init__(self, target_url:str="http://localhost:5000"):
+    def __init__(self, target_url:str="http://localhost:5000", pool_size:int=10, timeout:float=None):
+        """
+        Parameters:
+            target_url (str): Base URL of the LLM server. Default=http://localhost:5000
+            pool_size (int): Number of keep-alive connections kept in the session pool. Default=10
+            timeout (float): Timeout in seconds for each call. Default=None (no timeout)
+        """
         self.request_url = f"{target_url}/request"
         self.vocab_url = f"{target_url}/vocab"
+        self.stream_url = f"{target_url}/stream"
+        self.batch_url = f"{target_url}/batch"
+        self.logits_url = f"{target_url}/logits"
+        self.sessions_url = f"{target_url}/sessions"
+        self.tokenize_url = f"{target_url}/tokenize"
+        self.detokenize_url = f"{target_url}/detokenize"
+        self.vocab = None
+        self.vocab_etag = None
         self.headers = {
             "Content-Type": "application/json",
             "Connection": "keep-alive",
 
         }
 
+        ## Pooled session so keep-alive connections are actually reused between calls.
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
     def prompt_to_response(self, prompt:str, debug=False)-> str:
         """
         Helper method to convert a prompt to a response
@@ -23,47 +49,362 @@ class Client(object):
         """
         Helper method to send a request to the LLM
         """
-        response = requests.post(self.request_url, data=json.dumps({"prompt":prompt, "process_logits":False, "run_config": {"do_sample": False,
-    "debug_mode": False}}), headers=self.headers).json()
+        response = self.session.post(self.request_url, data=json.dumps({"prompt":prompt, "process_logits":False, "run_config": {"do_sample": False,
+    "debug_mode": False}}), headers=self.headers, timeout=self.timeout).json()
         return response
     
-    def send_request(self, prompt:list[dict], process_logits:bool=False, run_config:dict={}):
+    def send_request(self, prompt:list[dict], process_logits:bool=False, run_config:dict={}, session_id:str=None):
         """
-        Helper method to send a request to the LLM
+        Helper method to send a request to the LLM. Requests with the same session id keep the conversation cached on the
+        server, so each turn only prefills what was added since the previous one.
         """
-        response = requests.post(self.request_url, data=json.dumps({"prompt":prompt, "process_logits":process_logits, "run_config": run_config}), headers=self.headers).json()
+        data = {"prompt":prompt, "process_logits":process_logits, "run_config": run_config}
+        if session_id is not None:
+            data["session_id"] = session_id
+        response = self.session.post(self.request_url, data=json.dumps(data), headers=self.headers, timeout=self.timeout).json()
         return response
+
+    def close_session(self, session_id:str)->bool:
+        """
+        Helper method to end a conversation session and free its cache on the server
+        """
+        response = self.session.delete(f"{self.sessions_url}/{session_id}", timeout=self.timeout)
+        return response.status_code == 200
     
     def send_request_with_debug(self, prompt:list[dict], process_logits:bool=False):
         """
         Helper method to send a request to the LLM
         """
-        response = requests.post(self.request_url, data=json.dumps({"prompt":prompt, "process_logits":process_logits, "run_config": {"do_sample": False,
-    "debug_mode": True}}), headers=self.headers).json()
+        response = self.session.post(self.request_url, data=json.dumps({"prompt":prompt, "process_logits":process_logits, "run_config": {"do_sample": False,
+    "debug_mode": True}}), headers=self.headers, timeout=self.timeout).json()
         return response
     
     def send_request_with_sampling(self, prompt:list[dict], process_logits:bool=False):
         """
         Helper method to send a request to the LLM
         """
-        response = requests.post(self.request_url, data=json.dumps({"prompt":prompt, "process_logits":process_logits, "run_config": {"do_sample": True,
-    "debug_mode": False}}), headers=self.headers).json()
+        response = self.session.post(self.request_url, data=json.dumps({"prompt":prompt, "process_logits":process_logits, "run_config": {"do_sample": True,
+    "debug_mode": False}}), headers=self.headers, timeout=self.timeout).json()
         return response
     
     def send_request_with_sampling_and_debug(self, prompt:list[dict], process_logits:bool=False):
         """
         Helper method to send a request to the LLM
         """
-        response = requests.post(self.request_url, data=json.dumps({"prompt":prompt, "process_logits":process_logits, "run_config": {"do_sample": True,
-    "debug_mode": True}}), headers=self.headers).json()
+        response = self.session.post(self.request_url, data=json.dumps({"prompt":prompt, "process_logits":process_logits, "run_config": {"do_sample": True,
+    "debug_mode": True}}), headers=self.headers, timeout=self.timeout).json()
         return response
     
+    def send_batch(self, prompts:list, process_logits:bool=False, run_config:dict={}, run_configs:list[dict]=None)->list[dict]:
+        """
+        Helper method to send many prompts to the LLM in one request. run_configs optionally sets a run configuration per prompt.
+        Returns one result per prompt, in order (failed prompts have an "error" key).
+        """
+        run_configs = run_configs or [run_config] * len(prompts)
+        items = [{"prompt": prompt, "process_logits": process_logits, "run_config": rc} for prompt, rc in zip(prompts, run_configs)]
+        response = self.session.post(self.batch_url, data=json.dumps({"items": items}), headers=self.headers, timeout=self.timeout).json()
+        return response["results"]
+
+    def stream_request(self, prompt:list[dict], run_config:dict={}):
+        """
+        Helper method to stream a response from the LLM. Yields text as the tokens arrive.
+        """
+        with self.session.post(self.stream_url, data=json.dumps({"prompt":prompt, "run_config": run_config}), headers=self.headers, stream=True, timeout=self.timeout) as response:
+            event = "message"
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data = json.loads(line[len("data:"):])
+                    if event == "end":
+                        return
+                    if event == "error":
+                        raise RuntimeError(data.get("error"))
+                    yield data["token"]
+                elif line == "":
+                    event = "message"
+
+    def get_vocab(self)->dict:
+        """
+        Helper method to get the vocabulary of the LLM. The vocabulary is cached locally and only downloaded again if its ETag changes.
+        """
+        headers = {"If-None-Match": self.vocab_etag} if self.vocab_etag else {}
+        response = self.session.get(self.vocab_url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304:
+            return self.vocab
+        response.raise_for_status()
+        self.vocab = response.json()
+        self.vocab_etag = response.headers.get("ETag", None)
+        return self.vocab
+
+    def tokenize(self, texts:list[str], add_special_tokens:bool=True)->list[list[int]]:
+        """
+        Helper method to tokenize a batch of texts with the LLM tokenizer
+        """
+        response = self.session.post(self.tokenize_url, data=json.dumps({"texts": texts, "add_special_tokens": add_special_tokens}), headers=self.headers, timeout=self.timeout).json()
+        return response["input_ids"]
+
+    def detokenize(self, input_ids:list[list[int]], skip_special_tokens:bool=False)->dict:
+        """
+        Helper method to convert a batch of token ids back to texts and tokens
+        """
+        return self.session.post(self.detokenize_url, data=json.dumps({"input_ids": input_ids, "skip_special_tokens": skip_special_tokens}), headers=self.headers, timeout=self.timeout).json()
+
+    def get_logits(self, array_id:str, start:int=None, stop:int=None, path:str=None)->np.ndarray:
+        """
+        Helper method to download binary scores (requested with logits_format="npy") and open them as a memory-mapped array.
+        start/stop select a range of decode steps; only those steps are transferred, with an HTTP Range request.
+        Without a path the download goes to a temporary file that is removed once it is mapped.
+        """
+        url = f"{self.logits_url}/{array_id}"
+        shape, dtype, first, last = None, None, None, None
+        if start is not None or stop is not None:
+            response = self.session.get(url, headers={"Range": f"bytes=0-{llm_logits.HEADER_BYTES - 1}"}, timeout=self.timeout)
+            response.raise_for_status()
+            header = llm_logits.npy_header(response.content)
+            first, last, shape = llm_logits.step_byte_range(header, start, stop)
+            dtype = header["dtype"]
+
+        remove = path is None
+        if remove:
+            fd, path = tempfile.mkstemp(suffix=".npy", prefix=f"{array_id}_")
+            os.close(fd)
+
+        try:
+            with open(path, "wb") as f:
+                if shape is not None:
+                    f.write(llm_logits.header_bytes(shape, dtype))
+                if shape is None or first is not None:
+                    headers = {"Range": f"bytes={first}-{last}"} if first is not None else None
+                    with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                        response.raise_for_status()
+                        if headers is not None and response.status_code != 206:
+                            raise requests.HTTPError(f"Range request not honoured for logits {array_id}", response=response)
+                        for chunk in response.iter_content(chunk_size=1 << 20):
+                            f.write(chunk)
+            return llm_logits.open_npy(path, remove)
+        except BaseException:
+            if remove and os.path.exists(path):
+                os.remove(path)
+            raise
+
     def extract_response(self, response):
         """
         Helper method to extract the response from the LLM
         """
-        return response["response"][1]["content"]
+        text = response["response"]
+        ## With return_full_text the response is the whole conversation, ending with the reply.
+        return text if isinstance(text, str) else text[-1]["content"]
     
+import asyncio
+import httpx
+
+class AsyncClient(object):
+    """
+    Async client for the LLM server with the same methods as Client.
+
+    Uses a pooled connection, bounds the number of concurrent calls, retries with exponential backoff when the server
+    is busy (429/503) or unreachable, and supports per-call timeouts. Use gather to fan out many prompts.
+    """
+    def __init__(self, target_url:str="http://localhost:5000", max_concurrency:int=8, retries:int=3, backoff:float=0.5, timeout:float=300.0):
+        """
+        Parameters:
+            target_url (str): Base URL of the LLM server. Default=http://localhost:5000
+            max_concurrency (int): Maximum number of calls in flight at once. Default=8
+            retries (int): Number of retries on 429/503 responses and connection errors. Default=3
+            backoff (float): Initial backoff in seconds, doubled on each retry (a Retry-After header takes precedence). Default=0.5
+            timeout (float): Default timeout in seconds for each call. Default=300
+        """
+        self.request_url = f"{target_url}/request"
+        self.vocab_url = f"{target_url}/vocab"
+        self.stream_url = f"{target_url}/stream"
+        self.batch_url = f"{target_url}/batch"
+        self.logits_url = f"{target_url}/logits"
+        self.sessions_url = f"{target_url}/sessions"
+        self.tokenize_url = f"{target_url}/tokenize"
+        self.detokenize_url = f"{target_url}/detokenize"
+        self.vocab = None
+        self.vocab_etag = None
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.client = httpx.AsyncClient(
+            headers={"Content-Type": "application/json"},
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+            timeout=timeout,
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def aclose(self):
+        """
+        Close the pooled connections.
+        """
+        await self.client.aclose()
+
+    async def call(self, method:str, url:str, data:dict=None, timeout:float=None, headers:dict=None)->httpx.Response:
+        """
+        Helper method to make a call to the server, retrying with backoff on 429/503 responses and connection errors.
+        """
+        content = json.dumps(data) if data is not None else None
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    response = await self.client.request(method, url, content=content, headers=headers, timeout=timeout or self.timeout)
+            except httpx.ConnectError:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+            else:
+                if response.status_code not in (429, 503) or attempt == self.retries:
+                    return response
+                retry_after = response.headers.get("Retry-After", None)
+                delay = float(retry_after) if retry_after else self.backoff * 2 ** attempt
+            await asyncio.sleep(delay)
+
+    async def prompt_to_response(self, prompt:str, debug=False)-> str:
+        """
+        Helper method to convert a prompt to a response
+        """
+        response = await self.send_request([{"role": "user", "content": prompt}])
+        return self.extract_response(response)
+
+    async def send_request(self, prompt:list[dict], process_logits:bool=False, run_config:dict={}, timeout:float=None, session_id:str=None):
+        """
+        Helper method to send a request to the LLM. Requests with the same session id keep the conversation cached on the server.
+        """
+        data = {"prompt":prompt, "process_logits":process_logits, "run_config": run_config}
+        if session_id is not None:
+            data["session_id"] = session_id
+        response = await self.call("POST", self.request_url, data, timeout)
+        response.raise_for_status()
+        return response.json()
+
+    async def close_session(self, session_id:str)->bool:
+        """
+        Helper method to end a conversation session and free its cache on the server
+        """
+        response = await self.call("DELETE", f"{self.sessions_url}/{session_id}")
+        return response.status_code == 200
+
+    async def gather(self, prompts:list, process_logits:bool=False, run_config:dict={}, timeout:float=None, return_exceptions:bool=False)->list:
+        """
+        Helper method to send many prompts concurrently (bounded by max_concurrency). Results are returned in order.
+        """
+        return await asyncio.gather(*[self.send_request(prompt, process_logits, run_config, timeout) for prompt in prompts], return_exceptions=return_exceptions)
+
+    async def send_batch(self, prompts:list, process_logits:bool=False, run_config:dict={}, run_configs:list[dict]=None, timeout:float=None)->list[dict]:
+        """
+        Helper method to send many prompts to the LLM in one /batch request. run_configs optionally sets a run configuration per prompt.
+        """
+        run_configs = run_configs or [run_config] * len(prompts)
+        items = [{"prompt": prompt, "process_logits": process_logits, "run_config": rc} for prompt, rc in zip(prompts, run_configs)]
+        response = await self.call("POST", self.batch_url, {"items": items}, timeout)
+        response.raise_for_status()
+        return response.json()["results"]
+
+    async def stream_request(self, prompt:list[dict], run_config:dict={}, timeout:float=None):
+        """
+        Helper method to stream a response from the LLM. Yields text as the tokens arrive.
+        """
+        async with self.semaphore:
+            async with self.client.stream("POST", self.stream_url, content=json.dumps({"prompt":prompt, "run_config": run_config}), timeout=timeout or self.timeout) as response:
+                response.raise_for_status()
+                event = "message"
+                async for line in response.aiter_lines():
+                    if line.startswith("event:"):
+                        event = line[len("event:"):].strip()
+                    elif line.startswith("data:"):
+                        data = json.loads(line[len("data:"):])
+                        if event == "end":
+                            return
+                        if event == "error":
+                            raise RuntimeError(data.get("error"))
+                        yield data["token"]
+                    elif line == "":
+                        event = "message"
+
+    async def get_vocab(self)->dict:
+        """
+        Helper method to get the vocabulary of the LLM. The vocabulary is cached locally and only downloaded again if its ETag changes.
+        """
+        headers = {"If-None-Match": self.vocab_etag} if self.vocab_etag else None
+        response = await self.call("GET", self.vocab_url, headers=headers)
+        if response.status_code == 304:
+            return self.vocab
+        response.raise_for_status()
+        self.vocab = response.json()
+        self.vocab_etag = response.headers.get("ETag", None)
+        return self.vocab
+
+    async def get_logits(self, array_id:str, start:int=None, stop:int=None, path:str=None, timeout:float=None)->np.ndarray:
+        """
+        Helper method to download binary scores (requested with logits_format="npy") and open them as a memory-mapped array.
+        start/stop select a range of decode steps; only those steps are transferred, with an HTTP Range request.
+        Without a path the download goes to a temporary file that is removed once it is mapped.
+        """
+        url = f"{self.logits_url}/{array_id}"
+        shape, dtype, first, last = None, None, None, None
+        if start is not None or stop is not None:
+            response = await self.call("GET", url, headers={"Range": f"bytes=0-{llm_logits.HEADER_BYTES - 1}"}, timeout=timeout)
+            response.raise_for_status()
+            header = llm_logits.npy_header(response.content)
+            first, last, shape = llm_logits.step_byte_range(header, start, stop)
+            dtype = header["dtype"]
+
+        remove = path is None
+        if remove:
+            fd, path = tempfile.mkstemp(suffix=".npy", prefix=f"{array_id}_")
+            os.close(fd)
+
+        try:
+            with open(path, "wb") as f:
+                if shape is not None:
+                    f.write(llm_logits.header_bytes(shape, dtype))
+                if shape is None or first is not None:
+                    headers = {"Range": f"bytes={first}-{last}"} if first is not None else None
+                    async with self.semaphore:
+                        async with self.client.stream("GET", url, headers=headers, timeout=timeout or self.timeout) as response:
+                            response.raise_for_status()
+                            if headers is not None and response.status_code != 206:
+                                raise httpx.HTTPStatusError(f"Range request not honoured for logits {array_id}", request=response.request, response=response)
+                            async for chunk in response.aiter_bytes(1 << 20):
+                                f.write(chunk)
+            return llm_logits.open_npy(path, remove)
+        except BaseException:
+            if remove and os.path.exists(path):
+                os.remove(path)
+            raise
+
+    async def tokenize(self, texts:list[str], add_special_tokens:bool=True)->list[list[int]]:
+        """
+        Helper method to tokenize a batch of texts with the LLM tokenizer
+        """
+        response = await self.call("POST", self.tokenize_url, {"texts": texts, "add_special_tokens": add_special_tokens})
+        response.raise_for_status()
+        return response.json()["input_ids"]
+
+    async def detokenize(self, input_ids:list[list[int]], skip_special_tokens:bool=False)->dict:
+        """
+        Helper method to convert a batch of token ids back to texts and tokens
+        """
+        response = await self.call("POST", self.detokenize_url, {"input_ids": input_ids, "skip_special_tokens": skip_special_tokens})
+        response.raise_for_status()
+        return response.json()
+
+    def extract_response(self, response):
+        """
+        Helper method to extract the response from the LLM
+        """
+        text = response["response"]
+        ## With return_full_text the response is the whole conversation, ending with the reply.
+        return text if isinstance(text, str) else text[-1]["content"]
+
 import openai
 
 class OpenAIClient(object):
@@ -0,0 +1,506 @@
+import collections
+import json
+import threading
+import torch
+
+WHITESPACE = " \t\n\r"
+## Consecutive whitespace characters allowed between JSON tokens by default (stops a model from padding output with
+## whitespace forever). A newline and the indentation of pretty-printed JSON count together, so this allows an indent
+## of 2 spaces up to 7 levels deep (or 4 spaces up to 3). Whitespace inside strings and keys is content and does not count.
+MAX_WHITESPACE = 16
+_STRING_FRAMES = ("S", "SE", "SU", "K")
+
+_DONE = (("D",),)
+_NUMBER_TERMINAL = ("zero", "int", "frac", "expd")
+
+
+def _number_step(phase:str, integer:bool, ch:str)->str:
+    """
+    Next phase of a JSON number after a character (None if the character cannot continue the number).
+    """
+    digit = "0" <= ch <= "9"
+    if phase == "sign":
+        return "zero" if ch == "0" else ("int" if digit else None)
+    if phase in ("zero", "int"):
+        if phase == "int" and digit:
+            return "int"
+        if integer:
+            return None
+        return "dot" if ch == "." else ("exp" if ch in "eE" else None)
+    if phase == "dot":
+        return "frac" if digit else None
+    if phase == "frac":
+        return "frac" if digit else ("exp" if ch in "eE" and not integer else None)
+    if phase == "exp":
+        return "expsign" if ch in "+-" else ("expd" if digit else None)
+    if phase in ("expsign", "expd"):
+        return "expd" if digit else None
+    return None
+
+
+class JsonSchemaGrammar(object):
+    """
+    Character level acceptor for JSON documents matching a JSON schema, used to constrain generation.
+
+    The schema is compiled into nodes; the parse state is a set of stacks of frames (a set because anyOf and numbers
+    can be ambiguous until more characters arrive). States are immutable and hashable, so allowed-token masks can be
+    cached per state. Supported: type (including lists of types), properties/required (only declared properties are
+    generated), additionalProperties, items/prefixItems/minItems/maxItems, maxLength, enum, const, anyOf/oneOf,
+    allOf (merged), $ref to $defs/definitions. Other keywords (pattern, format, minimum, ...) are not enforced.
+
+    Methods:
+        feed: Advance a state by some text.
+        is_complete: Check if a state is a complete document.
+        can_end: Check if a state may end here (complete, or a complete number at the top level).
+    """
+    def __init__(self, schema:dict, max_whitespace:int=MAX_WHITESPACE):
+        """
+        Parameters:
+            schema (dict): The JSON schema.
+            max_whitespace (int): Consecutive whitespace characters allowed between JSON tokens (0 for compact output).
+        """
+        self.root = schema
+        self.max_whitespace = max_whitespace
+        self.nodes = []
+        self.refs = {}
+        self.any_node = self._add(("any",))
+        self.start_node = self._compile(schema)
+        self.initial = frozenset([((("D",), ("V", self.start_node)), 0)])
+        self.step_cache = {}
+        self.mask_cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _add(self, node)->int:
+        self.nodes.append(node)
+        return len(self.nodes) - 1
+
+    def _resolve(self, ref:str)->dict:
+        if not ref.startswith("#/"):
+            raise ValueError(f"Only local $ref are supported: {ref}")
+        schema = self.root
+        for part in ref[2:].split("/"):
+            schema = schema[part.replace("~1", "/").replace("~0", "~")]
+        return schema
+
+    def _compile(self, schema)->int:
+        """
+        Compile a schema into a node and return its index.
+        """
+        if schema is True or schema is None or schema == {}:
+            return self.any_node
+        if schema is False:
+            return self._add(("union", ()))
+
+        if "$ref" in schema:
+            ref = schema["$ref"]
+            if ref not in self.refs:
+                ## Reserve the node first so recursive schemas refer to it.
+                self.refs[ref] = self._add(None)
+                self.nodes[self.refs[ref]] = self.nodes[self._compile(self._resolve(ref))]
+            return self.refs[ref]
+
+        if "allOf" in schema:
+            merged = {k: v for k, v in schema.items() if k != "allOf"}
+            for part in schema["allOf"]:
+                part = self._resolve(part["$ref"]) if "$ref" in part else part
+                for k, v in part.items():
+                    if k in ("properties",) and k in merged:
+                        merged[k] = {**merged[k], **v}
+                    elif k == "required" and k in merged:
+                        merged[k] = list(merged[k]) + list(v)
+                    else:
+                        merged.setdefault(k, v)
+            return self._compile(merged)
+
+        for key in ("anyOf", "oneOf"):
+            if key in schema:
+                return self._add(("union", tuple(self._compile(s) for s in schema[key])))
+
+        if "const" in schema:
+            return self._add(("literal", (json.dumps(schema["const"]),)))
+        if "enum" in schema:
+            return self._add(("literal", tuple(json.dumps(v) for v in schema["enum"])))
+
+        kind = schema.get("type", None)
+        if isinstance(kind, list):
+            return self._add(("union", tuple(self._compile({**schema, "type": k}) for k in kind)))
+        if kind is None:
+            if "properties" in schema:
+                kind = "object"
+            elif "items" in schema or "prefixItems" in schema:
+                kind = "array"
+            else:
+                return self.any_node
+
+        if kind == "object":
+            properties = schema.get("properties", {})
+            additional = schema.get("additionalProperties", True)
+            node = self._add(None)
+            props = tuple((name, self._compile(s)) for name, s in properties.items())
+            ## Tool schemas list their parameters, so only declared properties are generated when there are any.
+            extra = None if properties or additional is False else self._compile(additional if isinstance(additional, dict) else {})
+            self.nodes[node] = ("object", props, frozenset(schema.get("required", [])), extra)
+            return node
+        if kind == "array":
+            node = self._add(None)
+            prefix = tuple(self._compile(s) for s in schema.get("prefixItems", []))
+            items = schema.get("items", True)
+            items = None if items is False else self._compile(items)
+            max_items = schema.get("maxItems", None)
+            if items is None:
+                max_items = len(prefix) if max_items is None else min(max_items, len(prefix))
+            self.nodes[node] = ("array", prefix, items, schema.get("minItems", 0), max_items)
+            return node
+        if kind == "string":
+            return self._add(("string", schema.get("maxLength", None)))
+        if kind in ("number", "integer"):
+            return self._add(("number", kind == "integer"))
+        if kind == "boolean":
+            return self._add(("literal", ("true", "false")))
+        if kind == "null":
+            return self._add(("literal", ("null",)))
+        raise ValueError(f"Unsupported schema type: {kind}")
+
+    def _start_value(self, rest:tuple, node:int, ch:str)->list:
+        """
+        Stacks after the first character of a value for a node, below which is rest.
+        """
+        if ch in WHITESPACE:
+            return [rest + (("V", node),)]
+
+        n = self.nodes[node]
+        kind = n[0]
+        if kind == "any":
+            if ch == "{":
+                return [rest + (("O", node, (), True),)]
+            if ch == "[":
+                return [rest + (("R", node, 0, True),)]
+            if ch == '"':
+                return [rest + (("S", None, 0),)]
+            if ch == "-" or "0" <= ch <= "9":
+                return [rest + (("N", False, "sign" if ch == "-" else ("zero" if ch == "0" else "int")),)]
+            options = tuple(o for o in ("true", "false", "null") if o[0] == ch)
+            return [rest + (("L", options, 1),)] if options else []
+        if kind == "union":
+            return [stack for alt in n[1] for stack in self._start_value(rest, alt, ch)]
+        if kind == "literal":
+            options = tuple(o for o in n[1] if o[0] == ch)
+            return [rest + (("L", options, 1),)] if options else []
+        if kind == "object":
+            return [rest + (("O", node, (), True),)] if ch == "{" else []
+        if kind == "array":
+            return [rest + (("R", node, 0, True),)] if ch == "[" else []
+        if kind == "string":
+            return [rest + (("S", n[1], 0),)] if ch == '"' else []
+        if kind == "number":
+            if ch == "-":
+                return [rest + (("N", n[1], "sign"),)]
+            if "0" <= ch <= "9":
+                return [rest + (("N", n[1], "zero" if ch == "0" else "int"),)]
+            return []
+        return []
+
+    def _object_fields(self, node:int):
+        """
+        Get (properties, required, extra) of an object node; "any" nodes are free objects.
+        """
+        n = self.nodes[node]
+        if n[0] == "any":
+            return (), frozenset(), self.any_node
+        return n[1], n[2], n[3]
+
+    def _array_item(self, node:int, index:int):
+        n = self.nodes[node]
+        if n[0] == "any":
+            return self.any_node, 0, None
+        prefix, items, min_items, max_items = n[1], n[2], n[3], n[4]
+        return (prefix[index] if index < len(prefix) else items), min_items, max_items
+
+    def _feed(self, stack:tuple, ch:str)->list:
+        """
+        Stacks after feeding one character to a stack.
+        """
+        top = stack[-1]
+        rest = stack[:-1]
+        kind = top[0]
+
+        if kind == "D":
+            return []
+        if kind == "V":
+            return self._start_value(rest, top[1], ch)
+
+        if kind == "S":
+            max_length, length = top[1], top[2]
+            if ch == '"':
+                return [rest]
+            if ch == "\\":
+                return [rest + (("SE", max_length, length),)]
+            if ord(ch) < 0x20:
+                return []
+            if max_length is None:
+                return [stack]
+            return [rest + (("S", max_length, length + 1),)] if length < max_length else []
+        if kind == "SE":
+            max_length, length = top[1], top[2]
+            if max_length is not None and length >= max_length:
+                return []
+            if ch == "u":
+                return [rest + (("SU", max_length, length, 4),)]
+            return [rest + (("S", max_length, length if max_length is None else length + 1),)] if ch in '"\\/bfnrt' else []
+        if kind == "SU":
+            max_length, length, remaining = top[1], top[2], top[3]
+            if ch not in "0123456789abcdefABCDEF":
+                return []
+            if remaining > 1:
+                return [rest + (("SU", max_length, length, remaining - 1),)]
+            return [rest + (("S", max_length, length if max_length is None else length + 1),)]
+
+        if kind == "N":
+            integer, phase = top[1], top[2]
+            res = []
+            nxt = _number_step(phase, integer, ch)
+            if nxt is not None:
+                res.append(rest + (("N", integer, nxt),))
+            if phase in _NUMBER_TERMINAL:
+                ## The number ends here, the character belongs to the enclosing value.
+                res += self._feed(rest, ch)
+            return res
+        if kind == "L":
+            options, pos = top[1], top[2]
+            res = []
+            cont = tuple(o for o in options if len(o) > pos and o[pos] == ch)
+            if cont:
+                res.append(rest + (("L", cont, pos + 1),))
+            if any(len(o) == pos for o in options):
+                res += self._feed(rest, ch)
+            return res
+
+        if kind == "O":
+            node, seen, first = top[1], top[2], top[3]
+            props, required, extra = self._object_fields(node)
+            if ch in WHITESPACE:
+                return [stack]
+            if ch == '"' and (extra is not None or len(seen) < len(props)):
+                return [rest + (("K", node, seen, ""),)]
+            if ch == "}" and first and required.issubset(seen):
+                return [rest]
+            return []
+        if kind == "K":
+            node, seen, partial = top[1], top[2], top[3]
+            props, required, extra = self._object_fields(node)
+            if not props:
+                ## Free keys: any string, the value schema does not depend on the key.
+                if ch == '"':
+                    return [rest + (("C", node, seen, None),)]
+                if ch == "\\" or ord(ch) < 0x20:
+                    return []
+                return [stack]
+            if ch == '"':
+                return [rest + (("C", node, seen, partial),)] if any(name == partial and name not in seen for name, _ in props) else []
+            partial += ch
+            return [rest + (("K", node, seen, partial),)] if any(name.startswith(partial) and name not in seen for name, _ in props) else []
+        if kind == "C":
+            node, seen, key = top[1], top[2], top[3]
+            if ch in WHITESPACE:
+                return [stack]
+            if ch != ":":
+                return []
+            props, required, extra = self._object_fields(node)
+            value = dict(props).get(key, extra) if key is not None else extra
+            seen = tuple(sorted(seen + (key,))) if key is not None else seen
+            return [rest + (("A", node, seen), ("V", value))]
+        if kind == "A":
+            node, seen = top[1], top[2]
+            props, required, extra = self._object_fields(node)
+            if ch in WHITESPACE:
+                return [stack]
+            if ch == "," and (extra is not None or len(seen) < len(props)):
+                return [rest + (("O", node, seen, False),)]
+            if ch == "}" and required.issubset(seen):
+                return [rest]
+            return []
+
+        if kind == "R":
+            node, count, first = top[1], top[2], top[3]
+            item, min_items, max_items = self._array_item(node, count)
+            if ch in WHITESPACE:
+                return [stack]
+            if ch == "]" and first and min_items == 0:
+                return [rest]
+            if item is None or (max_items is not None and count >= max_items):
+                return []
+            return self._start_value(rest + (("RA", node, count + 1),), item, ch)
+        if kind == "RA":
+            node, count = top[1], top[2]
+            item, min_items, max_items = self._array_item(node, count)
+            if ch in WHITESPACE:
+                return [stack]
+            if ch == "," and item is not None and (max_items is None or count < max_items):
+                return [rest + (("R", node, count, False),)]
+            if ch == "]" and count >= min_items:
+                return [rest]
+            return []
+        return []
+
+    def step(self, state:frozenset, ch:str)->frozenset:
+        """
+        Advance a state by one character.
+        Returns:
+            frozenset: The new state (empty if the character is not allowed).
+        """
+        key = (state, ch)
+        res = self.step_cache.get(key, None)
+        if res is not None:
+            return res
+
+        out = set()
+        space = ch in WHITESPACE
+        for stack, ws in state:
+            for nxt in self._feed(stack, ch):
+                count = ws + 1 if space and nxt[-1][0] not in _STRING_FRAMES else 0
+                if count <= self.max_whitespace:
+                    out.add((nxt, count))
+        res = frozenset(out)
+
+        if len(self.step_cache) > 500000:
+            self.step_cache.clear()
+        self.step_cache[key] = res
+        return res
+
+    def feed(self, state:frozenset, text:str)->frozenset:
+        """
+        Advance a state by some text.
+        Returns:
+            frozenset: The new state (empty if the text is not allowed).
+        """
+        for ch in text:
+            if not state:
+                break
+            state = self.step(state, ch)
+        return state
+
+    def is_complete(self, state:frozenset)->bool:
+        """
+        Check if the state is a complete document that cannot be continued.
+        """
+        return bool(state) and all(stack == _DONE for stack, _ in state)
+
+    def can_end(self, state:frozenset)->bool:
+        """
+        Check if the document may end in this state (complete, or ending with a complete number or literal).
+        """
+        return any(self._can_end(stack) for stack, _ in state)
+
+    def _can_end(self, stack:tuple)->bool:
+        if stack == _DONE:
+            return True
+        top = stack[-1]
+        if top[0] == "N" and top[2] in _NUMBER_TERMINAL:
+            return self._can_end(stack[:-1])
+        if top[0] == "L" and any(len(o) == top[2] for o in top[1]):
+            return self._can_end(stack[:-1])
+        return False
+
+    def in_plain_string(self, state:frozenset)->bool:
+        """
+        Check if every stack is inside a string without a length limit (any character but quote, backslash and control characters keeps the state).
+        """
+        return bool(state) and all(stack[-1][0] == "S" and stack[-1][1] is None for stack, _ in state)
+
+
+class TokenTable(object):
+    """
+    Text of every token of a tokenizer arranged in a character trie, for computing which tokens a grammar state allows.
+
+    Methods:
+        allowed: Get the mask of tokens allowed in a grammar state.
+    """
+    def __init__(self, tokenizer, vocab_size:int=None):
+        """
+        Parameters:
+            tokenizer: The tokenizer (from Transformers library).
+            vocab_size (int): Size of the model output (can be larger than the tokenizer vocabulary). Default=None (the tokenizer size)
+        """
+        self.vocab_size = max(vocab_size or 0, len(tokenizer))
+        self.texts = self._token_texts(tokenizer)
+
+        ## Tokens that may appear anywhere inside a string get one precomputed mask; only the rest are walked in strings.
+        self.string_safe = torch.zeros(self.vocab_size, dtype=torch.bool)
+        unsafe = {}
+        for token_id, text in self.texts.items():
+            if all(ch not in '"\\' and ord(ch) >= 0x20 for ch in text):
+                self.string_safe[token_id] = True
+            else:
+                unsafe[token_id] = text
+        self.trie = self._build(self.texts)
+        self.unsafe_trie = self._build(unsafe)
+
+    def _token_texts(self, tokenizer)->dict:
+        """
+        Get the text each token adds when it follows other text (special tokens and partial characters are left out).
+        """
+        special = set(tokenizer.all_special_ids)
+        ids = [i for i in range(len(tokenizer)) if i not in special]
+        ## Decoding after a reference token keeps leading spaces that some tokenizers drop at the start of a text.
+        ref = tokenizer.encode("a", add_special_tokens=False)[:1]
+        ref_text = tokenizer.decode(ref)
+        decoded = tokenizer.batch_decode([ref + [i] for i in ids], clean_up_tokenization_spaces=False)
+        texts = {}
+        for token_id, text in zip(ids, decoded):
+            if text.startswith(ref_text):
+                text = text[len(ref_text):]
+            if text and "�" not in text:
+                texts[token_id] = text
+        return texts
+
+    def _build(self, texts:dict)->tuple:
+        children = [{}]
+        ids = {}
+        for token_id, text in texts.items():
+            node = 0
+            for ch in text:
+                nxt = children[node].get(ch, None)
+                if nxt is None:
+                    nxt = len(children)
+                    children.append({})
+                    children[node][ch] = nxt
+                node = nxt
+            ids.setdefault(node, []).append(token_id)
+        return children, ids
+
+    def _walk(self, grammar:JsonSchemaGrammar, trie:tuple, state:frozenset, mask:torch.Tensor):
+        children, ids = trie
+        pending = [(0, state)]
+        while pending:
+            node, st = pending.pop()
+            for ch, child in children[node].items():
+                nst = grammar.step(st, ch)
+                if not nst:
+                    continue
+                for token_id in ids.get(child, ()):
+                    mask[token_id] = True
+                if children[child]:
+                    pending.append((child, nst))
+
+    def allowed(self, grammar:JsonSchemaGrammar, state:frozenset)->torch.Tensor:
+        """
+        Get the tokens whose text can follow in a grammar state (cached per state on the grammar).
+        Returns:
+            torch.Tensor: Boolean mask over the vocabulary.
+        """
+        mask = grammar.mask_cache.get(state, None)
+        if mask is not None:
+            return mask
+
+        if grammar.in_plain_string(state):
+            mask = self.string_safe.clone()
+            self._walk(grammar, self.unsafe_trie, state, mask)
+        else:
+            mask = torch.zeros(self.vocab_size, dtype=torch.bool)
+            self._walk(grammar, self.trie, state, mask)
+
+        with grammar.lock:
+            grammar.mask_cache[state] = mask
+            while len(grammar.mask_cache) > 256:
+                grammar.mask_cache.popitem(last=False)
+        return mask
@@ -0,0 +1,215 @@
+import collections
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+import numpy as np
+
+## Bytes requested to read the header of a .npy file (np.save writes headers far shorter than this).
+HEADER_BYTES = 4096
+
+
+class LogitsFileStore(object):
+    """
+    Stores per-request score arrays as .npy files so they can be served in binary form instead of inline JSON.
+
+    Files are kept within a count, a byte budget and a time to live, the oldest are deleted first. All files are
+    deleted on clear (when the model is unloaded) and once the store itself is garbage collected.
+
+    Methods:
+        save: Save an array and return its id.
+        path: Get the file path for an id (served with HTTP Range support, see step_byte_range for step ranges).
+        delete: Delete the array for an id.
+        clear: Delete all arrays.
+        info: Get the number of files and bytes stored.
+    """
+    ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+    def __init__(self, directory:str=None, max_files:int=1000, max_bytes:int=1 << 30, ttl:float=3600):
+        """
+        Parameters:
+            directory (str): Directory to write the .npy files to. Default=None (a new temporary directory)
+            max_files (int): Maximum number of arrays to keep. Default=1000
+            max_bytes (int): Maximum size of all kept files. Default=1GB (None for no limit)
+            ttl (float): Seconds a file is kept after it is saved. Default=3600 (None to keep files until they are evicted)
+        """
+        self.directory = directory
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        ## Saved arrays in order of saving: {id: (bytes, time saved)}
+        self.ids = collections.OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.finalizer = None
+
+    def save(self, array:np.ndarray)->str:
+        """
+        Save an array as a .npy file.
+        Parameters:
+            array (np.ndarray): The array to save (first dimension is the decode step).
+        Returns:
+            str: The id to retrieve the array with.
+        """
+        array_id = uuid.uuid4().hex
+        with self.lock:
+            ## The directory is only created once something is actually stored, a temporary one is removed with the store.
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix="llm_logits_")
+                self.finalizer = weakref.finalize(self, shutil.rmtree, self.directory, True)
+            os.makedirs(self.directory, exist_ok=True)
+            if self.finalizer is None:
+                self.finalizer = weakref.finalize(self, _remove_files, self.directory, self.ids)
+        path = os.path.join(self.directory, f"{array_id}.npy")
+        np.save(path, array)
+
+        with self.lock:
+            nbytes = os.path.getsize(path)
+            self.ids[array_id] = (nbytes, time.time())
+            self.nbytes += nbytes
+            self._evict()
+        return array_id
+
+    def _evict(self):
+        """
+        Delete the oldest files while over the count or byte budget, and the files past their time to live (call with the lock held).
+        """
+        now = time.time()
+        while self.ids:
+            oldest, (nbytes, saved) = next(iter(self.ids.items()))
+            over = len(self.ids) > self.max_files or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+            if not over and (self.ttl is None or now - saved <= self.ttl):
+                break
+            self.ids.popitem(last=False)
+            self.nbytes -= nbytes
+            _remove_file(self.directory, oldest)
+
+    def path(self, array_id:str)->str:
+        """
+        Get the path of the .npy file for an id.
+        Returns:
+            str: The file path, or None if the id is unknown or expired.
+        """
+        if self.directory is None or not self.ID_PATTERN.match(array_id):
+            return None
+        with self.lock:
+            self._evict()
+        path = os.path.join(self.directory, f"{array_id}.npy")
+        return path if os.path.exists(path) else None
+
+    def delete(self, array_id:str)->bool:
+        """
+        Delete the array for an id.
+        Returns:
+            bool: True if the array existed.
+        """
+        if self.directory is None or not self.ID_PATTERN.match(array_id):
+            return False
+        with self.lock:
+            nbytes, _ = self.ids.pop(array_id, (0, None))
+            self.nbytes -= nbytes
+        return _remove_file(self.directory, array_id)
+
+    def clear(self):
+        """
+        Delete all stored arrays.
+        """
+        with self.lock:
+            if self.directory is not None:
+                _remove_files(self.directory, self.ids)
+            self.ids.clear()
+            self.nbytes = 0
+
+    def info(self)->dict:
+        with self.lock:
+            return {"files": len(self.ids), "bytes": self.nbytes, "max_files": self.max_files, "max_bytes": self.max_bytes, "ttl": self.ttl}
+
+
+def _remove_file(directory:str, array_id:str)->bool:
+    path = os.path.join(directory, f"{array_id}.npy")
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _remove_files(directory:str, ids:dict):
+    ## Also used as the finalizer of a store, so it only gets the directory and the ids (not the store).
+    for array_id in list(ids):
+        _remove_file(directory, array_id)
+
+
+def npy_header(data:bytes)->dict:
+    """
+    Parse the header at the start of a .npy file.
+    Parameters:
+        data (bytes): The first bytes of the file (at least the whole header).
+    Returns:
+        dict: shape, dtype, fortran_order and offset (the byte where the array data starts).
+    """
+    f = io.BytesIO(data)
+    version = np.lib.format.read_magic(f)
+    read = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+    shape, fortran_order, dtype = read(f)
+    return {"shape": shape, "dtype": dtype, "fortran_order": fortran_order, "offset": f.tell()}
+
+
+def step_byte_range(header:dict, start:int=None, stop:int=None)->tuple:
+    """
+    Get the bytes of a range of decode steps (the first dimension) in a .npy file, for an HTTP Range request.
+    Parameters:
+        header (dict): The header of the file (see npy_header).
+        start (int): First step. Default=None (from the first step)
+        stop (int): Step to stop before. Default=None (to the last step)
+    Returns:
+        tuple: The first and last byte (inclusive, both None if no bytes are selected) and the shape of the selected steps.
+    """
+    if header["fortran_order"] or not header["shape"]:
+        raise ValueError("Step ranges need a C-ordered array with at least one dimension")
+    first, last, _ = slice(start, stop).indices(header["shape"][0])
+    last = max(first, last)
+    shape = (last - first,) + tuple(header["shape"][1:])
+    step_bytes = header["dtype"].itemsize * int(np.prod(header["shape"][1:]))
+    if last == first or step_bytes == 0:
+        return None, None, shape
+    return header["offset"] + first * step_bytes, header["offset"] + last * step_bytes - 1, shape
+
+
+def header_bytes(shape:tuple, dtype:np.dtype)->bytes:
+    """
+    Get the .npy header for a C-ordered array of a shape and dtype (written before the data of a step range).
+    """
+    f = io.BytesIO()
+    np.lib.format.write_array_header_1_0(f, {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": tuple(shape)})
+    return f.getvalue()
+
+
+def open_npy(path:str, remove:bool=False)->np.ndarray:
+    """
+    Open a downloaded .npy file as a memory-mapped array.
+    Parameters:
+        path (str): The file.
+        remove (bool): Remove the file once it is mapped (the mapping keeps the data readable). Default=False
+    Returns:
+        np.ndarray: The memory-mapped array (a regular array if it is empty, or if the file could not be removed while mapped).
+    """
+    with open(path, "rb") as f:
+        header = npy_header(f.read(HEADER_BYTES))
+    if 0 in header["shape"]:
+        array = np.load(path)
+    else:
+        array = np.load(path, mmap_mode="r")
+    if remove:
+        try:
+            os.remove(path)
+        except OSError:
+            ## Some platforms do not delete files that are mapped, so the data is read into memory first.
+            array = np.array(array)
+            os.remove(path)
+    return array
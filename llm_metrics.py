@@ -0,0 +1,192 @@
+import bisect
+import contextlib
+import threading
+import time
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (1, 4, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class _Histogram(object):
+    """
+    Cumulative bucket counts, sum and count of observed values for one label set.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value:float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """
+    Counters, gauges and histograms labelled by model name, rendered in the Prometheus text format for /metrics.
+    Request stages timed into llm_stage_seconds are queue_wait, tokenize, prefill, decode, detokenize and serialize.
+
+    Methods:
+        inc: Increment a counter.
+        add: Add to a gauge (negative values decrement it).
+        observe: Record a value in a histogram.
+        observe_stage: Record the time of a request stage.
+        stage: Time a block of code into the per-stage histogram.
+        collect_stages: Collect the stage times recorded on the current thread.
+        track: Count, time and track errors of a request.
+        render: Render all metrics in the Prometheus text format.
+        snapshot: Get all metrics as a dictionary.
+    """
+    DEFINITIONS = {
+        "llm_requests_total": ("counter", "Requests handled.", None),
+        "llm_request_errors_total": ("counter", "Requests that raised an error.", None),
+        "llm_requests_in_flight": ("gauge", "Requests currently being handled.", None),
+        "llm_request_seconds": ("histogram", "End to end request time in the server.", SECONDS_BUCKETS),
+        "llm_stage_seconds": ("histogram", "Time spent in each stage of a request.", SECONDS_BUCKETS),
+        "llm_prompt_tokens": ("histogram", "Prompt tokens per generate call.", TOKEN_BUCKETS),
+        "llm_generated_tokens": ("histogram", "Generated tokens per generate call.", TOKEN_BUCKETS),
+        "llm_prompt_tokens_total": ("counter", "Prompt tokens processed.", None),
+        "llm_generated_tokens_total": ("counter", "Tokens generated.", None),
+        "llm_tokens_per_second": ("histogram", "Generated tokens per second of a generate call.", RATE_BUCKETS),
+        "llm_session_hits_total": ("counter", "Session requests that reused the cached conversation.", None),
+        "llm_session_misses_total": ("counter", "Session requests that prefilled the whole prompt.", None),
+        "llm_session_reused_tokens_total": ("counter", "Prompt tokens served from session caches instead of prefill.", None),
+        "llm_session_evictions_total": ("counter", "Sessions evicted to stay within the memory budget.", None),
+        "llm_session_expirations_total": ("counter", "Sessions dropped after the idle timeout.", None),
+    }
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _key(self, name:str, labels:dict):
+        if name not in self.DEFINITIONS:
+            raise KeyError(f"Unknown metric: {name}")
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name:str, value:float=1, **labels):
+        """
+        Increment a counter, e.g. metrics.inc("llm_requests_total", model="sqlcoder").
+        """
+        key = self._key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def add(self, name:str, value:float, **labels):
+        """
+        Add to a gauge.
+        """
+        self.inc(name, value, **labels)
+
+    def observe(self, name:str, value:float, **labels):
+        """
+        Record a value in a histogram, e.g. metrics.observe("llm_stage_seconds", 0.01, model="sqlcoder", stage="prefill").
+        """
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.values.get(key, None)
+            if histogram is None:
+                histogram = self.values[key] = _Histogram(self.DEFINITIONS[name][2])
+            histogram.observe(value)
+
+    def observe_stage(self, model:str, stage:str, seconds:float):
+        """
+        Record the time of a request stage in llm_stage_seconds (and in the stages collected on the current thread).
+        """
+        self.observe("llm_stage_seconds", seconds, model=model, stage=stage)
+        stages = getattr(self.local, "stages", None)
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def stage(self, model:str, stage:str):
+        """
+        Time the enclosed block into llm_stage_seconds for a model and stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(model, stage, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def collect_stages(self):
+        """
+        Collect the stage times recorded on the current thread while the block runs.
+        Returns:
+            dict: Seconds per stage, filled in as the block runs.
+        """
+        outer = getattr(self.local, "stages", None)
+        stages = {}
+        self.local.stages = stages
+        try:
+            yield stages
+        finally:
+            self.local.stages = outer
+
+    @contextlib.contextmanager
+    def track(self, model:str):
+        """
+        Track a request for a model: counts it, keeps it in the in-flight gauge while the block runs, times it and counts errors.
+        """
+        self.inc("llm_requests_total", model=model)
+        self.add("llm_requests_in_flight", 1, model=model)
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc("llm_request_errors_total", model=model)
+            raise
+        finally:
+            self.add("llm_requests_in_flight", -1, model=model)
+            self.observe("llm_request_seconds", time.perf_counter() - start, model=model)
+
+    def render(self)->str:
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            items = sorted(self.values.items(), key=lambda item: item[0])
+            lines = []
+            current = None
+            for (name, labels), value in items:
+                kind, text, buckets = self.DEFINITIONS[name]
+                if name != current:
+                    lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+                    current = name
+                if kind != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ["+Inf"], value.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {value.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self)->dict:
+        """
+        Get all metrics as {name: [{labels, value}]}, with histograms as count, sum and mean.
+        """
+        with self.lock:
+            res = {}
+            for (name, labels), value in sorted(self.values.items(), key=lambda item: item[0]):
+                if isinstance(value, _Histogram):
+                    value = {"count": value.count, "sum": value.sum, "mean": value.sum / value.count if value.count else None}
+                res.setdefault(name, []).append({"labels": dict(labels), "value": value})
+        return res
+
+
+def _labels(labels:tuple)->str:
+    if not labels:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for k, v in labels]
+    return "{" + ",".join(f"{k}=\"{v}\"" for k, v in escaped) + "}"
+
+
+## Metrics shared by all wrappers and servers in the process.
+metrics = Metrics()
@@ -0,0 +1,173 @@
+import collections
+import contextlib
+import heapq
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+import torch
+import llm_metrics
+
+
+class _RequestRecord(object):
+    """
+    Timing of a single request: its generation kwargs, stage timings and the id of its profiler trace (if profiled).
+    """
+    def __init__(self, process_logits, profile):
+        self.process_logits = process_logits
+        self.profile = profile
+        self.kwargs = {}
+        self.stages = {}
+        self.trace_id = None
+        self.top_ops = None
+        self.start = time.perf_counter()
+        self.seconds = None
+
+    def summary(self)->dict:
+        return {
+            "seconds": self.seconds,
+            "time": time.time() - (time.perf_counter() - self.start),
+            "process_logits": self.process_logits,
+            "kwargs": self.kwargs,
+            "stages": self.stages,
+            "trace_id": self.trace_id,
+        }
+
+
+class Profiler(object):
+    """
+    Per-wrapper request profiling.
+
+    Every request is timed and the slowest ones are kept with their generation kwargs and stage timings (always on, only a
+    few timers per request). A request can also ask for its generate call to run under the torch profiler, in which
+    case a Chrome trace is written and can be downloaded by id.
+
+    Methods:
+        record: Time a request (and profile its generate call if requested).
+        generate: Run a generate call under the torch profiler if the current request asked for it.
+        trace_path: Get the trace file for an id.
+        slowest: Get the slowest requests.
+        info: Get the profiler settings and trace ids.
+    """
+    ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+    def __init__(self, slowest:int=10, directory:str=None, max_traces:int=20, admin_token_env:str="LLM_ADMIN_TOKEN"):
+        """
+        Parameters:
+            slowest (int): Number of slowest requests to keep. Default=10
+            directory (str): Directory to write traces to. Default=None (a new temporary directory)
+            max_traces (int): Maximum number of traces to keep, the oldest are deleted first. Default=20
+            admin_token_env (str): Environment variable with the token that on-demand profiling requires. Default=LLM_ADMIN_TOKEN (profiling is disabled if it is not set)
+        """
+        self.max_slowest = slowest
+        self.directory = directory
+        self.max_traces = max_traces
+        self.admin_token = os.environ.get(admin_token_env, None) or None
+        self.slow = []
+        self.traces = collections.OrderedDict()
+        self.counter = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def record(self, process_logits:bool=False, profile:bool=False):
+        """
+        Time a request on the current thread. Nested calls (e.g. a batch running single requests) belong to the outer request.
+        Parameters:
+            process_logits (bool): Whether the request processes logits.
+            profile (bool): Run the generate call of the request under the torch profiler.
+        Returns:
+            _RequestRecord: The record of the request; set its kwargs once they are known.
+        """
+        outer = getattr(self.local, "record", None)
+        if outer is not None:
+            yield outer
+            return
+
+        record = _RequestRecord(process_logits, profile)
+        self.local.record = record
+        try:
+            with llm_metrics.metrics.collect_stages() as stages:
+                yield record
+        finally:
+            self.local.record = None
+            record.seconds = time.perf_counter() - record.start
+            record.stages = dict(stages)
+            self._keep(record)
+
+    def _keep(self, record:_RequestRecord):
+        with self.lock:
+            self.counter += 1
+            entry = (record.seconds, self.counter, record.summary())
+            if len(self.slow) < self.max_slowest:
+                heapq.heappush(self.slow, entry)
+            elif self.slow and entry[0] > self.slow[0][0]:
+                heapq.heapreplace(self.slow, entry)
+
+    @contextlib.contextmanager
+    def generate(self):
+        """
+        Run the enclosed generate call under the torch profiler if the current request asked for profiling.
+        The trace is written once per request (the first generate call).
+        """
+        record = getattr(self.local, "record", None)
+        if record is None or not record.profile or record.trace_id is not None:
+            yield
+            return
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True) as prof:
+            yield
+
+        record.trace_id = self._save(prof)
+        record.top_ops = [
+            {"name": event.key, "calls": event.count, "self_cpu_ms": event.self_cpu_time_total / 1000.0, "cpu_ms": event.cpu_time_total / 1000.0}
+            for event in sorted(prof.key_averages(), key=lambda event: event.self_cpu_time_total, reverse=True)[:10]
+        ]
+
+    def _save(self, prof)->str:
+        trace_id = uuid.uuid4().hex
+        with self.lock:
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix="llm_traces_")
+            os.makedirs(self.directory, exist_ok=True)
+        prof.export_chrome_trace(os.path.join(self.directory, f"{trace_id}.json"))
+
+        with self.lock:
+            self.traces[trace_id] = time.time()
+            while len(self.traces) > self.max_traces:
+                oldest, _ = self.traces.popitem(last=False)
+                path = self.trace_path(oldest)
+                if path is not None:
+                    os.remove(path)
+        return trace_id
+
+    def trace_path(self, trace_id:str)->str:
+        """
+        Get the path of the Chrome trace file for an id.
+        Returns:
+            str: The file path, or None if the id is unknown.
+        """
+        if self.directory is None or not self.ID_PATTERN.match(trace_id):
+            return None
+        path = os.path.join(self.directory, f"{trace_id}.json")
+        return path if os.path.exists(path) else None
+
+    def slowest(self)->list[dict]:
+        """
+        Get the slowest requests, slowest first.
+        """
+        with self.lock:
+            return [summary for _, _, summary in sorted(self.slow, key=lambda entry: entry[0], reverse=True)]
+
+    def info(self)->dict:
+        with self.lock:
+            return {
+                "profiling_enabled": self.admin_token is not None,
+                "requests": self.counter,
+                "traces": list(self.traces.keys()),
+            }
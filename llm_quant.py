@@ -0,0 +1,161 @@
+import time
+import torch
+
+
+DTYPES = ("int8", "bfloat16")
+
+
+def state_nbytes(model)->int:
+    """
+    Get the memory used by a model's weights: parameters, buffers and the packed weights of dynamically quantized layers
+    (torch.ao), which are neither parameters nor buffers and only show up in the state dict. Tensors that share storage
+    (tied weights) count once.
+    """
+    def tensors(value):
+        if isinstance(value, torch.Tensor):
+            return [value]
+        if isinstance(value, (tuple, list)):
+            return [t for v in value for t in tensors(v)]
+        return []
+
+    values = list(model.parameters()) + list(model.buffers()) + list(model.state_dict(keep_vars=True).values())
+    storages = {}
+    for t in (t for value in values for t in tensors(value)):
+        if t.numel() == 0:
+            continue
+        try:
+            storage = t.untyped_storage()
+            key, nbytes = storage.data_ptr(), storage.nbytes()
+        except (RuntimeError, NotImplementedError):
+            ## Quantized tensors may not expose their storage.
+            key, nbytes = t.data_ptr(), t.numel() * t.element_size()
+        storages[key] = max(storages.get(key, 0), nbytes)
+    return sum(storages.values())
+
+
+def set_threads(threads:int=None, interop_threads:int=None):
+    """
+    Set the number of intra-op (and optionally inter-op) threads torch uses on CPU.
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            ## The inter-op pool can only be sized before any parallel work has run.
+            print(f"Could not set inter-op threads: {e}")
+
+
+def quantize_model(model, dtype:str):
+    """
+    Convert a model for CPU inference.
+    Parameters:
+        model: The language model (from Transformers library).
+        dtype (str): "int8" (dynamic quantization of the linear layers) or "bfloat16".
+    Returns:
+        The converted model (converted in place, so the full precision weights are released).
+    """
+    if dtype == "int8":
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    if dtype == "bfloat16":
+        return model.to(torch.bfloat16)
+    raise ValueError(f"Unsupported CPU inference dtype: {dtype} (expected one of {DTYPES})")
+
+
+def time_generate(model, input_ids, max_new_tokens:int=16)->float:
+    """
+    Time a greedy generation of exactly max_new_tokens tokens after one untimed pass.
+    Returns:
+        float: Seconds taken by the timed generation.
+    """
+    kwargs = {"max_new_tokens": max_new_tokens, "min_new_tokens": max_new_tokens, "do_sample": False}
+    with torch.no_grad():
+        model.generate(input_ids, max_new_tokens=2, do_sample=False)
+        start = time.perf_counter()
+        model.generate(input_ids, **kwargs)
+        return time.perf_counter() - start
+
+
+def greedy_outputs(model, tokenizer, prompts:list[str], max_new_tokens:int=64)->list[list[int]]:
+    """
+    Generate greedily for each prompt.
+    Returns:
+        list[list[int]]: The generated token ids for each prompt (the prompt is not included).
+    """
+    outputs = []
+    with torch.no_grad():
+        for prompt in prompts:
+            input_ids = tokenizer.encode(prompt, return_tensors="pt").to(model.device)
+            res = model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False)
+            outputs.append(res[0, input_ids.shape[1]:].tolist())
+    return outputs
+
+
+def compare_outputs(reference:list[list[int]], candidate:list[list[int]])->dict:
+    """
+    Compare greedy outputs of a converted model against the full precision model.
+    Returns:
+        dict: exact_match (fraction of prompts with identical output), prefix_agreement (mean fraction of reference
+        tokens reproduced before the first difference) and the index of each mismatching prompt.
+    """
+    agreements = []
+    mismatches = []
+    for i, (ref, cand) in enumerate(zip(reference, candidate)):
+        n = 0
+        while n < min(len(ref), len(cand)) and ref[n] == cand[n]:
+            n += 1
+        agreements.append(n / len(ref) if ref else 1.0)
+        if ref != cand:
+            mismatches.append(i)
+    return {
+        "exact_match": 1.0 - len(mismatches) / len(reference) if reference else 1.0,
+        "prefix_agreement": sum(agreements) / len(agreements) if agreements else 1.0,
+        "mismatches": mismatches,
+    }
+
+
+def prepare_cpu_model(model, tokenizer, options:dict):
+    """
+    Apply the CPU inference options from a wrapper config, e.g. {"dtype": "int8", "threads": 8, "interop_threads": 1}.
+    Unless "benchmark" is False, a short greedy generation is timed before and after the conversion.
+    Parameters:
+        model: The language model (from Transformers library).
+        tokenizer: The tokenizer for the language model.
+        options (dict): dtype, threads, interop_threads, benchmark, benchmark_prompt and benchmark_tokens.
+    Returns:
+        tuple: The converted model and a report of the memory saving and speedup.
+    """
+    set_threads(options.get("threads", None), options.get("interop_threads", None))
+
+    dtype = options.get("dtype", None)
+    benchmark = options.get("benchmark", True) and dtype is not None
+    input_ids = tokenizer.encode(options.get("benchmark_prompt", "SELECT name FROM products WHERE"), return_tensors="pt") if benchmark else None
+    max_new_tokens = options.get("benchmark_tokens", 16)
+
+    report = {"dtype": dtype, "threads": torch.get_num_threads(), "interop_threads": torch.get_num_interop_threads()}
+    report["bytes_before"] = state_nbytes(model)
+    seconds_before = time_generate(model, input_ids, max_new_tokens) if benchmark else None
+
+    if dtype is not None:
+        model = quantize_model(model, dtype)
+
+    report["bytes_after"] = state_nbytes(model)
+    report["memory_saving"] = 1.0 - report["bytes_after"] / report["bytes_before"] if report["bytes_before"] else 0.0
+    if benchmark:
+        seconds_after = time_generate(model, input_ids, max_new_tokens)
+        report["seconds_before"] = seconds_before
+        report["seconds_after"] = seconds_after
+        report["speedup"] = seconds_before / seconds_after if seconds_after > 0 else None
+    return model, report
+
+
+def format_report(name:str, report:dict)->str:
+    """
+    Format a prepare_cpu_model report for printing at startup.
+    """
+    text = f"CPU inference for {name}: dtype={report['dtype']} threads={report['threads']}"
+    text += f", weights {report['bytes_before'] / 2**20:.1f}MB -> {report['bytes_after'] / 2**20:.1f}MB ({report['memory_saving']:.0%} saved)"
+    if report.get("speedup", None) is not None:
+        text += f", decode {report['seconds_before']:.3f}s -> {report['seconds_after']:.3f}s ({report['speedup']:.2f}x)"
+    return text
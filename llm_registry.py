@@ -0,0 +1,171 @@
+import collections
+import gc
+import threading
+import time
+from typing import Callable
+import llm_quant
+
+
+class _ModelEntry(object):
+    """
+    A registered model: its loader and, once loaded, the wrapper instance.
+    """
+    def __init__(self, name, loader, wrapper=None):
+        self.name = name
+        self.loader = loader
+        self.wrapper = wrapper
+        self.nbytes = llm_quant.state_nbytes(wrapper.model) if wrapper is not None else 0
+        self.last_used = time.time() if wrapper is not None else None
+        self.lock = threading.Lock()
+
+
+class ModelRegistry(object):
+    """
+    Registry of wrapped language models hosted by one server.
+
+    Models are registered with a loader and loaded lazily on first use. When the resident memory of the loaded
+    models exceeds the memory budget, the least recently used models are unloaded (they are loaded again on their
+    next use). Models added as already loaded wrappers without a loader are never unloaded.
+
+    Methods:
+        register: Register a model by name with a loader.
+        add: Add an already loaded wrapper.
+        get: Get a wrapper by name, loading it if needed.
+        peek: Get a wrapper by name only if it is loaded.
+        unload: Unload a model.
+        info: List registered and loaded models with their resident memory.
+    """
+    def __init__(self, max_bytes:int=None):
+        """
+        Parameters:
+            max_bytes (int): Memory budget for all loaded models. Default=None (no limit)
+        """
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.default = None
+        self.lock = threading.Lock()
+
+    def __contains__(self, name:str)->bool:
+        return name in self.entries
+
+    def register(self, name:str, loader:Callable, default:bool=False):
+        """
+        Register a model with a loader that is called the first time the model is used.
+        Parameters:
+            name (str): The name requests use to select the model.
+            loader (Callable): Function with no arguments that returns the Wrapper for the model.
+            default (bool): Use this model for requests that do not name a model. Default=False (the first registered model is the default)
+        """
+        with self.lock:
+            self.entries[name] = _ModelEntry(name, loader)
+            if default or self.default is None:
+                self.default = name
+
+    def add(self, wrapper, default:bool=False):
+        """
+        Add an already loaded wrapper under its name.
+        """
+        with self.lock:
+            self.entries[wrapper.name] = _ModelEntry(wrapper.name, None, wrapper)
+            if default or self.default is None:
+                self.default = wrapper.name
+        self.evict(keep=wrapper.name)
+
+    def get(self, name:str=None):
+        """
+        Get the wrapper for a model, loading it on first use.
+        Parameters:
+            name (str): The model name. Default=None (the default model)
+        Returns:
+            Wrapper: The loaded wrapper, or None if no such model is registered.
+        """
+        name = name or self.default
+        entry = self.entries.get(name, None) if name is not None else None
+        if entry is None:
+            return None
+
+        ## Loading happens outside the registry lock so other models keep serving while a model loads.
+        with entry.lock:
+            if entry.wrapper is None:
+                print(f"Loading model: {name}")
+                entry.wrapper = entry.loader()
+                entry.nbytes = llm_quant.state_nbytes(entry.wrapper.model)
+            wrapper = entry.wrapper
+            entry.last_used = time.time()
+
+        with self.lock:
+            self.entries.move_to_end(name)
+        self.evict(keep=name)
+        return wrapper
+
+    def peek(self, name:str=None):
+        """
+        Get the wrapper for a model only if it is already loaded (never triggers a load).
+        """
+        entry = self.entries.get(name or self.default, None)
+        return entry.wrapper if entry is not None else None
+
+    def unload(self, name:str)->bool:
+        """
+        Unload a model so its memory can be reclaimed. Requests already using it finish normally.
+        Returns:
+            bool: True if the model was loaded and could be unloaded.
+        """
+        entry = self.entries.get(name, None)
+        if entry is None or entry.loader is None:
+            return False
+
+        with entry.lock:
+            wrapper = entry.wrapper
+            if wrapper is None:
+                return False
+            entry.wrapper = None
+            entry.nbytes = 0
+
+        print(f"Unloading model: {name}")
+        scheduler = getattr(wrapper, "scheduler", None)
+        if scheduler is not None:
+            scheduler.stop()
+        ## Binary scores saved for the model can no longer be fetched once it is unloaded.
+        logits_files = getattr(wrapper, "logits_files", None)
+        if logits_files is not None:
+            logits_files.clear()
+        device = str(getattr(wrapper.model, "device", "cpu"))
+        del wrapper
+        gc.collect()
+        if device.startswith("cuda"):
+            import torch
+            torch.cuda.empty_cache()
+        return True
+
+    def resident_bytes(self)->int:
+        return sum(entry.nbytes for entry in self.entries.values() if entry.wrapper is not None)
+
+    def evict(self, keep:str=None):
+        """
+        Unload least recently used models until the loaded models fit the memory budget.
+        Parameters:
+            keep (str): A model that must stay loaded (the one just requested).
+        """
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            candidates = [name for name, entry in self.entries.items() if entry.wrapper is not None and entry.loader is not None and name != keep]
+        for name in candidates:
+            if self.resident_bytes() <= self.max_bytes:
+                break
+            self.unload(name)
+
+    def info(self)->dict:
+        """
+        Get the registered and loaded models with their resident memory.
+        """
+        with self.lock:
+            entries = list(self.entries.values())
+        return {
+            "default": self.default,
+            "registered": [entry.name for entry in entries],
+            "loaded": {entry.name: {"bytes": entry.nbytes, "last_used": entry.last_used} for entry in entries if entry.wrapper is not None},
+            "resident_bytes": self.resident_bytes(),
+            "max_bytes": self.max_bytes,
+        }
@@ -0,0 +1,134 @@
+import queue
+import threading
+import time
+from typing import Any, Callable
+
+
+class _PendingRequest(object):
+    """
+    A single request waiting in the batch scheduler queue.
+    """
+    def __init__(self, key, payload):
+        self.key = key
+        self.payload = payload
+        self.queued = time.perf_counter()
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SchedulerStopped(RuntimeError):
+    """
+    Raised by BatchScheduler.submit once the scheduler has been stopped (e.g. its model was unloaded).
+    """
+
+
+class BatchScheduler(object):
+    """
+    Dynamic request batching scheduler.
+
+    Requests submitted from concurrent callers are collected for a short window (up to max_wait_ms or until
+    max_batch_size requests are waiting) and then handed to a single batch function. Requests are only batched
+    together if they share the same key (e.g. the same generation settings).
+
+    Methods:
+        submit: Submit a request and block until its result is available (raises SchedulerStopped after stop).
+        stop: Stop the background worker thread.
+    """
+    def __init__(self, run_batch:Callable[[Any, list], list], max_batch_size:int=8, max_wait_ms:float=10, on_wait:Callable[[float], None]=None):
+        """
+        Parameters:
+            run_batch (Callable): Function called with (key, payloads) that returns one result per payload, in order.
+            max_batch_size (int): Maximum number of requests in a single batch. Default=8
+            max_wait_ms (float): Maximum time to wait for more requests after the first one arrives. Default=10
+            on_wait (Callable): Function called with the seconds each request waited in the queue before its batch started. Default=None
+        """
+        self.run_batch = run_batch
+        self.on_wait = on_wait
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.running = True
+        ## Guards running so no request is queued behind the stop marker, where it would never be processed.
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self.worker.start()
+
+    def submit(self, key, payload):
+        """
+        Submit a request to the scheduler and wait for the result.
+        Parameters:
+            key: Hashable key - only requests with the same key are batched together.
+            payload: The request payload passed on to the batch function.
+        Returns:
+            The result returned by the batch function for this payload.
+        """
+        pending = _PendingRequest(key, payload)
+        with self.lock:
+            if not self.running:
+                raise SchedulerStopped("Batch scheduler is stopped")
+            self.queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def stop(self):
+        """
+        Stop the background worker thread. Requests already queued are still processed, later submits raise SchedulerStopped.
+        """
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            self.queue.put(None)
+        self.worker.join()
+
+    def _collect(self)->list:
+        """
+        Block for the first request then gather more until the batch is full or the wait window closes.
+        """
+        first = self.queue.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                ## Put the stop marker back so the loop exits after this batch.
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _loop(self):
+        while self.running or not self.queue.empty():
+            batch = self._collect()
+
+            ## Group by key, keeping arrival order within each group.
+            groups = {}
+            for pending in batch:
+                groups.setdefault(pending.key, []).append(pending)
+
+            for key, group in groups.items():
+                if self.on_wait is not None:
+                    started = time.perf_counter()
+                    for pending in group:
+                        self.on_wait(started - pending.queued)
+                try:
+                    results = self.run_batch(key, [p.payload for p in group])
+                    for pending, result in zip(group, results):
+                        pending.result = result
+                except Exception as e:
+                    for pending in group:
+                        pending.error = e
+                finally:
+                    for pending in group:
+                        pending.done.set()
@@ -1,6 +1,22 @@
 import flask
 import abc
+import collections
+import contextlib
+import hmac
+import json
+import threading
+import time
+import numpy as np
+import torch
 import transformers
+import llm_cache
+import llm_json_schema
+import llm_logits
+import llm_metrics
+import llm_profiler
+import llm_quant
+import llm_registry
+import llm_scheduler
 
 class LogitStoreProcessor(transformers.LogitsProcessor):
     """
@@ -32,6 +48,392 @@ class LogitStoreProcessor(transformers.LogitsProcessor):
         self.scores.append(scores.tolist())
         return scores
 
+class TensorLogitStoreProcessor(transformers.LogitsProcessor):
+    """
+    A compact processor for capturing scores from language model predictions.
+
+    Scores are written into a tensor preallocated on the model device on the first decode step and only
+    transferred to the host once, when the result is requested. Capture can be restricted to the top-k scores
+    or to a fixed set of token ids, and is stored at reduced precision (float16 by default).
+
+    Attributes:
+        scores (torch.Tensor): Captured scores of shape (steps, batch, k).
+        ids (torch.Tensor): Token ids for the captured top-k scores of shape (steps, batch, k) (top-k mode only).
+        input_ids (torch.Tensor): The input ids at the last decode step.
+        step (int): Number of decode steps captured.
+    """
+    def __init__(self, max_steps:int, top_k:int=None, token_ids:list[int]=None, dtype:torch.dtype=torch.float16):
+        """
+        Parameters:
+            max_steps (int): Maximum number of decode steps to capture (normally max_new_tokens).
+            top_k (int): Capture only the top-k scores (and their token ids) at each step. Default=None (full vocabulary)
+            token_ids (list[int]): Capture only the scores of these token ids at each step. Default=None
+            dtype (torch.dtype): Storage precision for the captured scores. Default=torch.float16
+        """
+        self.max_steps = max_steps
+        self.top_k = top_k
+        self.token_ids = token_ids
+        self.dtype = dtype
+        self.clear()
+
+    def clear(self):
+        """
+        Clear the captured scores (buffers are reallocated on the next decode step).
+        """
+        self.scores = None
+        self.ids = None
+        self.input_ids = None
+        self.step = 0
+
+    def _allocate(self, scores):
+        batch, vocab = scores.shape
+        if self.token_ids is not None:
+            self._token_index = torch.tensor(self.token_ids, dtype=torch.long, device=scores.device)
+            width = len(self.token_ids)
+        elif self.top_k:
+            width = min(self.top_k, vocab)
+            self.ids = torch.empty((self.max_steps, batch, width), dtype=torch.int32, device=scores.device)
+        else:
+            width = vocab
+        self.scores = torch.empty((self.max_steps, batch, width), dtype=self.dtype, device=scores.device)
+
+    def __call__(self, input_ids, scores):
+        if self.scores is None:
+            self._allocate(scores)
+
+        if self.step < self.max_steps:
+            if self.token_ids is not None:
+                self.scores[self.step] = scores.index_select(-1, self._token_index)
+            elif self.top_k:
+                values, indices = scores.topk(self.scores.shape[-1], dim=-1)
+                self.scores[self.step] = values
+                self.ids[self.step] = indices
+            else:
+                self.scores[self.step] = scores
+            self.step += 1
+
+        self.input_ids = input_ids
+        return scores
+
+    def arrays(self)->dict:
+        """
+        Transfer the captured data to the host as numpy arrays (bfloat16 is widened to float32 as numpy has no bfloat16).
+        Returns:
+            dict: scores (steps x batch x k), score_ids (top-k ids, the selected token ids or None) and the final input_ids.
+        """
+        if self.scores is None:
+            return {"scores": None, "score_ids": None, "input_ids": None}
+
+        scores = self.scores[:self.step]
+        if scores.dtype == torch.bfloat16:
+            scores = scores.float()
+
+        if self.token_ids is not None:
+            score_ids = np.asarray(self.token_ids, dtype=np.int32)
+        elif self.ids is not None:
+            score_ids = self.ids[:self.step].cpu().numpy()
+        else:
+            score_ids = None
+
+        return {"scores": scores.cpu().numpy(), "score_ids": score_ids, "input_ids": self.input_ids.cpu().numpy()}
+
+    def result(self)->dict:
+        """
+        Transfer the captured data to the host.
+        Returns:
+            dict: scores (steps x batch x k), score_ids (top-k ids or the selected token ids) and the final input_ids.
+        """
+        if self.scores is None:
+            return {"logits": [], "scores": [], "score_ids": [], "input_ids": []}
+
+        if self.token_ids is not None:
+            score_ids = list(self.token_ids)
+        elif self.ids is not None:
+            score_ids = self.ids[:self.step].cpu().tolist()
+        else:
+            score_ids = []
+
+        return {
+            "logits": [],
+            "scores": self.scores[:self.step].float().cpu().tolist(),
+            "score_ids": score_ids,
+            "input_ids": self.input_ids.cpu().tolist(),
+        }
+
+
+class JsonSchemaLogitsProcessor(transformers.LogitsProcessor):
+    """
+    A processor that constrains generation to JSON matching a schema.
+
+    Tokens that cannot continue a valid document are masked out at every step, and once the document is complete only
+    the end of sequence token is allowed so generation stops as soon as the top-level value closes. Each row of the
+    batch is tracked separately (beam search, which reorders rows, is not supported).
+
+    Methods:
+        texts: Get the generated JSON text of each row.
+        values: Get the parsed JSON value of each row.
+    """
+    def __init__(self, grammar:llm_json_schema.JsonSchemaGrammar, table:llm_json_schema.TokenTable, eos_token_ids:list[int]):
+        """
+        Parameters:
+            grammar (llm_json_schema.JsonSchemaGrammar): The compiled schema.
+            table (llm_json_schema.TokenTable): The token texts of the tokenizer.
+            eos_token_ids (list[int]): The end of sequence token ids.
+        """
+        self.grammar = grammar
+        self.table = table
+        self.eos_token_ids = list(eos_token_ids)
+        self.states = None
+        self.generated = None
+        self.length = 0
+
+    def advance(self, input_ids):
+        """
+        Advance each row by the tokens chosen since the last call. Called at every step, and by JsonSchemaStoppingCriteria
+        once the token of the step is chosen, so the last token is fed too when generation stops (e.g. at max_new_tokens).
+        """
+        if self.states is None:
+            self.states = [self.grammar.initial] * input_ids.shape[0]
+            self.generated = [""] * input_ids.shape[0]
+            self.length = input_ids.shape[1]
+            return
+
+        for position in range(self.length, input_ids.shape[1]):
+            for row, token_id in enumerate(input_ids[:, position].tolist()):
+                if self.states[row] is None:
+                    continue
+                if token_id in self.eos_token_ids:
+                    self.states[row] = None
+                    continue
+                text = self.table.texts.get(token_id, "")
+                self.states[row] = self.grammar.feed(self.states[row], text)
+                self.generated[row] += text
+        self.length = input_ids.shape[1]
+
+    def __call__(self, input_ids, scores):
+        self.advance(input_ids)
+
+        mask = torch.zeros(scores.shape, dtype=torch.bool)
+        for row, state in enumerate(self.states):
+            if state is not None and state and not self.grammar.is_complete(state):
+                allowed = self.table.allowed(self.grammar, state)
+                n = min(allowed.shape[0], scores.shape[-1])
+                mask[row, :n] = allowed[:n]
+                if not self.grammar.can_end(state) and mask[row].any():
+                    continue
+            ## Complete (or stuck) rows may only end.
+            mask[row, self.eos_token_ids] = True
+
+        return scores.masked_fill(~mask.to(scores.device), -float("inf"))
+
+    def texts(self)->list[str]:
+        """
+        Get the generated JSON text of each row.
+        """
+        return list(self.generated or [])
+
+    def values(self)->list:
+        """
+        Get the parsed JSON value of each row (None where the text is not a complete document).
+        """
+        res = []
+        for text in self.texts():
+            try:
+                res.append(json.loads(text))
+            except json.JSONDecodeError:
+                res.append(None)
+        return res
+
+
+class JsonSchemaStoppingCriteria(transformers.StoppingCriteria):
+    """
+    Feeds a JsonSchemaLogitsProcessor the token chosen at each step. Logits processors only see a token at the next
+    step, so the last token would never reach the processor. Never stops generation itself.
+    """
+    def __init__(self, processor:JsonSchemaLogitsProcessor):
+        self.processor = processor
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.processor.advance(input_ids)
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+class TimingProcessor(transformers.LogitsProcessor):
+    """
+    Records when the first scores arrive (the end of prefill) and counts decode steps, without changing the scores.
+    """
+    def __init__(self):
+        self.first = None
+        self.steps = 0
+        self.prompt_tokens = 0
+        self.rows = 0
+
+    def __call__(self, input_ids, scores):
+        if self.first is None:
+            self.first = time.perf_counter()
+            self.prompt_tokens = input_ids.shape[-1]
+            self.rows = input_ids.shape[0]
+        self.steps += 1
+        return scores
+
+
+class StopSequenceCriteria(transformers.StoppingCriteria):
+    """
+    Stops each row once its generated text contains one of the stop sequences of the request. Also counts the tokens
+    generated for each row, so responses can report usage and why generation finished.
+
+    Methods:
+        trim: Cut a generated text at the first stop sequence.
+        stream: Filter streamed text chunks so the stop sequence (and anything after it) is never sent.
+        prompt_tokens: Get the prompt tokens of a row.
+        result: Build the response for a row.
+    """
+    def __init__(self, tokenizer, stop:tuple=(), eos_token_ids:list[int]=None, prompt_length:int=None, pad_token_id:int=None):
+        """
+        Parameters:
+            tokenizer: The tokenizer used to decode the generated tokens.
+            stop (tuple): The stop sequences. Default=() (only counts tokens)
+            eos_token_ids (list[int]): End of sequence token ids, rows that generate one are finished. Default=None
+            prompt_length (int): Length of the (padded) prompt in the generated sequences. Default=None (taken from the first step)
+            pad_token_id (int): Padding token, used to count the prompt tokens of left padded rows. Default=None (no padding)
+        """
+        self.tokenizer = tokenizer
+        self.stop = tuple(s for s in stop if s)
+        ## Only the end of the generated text is decoded at each step; a character can take up to 4 byte-level tokens.
+        self.window = 4 * max([len(s) for s in self.stop], default=0) + 4
+        self.eos_token_ids = [t for t in (eos_token_ids or []) if t is not None]
+        self.prompt_length = prompt_length
+        self.pad_token_id = pad_token_id
+        self.checked = None
+        self.lengths = None
+        self.done = None
+        self.padding = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        length = input_ids.shape[1]
+        if self.done is None:
+            ## The first call comes after the first generated token.
+            if self.prompt_length is None:
+                self.prompt_length = length - 1
+            self.checked = self.prompt_length
+            self.done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+            self.lengths = torch.zeros(input_ids.shape[0], dtype=torch.long, device=input_ids.device)
+            if self.pad_token_id is not None:
+                self.padding = (input_ids[:, :self.prompt_length] == self.pad_token_id).long().cumprod(dim=1).sum(dim=1)
+
+        ## Assisted generation can add several tokens per step.
+        new = input_ids[:, self.checked:]
+        self.checked = length
+        active = ~self.done
+        self.lengths[active] = length - self.prompt_length
+
+        finished = torch.zeros_like(self.done)
+        if self.eos_token_ids:
+            finished = torch.isin(new, torch.tensor(self.eos_token_ids, device=input_ids.device)).any(dim=1)
+        if self.stop:
+            for row in torch.nonzero(active & ~finished).flatten().tolist():
+                text = self.tokenizer.decode(input_ids[row, self.prompt_length:][-self.window:], skip_special_tokens=True)
+                if any(s in text for s in self.stop):
+                    finished[row] = True
+
+        self.done |= finished
+        return self.done.clone()
+
+    def trim(self, text:str)->str:
+        """
+        Cut a generated text at the first stop sequence (the stop sequence is not included).
+        """
+        cuts = [text.find(s) for s in self.stop if s in text]
+        return text[:min(cuts)] if cuts else text
+
+    def stream(self, chunks):
+        """
+        Filter streamed text chunks: text that could be the start of a stop sequence is held back until it is known not to be,
+        and nothing is sent from the first stop sequence on.
+        Parameters:
+            chunks (Iterator[str]): Generated text chunks.
+        Returns:
+            Iterator[str]: The text chunks up to the first stop sequence.
+        """
+        if not self.stop:
+            yield from chunks
+            return
+
+        buffer = ""
+        stopped = False
+        for chunk in chunks:
+            ## Keep draining after a stop so the generate call finishes and is recorded.
+            if stopped:
+                continue
+            buffer += chunk
+            text = self.trim(buffer)
+            if len(text) < len(buffer):
+                stopped = True
+                if text:
+                    yield text
+                continue
+            hold = max([n for s in self.stop for n in range(1, len(s)) if buffer.endswith(s[:n])], default=0)
+            if len(buffer) > hold:
+                yield buffer[:len(buffer)-hold]
+                buffer = buffer[len(buffer)-hold:]
+        if buffer and not stopped:
+            yield buffer
+
+    def prompt_tokens(self, row:int)->int:
+        """
+        Get the prompt tokens of a row, without left padding.
+        """
+        if self.prompt_length is None:
+            return 0
+        return self.prompt_length - (int(self.padding[row]) if self.padding is not None else 0)
+
+    def result(self, row:int, text, prompt_tokens:int=None)->dict:
+        """
+        Build the response for a row: the text, its token usage and the finish reason ("stop" for an end of sequence token
+        or stop sequence, "length" when max_new_tokens was reached).
+        Parameters:
+            row (int): The row of the generated sequences.
+            text: The response text (or chat messages).
+            prompt_tokens (int): Prompt tokens of the row. Default=None (counted from the generated sequences)
+        """
+        prompt_tokens = prompt_tokens if prompt_tokens is not None else self.prompt_tokens(row)
+        completion_tokens = int(self.lengths[row]) if self.lengths is not None else 0
+        return {
+            "response": text,
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+            "finish_reason": "stop" if self.done is not None and bool(self.done[row]) else "length",
+        }
+
+
+class _ForwardCounter(object):
+    """
+    Counts forward passes of models per thread, so concurrent requests each see only their own passes.
+    """
+    def __init__(self, models:list):
+        self.counts = {}
+        for model in models:
+            model.register_forward_hook(lambda module, args, output, key=id(model): self._hook(key))
+
+    def _hook(self, key):
+        passes = self.counts.get(threading.get_ident(), None)
+        if passes is not None:
+            passes[key] = passes.get(key, 0) + 1
+
+    @contextlib.contextmanager
+    def count(self):
+        """
+        Count the forward passes made by the current thread inside the block.
+        Returns:
+            collections.Counter: The number of passes per model id, filled in as the block runs.
+        """
+        passes = collections.Counter()
+        self.counts[threading.get_ident()] = passes
+        try:
+            yield passes
+        finally:
+            self.counts.pop(threading.get_ident(), None)
+
+
 class Wrapper(abc.ABC):
 
     def request(self, prompt:list[dict], *args, **kwargs,)->dict:
@@ -41,8 +443,410 @@ class Wrapper(abc.ABC):
         pass
 
     def get_vocab(self)->dict:
+        """
+        Get the vocabulary of the language model.
+        Returns:
+            dict: A dictionary containing the vocabulary of the language model (token to id).
+        """
+        return self.get_vocab_cache().vocab
+
+    def json_schema_processor(self, run_config:dict):
+        """
+        Create a processor constraining generation to the JSON schema in the run configuration ({"json_schema": {...}}).
+        "json_max_whitespace" sets the consecutive whitespace allowed between JSON tokens (llm_json_schema.MAX_WHITESPACE
+        by default, raise it for pretty-printed output with deep indentation, 0 for compact output).
+        Compiled schemas are kept for reuse, as are their allowed-token masks.
+        Returns:
+            JsonSchemaLogitsProcessor: A new processor for this request, or None if no schema is given.
+        """
+        schema = run_config.get("json_schema", None)
+        if schema is None:
+            return None
+        max_whitespace = run_config.get("json_max_whitespace", llm_json_schema.MAX_WHITESPACE)
+        if not isinstance(max_whitespace, int) or isinstance(max_whitespace, bool) or max_whitespace < 0:
+            raise ValueError(f"json_max_whitespace must be a non-negative integer, got {max_whitespace!r}")
+
+        key = (json.dumps(schema, sort_keys=True), max_whitespace)
+        with self.tokenizer_lock:
+            if getattr(self, "json_grammars", None) is None:
+                self.json_grammars = collections.OrderedDict()
+            grammar = self.json_grammars.pop(key, None) or llm_json_schema.JsonSchemaGrammar(schema, max_whitespace)
+            self.json_grammars[key] = grammar
+            while len(self.json_grammars) > 32:
+                self.json_grammars.popitem(last=False)
+
+            if getattr(self, "token_table", None) is None:
+                self.token_table = llm_json_schema.TokenTable(self.tokenizer, self.model.get_output_embeddings().weight.shape[0])
+
+        return JsonSchemaLogitsProcessor(grammar, self.token_table, self.eos_token_ids())
+
+    def eos_token_ids(self)->list[int]:
+        """
+        Get the end of sequence token ids from the generation config of the model, falling back to the tokenizer.
+        """
+        eos_token_ids = self.model.generation_config.eos_token_id
+        if eos_token_ids is None:
+            eos_token_ids = self.tokenizer.eos_token_id
+        return eos_token_ids if isinstance(eos_token_ids, list) else [eos_token_ids]
+
+    def output_options(self, kwargs:dict, prompt_length:int=None, pad_token_id:int=None)->tuple:
+        """
+        Take the output options (stop sequences and return_full_text) out of the generation kwargs and attach the stop criteria.
+        Parameters:
+            kwargs (dict): The generation kwargs from generation_kwargs.
+            prompt_length (int): Length of the (padded) prompt in the generated sequences. Default=None (taken from the first step)
+            pad_token_id (int): Padding token of left padded batches. Default=None
+        Returns:
+            tuple: The kwargs to pass to generate (or the pipeline), the StopSequenceCriteria and whether to return the full text.
+        """
+        kwargs = dict(kwargs)
+        criteria = StopSequenceCriteria(self.tokenizer, kwargs.pop("stop", ()), self.eos_token_ids(), prompt_length, pad_token_id)
+        return_full_text = kwargs.pop("return_full_text", False)
+        ## JSON schema constraints are also fed the last token of each row, which only the stopping criteria see.
+        constraints = [JsonSchemaStoppingCriteria(p) for p in kwargs.get("logits_processor", None) or [] if isinstance(p, JsonSchemaLogitsProcessor)]
+        kwargs["stopping_criteria"] = transformers.StoppingCriteriaList(list(kwargs.get("stopping_criteria", None) or []) + [criteria] + constraints)
+        return kwargs, criteria, return_full_text
+
+    def get_vocab_cache(self)->llm_cache.VocabCache:
+        """
+        Get the vocabulary computed once from the tokenizer, kept pre-serialized for the /vocab endpoint.
+        """
+        if getattr(self, "vocab_cache", None) is None:
+            with self.tokenizer_lock:
+                self.vocab_cache = llm_cache.VocabCache(self.tokenizer.get_vocab())
+        return self.vocab_cache
+
+    def tokenize(self, texts:list[str], add_special_tokens:bool=True)->list[list[int]]:
+        """
+        Tokenize a batch of texts in one tokenizer call.
+        Returns:
+            list[list[int]]: The token ids for each text.
+        """
+        with self.tokenizer_lock:
+            return self.tokenizer(texts, add_special_tokens=add_special_tokens)["input_ids"]
+
+    def detokenize(self, input_ids:list[list[int]], skip_special_tokens:bool=False)->dict:
+        """
+        Convert a batch of token id lists back to text and to the individual tokens.
+        Returns:
+            dict: texts (decoded text per list) and tokens (token string per id).
+        """
+        with self.tokenizer_lock:
+            return {
+                "texts": self.tokenizer.batch_decode(input_ids, skip_special_tokens=skip_special_tokens),
+                "tokens": [self.tokenizer.convert_ids_to_tokens(ids) for ids in input_ids],
+            }
+
+    def stream(self, prompt:list[dict], run_config:dict={}):
         pass
 
+    def generate_text(self, prompt:list[dict], kwargs:dict)->dict:
+        pass
+
+    def generate_texts(self, prompts:list, kwargs:dict)->list[dict]:
+        pass
+
+    def request_batch(self, items:list[dict])->list[dict]:
+        """
+        Request responses for many prompts in one call. Items with the same generation settings are run as padded
+        batches (up to "max_batch_size" from the wrapper config), items that process logits are run one at a time.
+        Parameters:
+            items (list[dict]): Each item has a prompt and optionally run_config and process_logits.
+        Returns:
+            list[dict]: One response per item in the same order. Failed items contain an "error" instead of a response.
+        """
+        results = [None] * len(items)
+        groups = {}
+
+        for i, item in enumerate(items):
+            try:
+                prompt = item.get("prompt", None)
+                if prompt is None:
+                    results[i] = {"error": "Prompt is required"}
+                    continue
+                run_config = item.get("run_config", {})
+                if item.get("process_logits", False) or "json_schema" in run_config:
+                    results[i] = self.request(prompt, item.get("process_logits", False), run_config)
+                    continue
+
+                kwargs = self.generation_kwargs(run_config)
+                cache_key = self.response_cache_key(prompt, False, kwargs)
+                cached = self.response_cache.get(cache_key) if cache_key is not None else None
+                if cached is not None:
+                    results[i] = cached
+                    continue
+
+                groups.setdefault(tuple(sorted(kwargs.items())), []).append((i, prompt, run_config, cache_key))
+            except Exception as e:
+                results[i] = {"error": str(e)}
+
+        max_batch_size = self.config.get("max_batch_size", 16)
+        for key, group in groups.items():
+            for n in range(0, len(group), max_batch_size):
+                chunk = group[n:n+max_batch_size]
+                try:
+                    outs = self.generate_texts([prompt for _, prompt, _, _ in chunk], dict(key))
+                except Exception:
+                    ## Run the items one at a time so the error is only reported for the items that fail.
+                    outs = [None] * len(chunk)
+
+                for (i, prompt, run_config, cache_key), out in zip(chunk, outs):
+                    if out is None:
+                        try:
+                            results[i] = self.request(prompt, False, run_config)
+                        except Exception as e:
+                            results[i] = {"error": str(e)}
+                        continue
+
+                    results[i] = {**out, "logits":[], "scores":[]}
+                    if cache_key is not None:
+                        self.response_cache.put(cache_key, results[i])
+
+        return results
+
+    def register_prefix(self, prefix:str)->bool:
+        return False
+
+    def close_session(self, session_id:str)->bool:
+        """
+        Drop a conversation session and its key/value cache.
+        Returns:
+            bool: True if the session was cached.
+        """
+        sessions = getattr(self, "sessions", None)
+        return sessions.close(session_id) if sessions is not None else False
+
+    def profile_requested(self, run_config:dict)->bool:
+        """
+        Check if the run configuration asks for the generate call to run under the torch profiler ({"profile": True}).
+        Profiling is only available when an admin token is configured; the servers check the token before passing the option on.
+        """
+        return bool(run_config.get("profile", False)) and self.profiler.admin_token is not None
+
+    def response_cache_key(self, prompt:list[dict], process_logits:bool, kwargs:dict):
+        """
+        Get the response cache key for a request, or None if the response cache is disabled or does not apply.
+        Requests that sample or process logits are never cached.
+        """
+        if self.response_cache is None or process_logits:
+            return None
+        return self.response_cache.key(self.name, prompt, kwargs)
+
+    def logits_format(self, run_config:dict)->str:
+        """
+        Get the format to return captured scores in: "json" (inline lists, default) or "npy" (binary files served from /logits/<id>).
+        """
+        return run_config.get("logits_format", self.config.get("logits_format", "json"))
+
+    def capture_response(self, capture:TensorLogitStoreProcessor, run_config:dict)->dict:
+        """
+        Build the logits part of the response from a capture processor.
+        For the "npy" format the arrays are saved to the logits file store and only their ids, shapes and dtypes are returned.
+        """
+        if self.logits_format(run_config) != "npy":
+            return capture.result()
+
+        arrays = capture.arrays()
+        res = {"logits": [], "scores": [], "score_ids": [], "input_ids": []}
+        if arrays["scores"] is None:
+            return res
+
+        res["input_ids"] = arrays["input_ids"].tolist()
+        for key in ["scores", "score_ids"]:
+            if arrays[key] is not None:
+                res[f"{key}_file"] = {
+                    "id": self.logits_files.save(arrays[key]),
+                    "shape": list(arrays[key].shape),
+                    "dtype": str(arrays[key].dtype),
+                }
+        return res
+
+    def capture_processor(self, run_config:dict, kwargs:dict):
+        """
+        Create a compact logits capture processor if "logits_capture" is set in the run configuration or wrapper config,
+        e.g. {"logits_capture": {"top_k": 20, "dtype": "float16"}} or {"logits_capture": {"token_ids": [1, 2, 3]}}.
+        Returns:
+            TensorLogitStoreProcessor: A new processor for this request, or None to use the default logits store.
+        """
+        capture = run_config.get("logits_capture", self.config.get("logits_capture", None))
+        if capture is None:
+            if self.logits_format(run_config) != "npy":
+                return None
+            ## Binary output always goes through the tensor capture, stored as float16 unless configured otherwise.
+            capture = {}
+
+        return TensorLogitStoreProcessor(
+            kwargs["max_new_tokens"],
+            top_k=capture.get("top_k", None),
+            token_ids=capture.get("token_ids", None),
+            dtype=getattr(torch, capture.get("dtype", "float16")),
+        )
+
+    def prepare_cpu_model(self):
+        """
+        Convert the model for CPU inference as configured under "quantization" in the wrapper config, e.g.
+        {"quantization": {"dtype": "int8", "threads": 8}} (dtype is "int8" or "bfloat16"). The memory saving and speedup are reported at startup.
+        """
+        self.quantization = None
+        options = self.config.get("quantization", None)
+        if not options:
+            return
+        if self.config.get("device", "cpu") != "cpu":
+            print(f"Quantization is only applied on cpu, {self.name} runs at full precision")
+            return
+
+        self.model, self.quantization = llm_quant.prepare_cpu_model(self.model, self.tokenizer, options)
+        print(llm_quant.format_report(self.name, self.quantization))
+
+    def start_warmup(self):
+        """
+        Start the warmup pass configured under "warmup" in the wrapper config, e.g. {"warmup": {"lengths": [16, 256], "max_new_tokens": 8}}.
+        The warmup runs in a background thread unless "background" is False. Without a warmup config the wrapper is ready immediately.
+        """
+        self.ready = False
+        self.warmup_error = None
+        warmup = self.config.get("warmup", None)
+        if not warmup:
+            self.ready = True
+            return
+
+        if warmup.get("background", True):
+            threading.Thread(target=self.warmup, name=f"warmup-{self.name}", daemon=True).start()
+        else:
+            self.warmup()
+
+    def warmup(self):
+        """
+        Run a few dummy prompts at typical lengths through the model so kernels and allocator caches are primed.
+        Sets the ready flag once complete.
+        """
+        warmup = self.config.get("warmup", {})
+        prompts = warmup.get("prompts", None) or [" ".join(["warmup"] * n) for n in warmup.get("lengths", [16, 128])]
+
+        kwargs = self.generation_kwargs({"do_sample": False})
+        kwargs.pop("max_length", None)
+        kwargs["max_new_tokens"] = warmup.get("max_new_tokens", 8)
+        kwargs["num_return_sequences"] = 1
+
+        try:
+            for prompt in prompts:
+                self.generate_text(prompt, kwargs)
+        except Exception as e:
+            print(f"Warmup failed for {self.name}: {e}")
+            self.warmup_error = str(e)
+            return
+        self.ready = True
+
+    def timed_generate(self, generate, kwargs:dict, prompt_tokens:int=None):
+        """
+        Run a generate call and record its prefill and decode time, token counts and tokens per second in the metrics.
+        Parameters:
+            generate (Callable): Function called with the generation kwargs that runs generation.
+            kwargs (dict): The generation kwargs (a timing processor is added to the logits processors).
+            prompt_tokens (int): Prompt tokens of the call. Default=None (taken from the input of the first decode step)
+        Returns:
+            The result of the generate call.
+        """
+        timing = TimingProcessor()
+        kwargs = {**kwargs, "logits_processor": transformers.LogitsProcessorList(list(kwargs.get("logits_processor", None) or []) + [timing])}
+
+        with self.profiler.generate():
+            start = time.perf_counter()
+            res = generate(kwargs)
+            end = time.perf_counter()
+
+        ## The decoder input at the first step holds the prompt for decoder-only models (the start token for encoder-decoders).
+        if torch.is_tensor(res):
+            generated = (res.shape[-1] - timing.prompt_tokens) * res.shape[0] if timing.first is not None else 0
+        else:
+            generated = timing.steps * timing.rows
+        first = timing.first if timing.first is not None else end
+
+        metrics = llm_metrics.metrics
+        metrics.observe_stage(self.name, "prefill", first - start)
+        metrics.observe_stage(self.name, "decode", end - first)
+        prompt_tokens = prompt_tokens if prompt_tokens is not None else timing.prompt_tokens * timing.rows
+        metrics.observe("llm_prompt_tokens", prompt_tokens, model=self.name)
+        metrics.observe("llm_generated_tokens", generated, model=self.name)
+        metrics.inc("llm_prompt_tokens_total", prompt_tokens, model=self.name)
+        metrics.inc("llm_generated_tokens_total", generated, model=self.name)
+        if end > start:
+            metrics.observe("llm_tokens_per_second", generated / (end - start), model=self.name)
+        return res
+
+    def iterate_streamer(self, generate, streamer):
+        """
+        Run a generate call in a background thread and yield text from the streamer as it is produced.
+        Parameters:
+            generate (Callable): Function that runs generation with the streamer attached.
+            streamer (transformers.TextIteratorStreamer): The streamer hooked into the generate call.
+        Returns:
+            Iterator[str]: Text chunks as they are decoded.
+        """
+        errors = []
+
+        def run():
+            try:
+                generate()
+            except Exception as e:
+                ## Unblock the consumer, the error is raised once the streamer is drained.
+                errors.append(e)
+                streamer.end()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        for text in streamer:
+            if text:
+                yield text
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    def generation_kwargs(self, run_config:dict)->dict:
+        """
+        Build the generation kwargs for a request from the wrapper config and the run configuration.
+        Parameters:
+            run_config (dict): Run configuration for the request (including do_sample, etc.)
+        Returns:
+            dict: The kwargs to pass to generate (or the pipeline), plus the output options "stop" and "return_full_text"
+            that output_options takes out before the call.
+        """
+        max_length = self.config.get("max_length", None)
+        num_return_sequences = self.config.get("num_return_sequences", 1)
+        output_scores = self.config.get("output_scores", None)
+        max_new_tokens = run_config.get("max_new_tokens", self.config.get("max_new_tokens", 500))
+        stop = run_config.get("stop", self.config.get("stop", None))
+        return_full_text = run_config.get("return_full_text", self.config.get("return_full_text", False))
+        do_sample = run_config.get("do_sample", self.config.get("do_sample", False))
+        temperature = run_config.get("temperature", self.config.get("temperature", 0.0))
+
+        ## Handling configuration options. Expand in future to improve tunability of LLMs.
+        kwargs = {}
+
+        if max_length:
+            kwargs["max_length"] = max_length
+
+        if output_scores:
+            kwargs["output_scores"] = output_scores
+
+        if not isinstance(max_new_tokens, int) or isinstance(max_new_tokens, bool) or max_new_tokens < 1:
+            raise ValueError(f"max_new_tokens must be a positive integer, got {max_new_tokens!r}")
+        kwargs["max_new_tokens"] = max_new_tokens
+
+        ## Stop sequences are kept as a tuple so the kwargs can key batches and cached responses.
+        if stop:
+            stop = (stop,) if isinstance(stop, str) else tuple(stop)
+            if not all(isinstance(s, str) for s in stop):
+                raise ValueError("stop must be a string or a list of strings")
+            kwargs["stop"] = stop
+        kwargs["return_full_text"] = bool(return_full_text)
+
+        kwargs["num_return_sequences"] = num_return_sequences
+        kwargs["do_sample"] = do_sample
+        kwargs["temperature"] = temperature
+
+        return kwargs
+
 
 class LLM_Server_Wrapper(Wrapper):
     """
@@ -65,12 +869,104 @@ class LLM_Server_Wrapper(Wrapper):
         self.config = config
         self.model = model
         self.tokenizer = tokenizer
-        self.logits_store = LogitStoreProcessor()
-        self.logits_processor_list = transformers.LogitsProcessorList([self.logits_store,])
+        ## Binary scores (logits_format="npy") are kept on disk within "logits_max_files", "logits_max_bytes" and "logits_ttl" (seconds).
+        self.logits_files = llm_logits.LogitsFileStore(config.get("logits_dir", None), config.get("logits_max_files", 1000),
+                                                       config.get("logits_max_bytes", 1 << 30), config.get("logits_ttl", 3600))
+
+        ## Optional exact-match response cache for deterministic requests, e.g. {"response_cache": {"max_entries": 1024, "ttl": 3600, "path": "cache.db"}}
+        response_cache = config.get("response_cache", None)
+        self.response_cache = llm_cache.ResponseCache(response_cache.get("max_entries", 1024), response_cache.get("ttl", None), response_cache.get("path", None)) if response_cache else None
         self.prompting_hint = config.get("prompting_hint", "")
 
+        ## Slowest request sampling and on-demand profiling, e.g. {"profiling": {"slowest": 10, "dir": "traces", "max_traces": 20}}
+        profiling = config.get("profiling", {})
+        self.profiler = llm_profiler.Profiler(profiling.get("slowest", 10), profiling.get("dir", None), profiling.get("max_traces", 20), profiling.get("admin_token_env", "LLM_ADMIN_TOKEN"))
+
+        ## Fast tokenizers change their padding state when encoding, so calls are serialized across request threads.
+        self.tokenizer_lock = threading.Lock()
+
         if config.get("device", "cpu") == "cuda":
             self.model.to("cuda")
+        self.prepare_cpu_model()
+
+        ## Optional draft model for assisted (speculative) decoding, e.g. {"assistant": {"model": "<hf id>", "num_assistant_tokens": 5}}
+        self.assistant_model = None
+        self.assistant_error = None
+        self.forward_counter = None
+        if config.get("assistant", None):
+            self.load_assistant(config["assistant"])
+
+        ## Optional dynamic batching of concurrent requests, e.g. {"batching": {"max_batch_size": 8, "max_wait_ms": 10}}
+        self.scheduler = None
+        batching = config.get("batching", None)
+        if batching:
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            self.scheduler = llm_scheduler.BatchScheduler(self.generate_batch, batching.get("max_batch_size", 8), batching.get("max_wait_ms", 10),
+                                                          on_wait=lambda seconds: llm_metrics.metrics.observe_stage(self.name, "queue_wait", seconds))
+
+        ## Optional shared-prefix key/value cache for decoder-only models, e.g. {"prefix_cache": {"prefixes": [...], "max_bytes": 2**30}}
+        ## The fixed text at the start of the prompting hint is always registered.
+        self.prefix_cache = None
+        prefix_cache = config.get("prefix_cache", None)
+        if prefix_cache and not self.model.config.is_encoder_decoder:
+            self.prefix_cache = llm_cache.PrefixCache(self.model, self.tokenizer, prefix_cache.get("max_bytes", 1 << 30))
+            for prefix in [llm_cache.template_prefix(self.prompting_hint)] + prefix_cache.get("prefixes", []):
+                if prefix:
+                    self.register_prefix(prefix)
+
+        ## Optional conversation sessions that keep their key/value cache between requests (decoder-only models),
+        ## e.g. {"sessions": {"max_bytes": 2**30, "idle_timeout": 600}}
+        self.sessions = None
+        sessions = config.get("sessions", None)
+        if sessions and not self.model.config.is_encoder_decoder:
+            self.sessions = llm_cache.SessionCache(sessions.get("max_bytes", 1 << 30), sessions.get("idle_timeout", 600.0),
+                                                   on_event=lambda event, count: llm_metrics.metrics.inc(f"llm_session_{event}_total", count, model=self.name))
+
+        self.get_vocab_cache()
+        self.start_warmup()
+
+    def load_assistant(self, assistant:dict):
+        """
+        Load the draft model used for assisted decoding. The draft model must share the tokenizer of the wrapped
+        model (same vocabulary and special tokens), otherwise the wrapper falls back to plain decoding.
+        Parameters:
+            assistant (dict): model (a model or Hugging Face id), tokenizer (a tokenizer or id, default the model id) and num_assistant_tokens.
+        """
+        model = assistant.get("model", None)
+        tokenizer = assistant.get("tokenizer", model if isinstance(model, str) else None)
+        try:
+            if isinstance(model, str):
+                model = transformers.AutoModelForCausalLM.from_pretrained(model)
+            if isinstance(tokenizer, str):
+                tokenizer = transformers.AutoTokenizer.from_pretrained(tokenizer)
+        except Exception as e:
+            self.assistant_error = f"Could not load the assistant model: {e}"
+            print(f"{self.assistant_error}, using plain decoding for {self.name}")
+            return
+
+        error = None
+        if self.model.config.is_encoder_decoder or model.config.is_encoder_decoder:
+            error = "assisted decoding is only enabled for decoder-only models"
+        elif tokenizer is not None and tokenizer.get_vocab() != self.tokenizer.get_vocab():
+            error = "the assistant tokenizer has a different vocabulary"
+        elif tokenizer is not None and (tokenizer.eos_token_id, tokenizer.pad_token_id) != (self.tokenizer.eos_token_id, self.tokenizer.pad_token_id):
+            error = "the assistant tokenizer has different special tokens"
+        elif model.get_output_embeddings().weight.shape[0] != self.model.get_output_embeddings().weight.shape[0]:
+            error = "the assistant model has a different vocabulary size"
+        if error is not None:
+            self.assistant_error = f"Incompatible assistant model: {error}"
+            print(f"{self.assistant_error}, using plain decoding for {self.name}")
+            return
+
+        model.to(self.model.device)
+        model.eval()
+        if "num_assistant_tokens" in assistant:
+            model.generation_config.num_assistant_tokens = assistant["num_assistant_tokens"]
+        if "num_assistant_tokens_schedule" in assistant:
+            model.generation_config.num_assistant_tokens_schedule = assistant["num_assistant_tokens_schedule"]
+        self.assistant_model = model
+        self.forward_counter = _ForwardCounter([self.model, self.assistant_model])
 
     def print_kwargs(self, kwargs):
         """
@@ -79,74 +975,260 @@ class LLM_Server_Wrapper(Wrapper):
         for k,v in kwargs.items():
             print(f"{k}: {v}")
 
-    def get_vocab(self):
-        """
-        Get the vocabulary of the language model.
-        Returns:
-            dict: A dictionary containing the vocabulary of the language model.
-        """
-        return self.model.get_vocab()
 
-    def request(self, prompt:list[dict], process_logits:bool=False, run_config:dict={})->dict:
+    def request(self, prompt:list[dict], process_logits:bool=False, run_config:dict={}, session_id:str=None)->dict:
         """
         Request a response from the language model.
         prompt (list[dict]): The prompt to send to the language model.
         process_logits (bool): Whether to process logits and scores from the language model (can add overhead to the request). Default=False
         run_config (dict): Run configuration for the request (including do_sample, etc.)
+        session_id (str): Conversation session to keep the key/value cache of, so the next turn only prefills the new tokens (needs "sessions" in the wrapper config). Default=None
 
         Returns:
-            dict: A dictionary containing the response, logits, and scores from the language model. Logits and scores are only returned if process_logits is True.
+            dict: A dictionary containing the response, usage (prompt and completion tokens), finish reason, logits, and scores from the language model. Logits and scores are only returned if process_logits is True.
+            The response is the newly generated text, cut at the first of the run configuration "stop" sequences; set "return_full_text" to get the prompt back as well.
         """
-        max_length = self.config.get("max_length", None)
-        num_return_sequences = self.config.get("num_return_sequences", 1)
-        output_scores = self.config.get("output_scores", None)
-        max_new_tokens = self.config.get("max_new_tokens", 500)
-        do_sample = run_config.get("do_sample", self.config.get("do_sample", False))
-        temperature = run_config.get("temperature", self.config.get("temperature", 0.0))
         debug_mode = run_config.get("debug_mode", self.config.get("debug_mode", False))
-  
-
-        ## Encode the prompt using the tokenizer
-        enc = self.tokenizer.encode(prompt, return_tensors="pt").to(self.model.device)
-
-        
-        ## Handling configuration options. Expand in future to improve tunability of LLMs.
-        kwargs = {}
+        kwargs = self.generation_kwargs(run_config)
 
         kwargs["logits_processor"] = []
-        
-        if self.logits_processor_list:
-            for p in self.logits_processor_list:
-                print("Clearing processor")
-                p.clear()
-
-        if process_logits:   
-            kwargs["logits_processor"] = self.logits_processor_list
-        
-        if max_length:
-            kwargs["max_length"] = max_length
 
-        if output_scores:
-            kwargs["output_scores"] = output_scores
+        ## Processors are created per request so concurrent generations never share logits state.
+        capture = self.capture_processor(run_config, kwargs) if process_logits else None
+        logits_store = LogitStoreProcessor() if process_logits and capture is None else None
 
-       
-        kwargs["max_new_tokens"] = max_new_tokens
-        kwargs["num_return_sequences"] = num_return_sequences
-        kwargs["do_sample"] = do_sample
-        kwargs["temperature"] = temperature
+        if capture is not None:
+            kwargs["logits_processor"] = transformers.LogitsProcessorList([capture,])
+        elif logits_store is not None:
+            kwargs["logits_processor"] = transformers.LogitsProcessorList([logits_store,])
 
+        ## The schema constraint runs first so captured scores are the constrained ones.
+        constraint = self.json_schema_processor(run_config)
+        if constraint is not None:
+            kwargs["logits_processor"] = transformers.LogitsProcessorList([constraint,] + list(kwargs["logits_processor"]))
 
         if debug_mode:
             self.print_kwargs(kwargs)
             print("Process Logits: ", process_logits)
             print(prompt)
 
+        with self.profiler.record(process_logits, self.profile_requested(run_config)) as record:
+            record.kwargs = {k: v for k, v in kwargs.items() if k != "logits_processor"}
+
+            ## Profiled requests always run generate, so they skip the response cache.
+            cache_key = self.response_cache_key(prompt, process_logits, {**kwargs, "json_schema": run_config.get("json_schema", None), "json_max_whitespace": run_config.get("json_max_whitespace", None)}) if not record.profile else None
+            if cache_key is not None:
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    return cached
+
+            ## Session requests run on this thread so their key/value cache can be kept.
+            session_id = session_id if self.sessions is not None and kwargs.get("num_return_sequences", 1) == 1 else None
+
+            ## Assisted decoding runs one sequence at a time; logits processors are not used as they would also see the draft tokens that get rejected.
+            if self.assistant_model is not None and not process_logits and constraint is None and session_id is None and kwargs.get("num_return_sequences", 1) == 1:
+                out, metadata = self.generate_assisted(prompt, kwargs)
+                res = {**out, "logits":[], "scores":[], "metadata":metadata}
+            ## Batch with other in-flight requests that share the same generation settings.
+            ## Requests with logits processors are not batched as the processors track a single sequence, profiled requests must run on this thread.
+            elif self.scheduler is not None and not process_logits and constraint is None and session_id is None and not record.profile:
+                key = tuple(sorted((k, v) for k, v in kwargs.items() if k != "logits_processor"))
+                try:
+                    res = self.scheduler.submit(key, prompt)
+                except llm_scheduler.SchedulerStopped:
+                    ## The model was unloaded while this request still held the wrapper, generate on this thread instead.
+                    res = {**self.generate_text(prompt, kwargs), "logits":[], "scores":[]}
+            else:
+                out = self.generate_text(prompt, kwargs, session_id)
+
+                if capture is not None:
+                    res = {**out, **self.capture_response(capture, run_config)}
+                elif logits_store is not None:
+                    res = {**out, "logits":logits_store.logits, "scores": logits_store.scores}
+                else:
+                    res = {**out, "logits":[], "scores":[]}
+
+            if constraint is not None:
+                res["json"] = constraint.values()[0] if constraint.values() else None
+            if cache_key is not None:
+                self.response_cache.put(cache_key, res)
+            if record.trace_id is not None:
+                res = {**res, "profile": {"trace_id": record.trace_id, "top_ops": record.top_ops}}
+
+            return res
+
+    def register_prefix(self, prefix:str)->bool:
+        """
+        Precompute the key/value cache for a prompt prefix so requests starting with it skip prefill over the prefix.
+        Parameters:
+            prefix (str): The prompt prefix.
+        Returns:
+            bool: True if the prefix was cached.
+        """
+        if self.prefix_cache is None:
+            return False
+        with self.tokenizer_lock:
+            return self.prefix_cache.register(prefix)
+
+    def encode_prompt(self, prompt)->torch.Tensor:
+        """
+        Encode a text prompt, or chat messages with the chat template of the tokenizer (call with the tokenizer lock held).
+        Returns:
+            torch.Tensor: The token ids of shape (1, length) on the model device.
+        """
+        if isinstance(prompt, list):
+            enc = self.tokenizer.apply_chat_template(prompt, add_generation_prompt=True, return_tensors="pt", return_dict=True)["input_ids"]
+        else:
+            enc = self.tokenizer.encode(prompt, return_tensors="pt")
+        return enc.to(self.model.device)
+
+    def decode_result(self, res, row:int, start:int, criteria:StopSequenceCriteria, prompt_tokens:int, return_full_text:bool)->dict:
+        """
+        Decode the newly generated text of a returned sequence, cut at the first stop sequence.
+        Parameters:
+            res (torch.Tensor): The sequences returned by generate.
+            row (int): The row to decode.
+            start (int): Where the generated tokens start in the row (the padded prompt length for decoder-only models).
+            criteria (StopSequenceCriteria): The stop criteria of the generate call.
+            prompt_tokens (int): Prompt tokens of the row.
+            return_full_text (bool): Return the prompt followed by the generated text.
+        Returns:
+            dict: The response, usage and finish reason.
+        """
+        ## The prompt is decoded with the sequence and cut off by length, so tokenizers that merge spaces across the boundary decode the same as before.
+        prefix = self.tokenizer.decode(res[row][:start], skip_special_tokens=True)
+        text = criteria.trim(self.tokenizer.decode(res[row], skip_special_tokens=True)[len(prefix):])
+        return criteria.result(row, prefix + text if return_full_text else text, prompt_tokens)
+
+    def generate_text(self, prompt:list[dict], kwargs:dict, session_id:str=None)->dict:
+        """
+        Encode the prompt, call generate on the wrapped model and decode the first returned sequence.
+        With a session id the key/value cache of the conversation is reused and kept for the next turn.
+        Returns:
+            dict: The newly generated text (or the full text if requested), usage and finish reason (and the cached prompt tokens for sessions).
+        """
+        ## Encode the prompt using the tokenizer
+        with self.tokenizer_lock, llm_metrics.metrics.stage(self.name, "tokenize"):
+            enc = self.encode_prompt(prompt)
+
+        ## Encoder-decoder models only return the decoder sequence, which starts after a single start token.
+        start = 0 if self.model.config.is_encoder_decoder else enc.shape[1]
+        kwargs, criteria, return_full_text = self.output_options(kwargs, start or None)
+
+        ## Start from the cached keys/values of the session, or of a registered prefix, so only the rest of the prompt is prefilled.
+        cached_tokens = 0
+        if session_id is not None:
+            past_key_values, cached_tokens = self.sessions.lookup(session_id, enc)
+            kwargs = {**kwargs, "past_key_values": past_key_values}
+        if self.prefix_cache is not None and kwargs.get("num_return_sequences", 1) == 1 and kwargs.get("past_key_values", None) is None:
+            past_key_values = self.prefix_cache.lookup(prompt, enc)
+            if past_key_values is not None:
+                kwargs = {**kwargs, "past_key_values": past_key_values}
+        ## A new session starts from an empty cache that generate fills in, so it can be kept.
+        if session_id is not None and kwargs["past_key_values"] is None:
+            kwargs["past_key_values"] = transformers.DynamicCache()
+
         ## Call generate method of the wrapped model
-        res = self.model.generate(enc, **kwargs)
-       
-        dec = self.tokenizer.decode(res[0], skip_special_tokens=True)
-        
-        return {"response":dec, "logits":self.logits_store.logits, "scores": self.logits_store.scores}
+        res = self.timed_generate(lambda kw: self.model.generate(enc, **kw), kwargs, enc.shape[1])
+        if session_id is not None:
+            self.sessions.store(session_id, res[0], kwargs["past_key_values"])
+
+        with llm_metrics.metrics.stage(self.name, "detokenize"):
+            out = self.decode_result(res, 0, start, criteria, enc.shape[1], return_full_text)
+        if session_id is not None:
+            out["usage"]["cached_tokens"] = cached_tokens
+        return out
+
+    def generate_assisted(self, prompt:list[dict], kwargs:dict)->tuple:
+        """
+        Generate with the draft model proposing tokens that the wrapped model verifies in a single forward pass.
+        Greedy decoding gives the same output as plain decoding.
+        Returns:
+            tuple: The response (text, usage and finish reason) and the metadata (new tokens, tokens per second, forward passes and estimated acceptance rate).
+        """
+        with self.tokenizer_lock, llm_metrics.metrics.stage(self.name, "tokenize"):
+            enc = self.encode_prompt(prompt)
+        kwargs, criteria, return_full_text = self.output_options(kwargs, enc.shape[1])
+
+        with self.forward_counter.count() as passes:
+            start = time.perf_counter()
+            res = self.timed_generate(lambda kw: self.model.generate(enc, assistant_model=self.assistant_model, **kw), kwargs, enc.shape[1])
+            elapsed = time.perf_counter() - start
+
+        ## Every verification pass of the wrapped model adds the accepted draft tokens plus one token of its own.
+        new_tokens = res.shape[1] - enc.shape[1]
+        target_passes = passes[id(self.model)]
+        draft_passes = passes[id(self.assistant_model)]
+        accepted = max(new_tokens - target_passes, 0)
+        metadata = {
+            "assisted": True,
+            "new_tokens": new_tokens,
+            "tokens_per_second": new_tokens / elapsed if elapsed > 0 else None,
+            "target_forward_passes": target_passes,
+            "draft_forward_passes": draft_passes,
+            "acceptance_rate": accepted / draft_passes if draft_passes else None,
+        }
+        with llm_metrics.metrics.stage(self.name, "detokenize"):
+            return self.decode_result(res, 0, enc.shape[1], criteria, enc.shape[1], return_full_text), metadata
+
+    def generate_batch(self, key:tuple, prompts:list)->list[dict]:
+        """
+        Run a single padded generate call for a batch of prompts (called by the batch scheduler).
+        Parameters:
+            key (tuple): The generation kwargs shared by all prompts in the batch, as (name, value) pairs.
+            prompts (list): The prompts to generate responses for.
+        Returns:
+            list[dict]: One response dictionary per prompt, in the same order as the prompts.
+        """
+        return [{**out, "logits":[], "scores":[]} for out in self.generate_texts(prompts, dict(key))]
+
+    def generate_texts(self, prompts:list, kwargs:dict)->list[dict]:
+        """
+        Encode the prompts as one padded batch, call generate once and decode the first returned sequence for each prompt.
+        Returns:
+            list[dict]: The newly generated text (or the full text if requested), usage and finish reason for each prompt.
+        """
+        ## Decoder-only models must be left padded so generation continues directly from each prompt.
+        with self.tokenizer_lock, llm_metrics.metrics.stage(self.name, "tokenize"):
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            self.tokenizer.padding_side = "right" if self.model.config.is_encoder_decoder else "left"
+            ## Each prompt is encoded like a single request (chat messages with the chat template), then padded into one batch.
+            ids = [self.encode_prompt(prompt)[0].tolist() for prompt in prompts]
+            enc = self.tokenizer.pad({"input_ids": ids}, return_tensors="pt").to(self.model.device)
+
+        start = 0 if self.model.config.is_encoder_decoder else enc["input_ids"].shape[1]
+        kwargs, criteria, return_full_text = self.output_options(kwargs, start or None)
+        kwargs.setdefault("pad_token_id", self.tokenizer.pad_token_id)
+
+        res = self.timed_generate(lambda kw: self.model.generate(**enc, **kw), kwargs, int(enc["attention_mask"].sum()))
+
+        ## Generate returns num_return_sequences rows per prompt - keep the first one for each prompt.
+        step = kwargs.get("num_return_sequences", 1)
+        with llm_metrics.metrics.stage(self.name, "detokenize"):
+            return [self.decode_result(res, i*step, start, criteria, int(enc["attention_mask"][i].sum()), return_full_text) for i in range(len(prompts))]
+
+    def stream(self, prompt:list[dict], run_config:dict={}):
+        """
+        Stream a response from the language model, yielding text as each token is generated.
+        prompt (list[dict]): The prompt to send to the language model.
+        run_config (dict): Run configuration for the request (including do_sample, etc.)
+
+        Returns:
+            Iterator[str]: Newly generated text chunks (the prompt is not repeated).
+        """
+        kwargs = self.generation_kwargs(run_config)
+        kwargs["num_return_sequences"] = 1
+        kwargs["streamer"] = transformers.TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        constraint = self.json_schema_processor(run_config)
+        if constraint is not None:
+            kwargs["logits_processor"] = transformers.LogitsProcessorList([constraint,])
+
+        with self.tokenizer_lock, llm_metrics.metrics.stage(self.name, "tokenize"):
+            enc = self.encode_prompt(prompt)
+        kwargs, criteria, _ = self.output_options(kwargs, None if self.model.config.is_encoder_decoder else enc.shape[1])
+
+        return criteria.stream(self.iterate_streamer(lambda: self.timed_generate(lambda kw: self.model.generate(enc, **kw), kwargs, enc.shape[1]), kwargs["streamer"]))
     
     def info(self)->dict:
         """
@@ -157,7 +1239,16 @@ class LLM_Server_Wrapper(Wrapper):
         return {
             "name": self.name,
             "config": self.config,
-            "prompting_hint":self.prompting_hint
+            "prompting_hint":self.prompting_hint,
+            "ready": self.ready,
+            "warmup_error": self.warmup_error,
+            "prefix_cache": self.prefix_cache.info() if self.prefix_cache is not None else None,
+            "sessions": self.sessions.info() if self.sessions is not None else None,
+            "response_cache": self.response_cache.info() if self.response_cache is not None else None,
+            "logits_files": self.logits_files.info(),
+            "assistant": {"enabled": self.assistant_model is not None, "error": self.assistant_error},
+            "quantization": self.quantization,
+            "profiler": self.profiler.info(),
         }
     
 
@@ -183,13 +1274,38 @@ class LLM_Server_Pipe_Wrapper(Wrapper):
         self.config = config
         self.model = model
         self.tokenizer = tokenizer
-        self.logits_store = LogitStoreProcessor()
-        self.logits_processor_list = transformers.LogitsProcessorList([self.logits_store,])
+        ## Binary scores (logits_format="npy") are kept on disk within "logits_max_files", "logits_max_bytes" and "logits_ttl" (seconds).
+        self.logits_files = llm_logits.LogitsFileStore(config.get("logits_dir", None), config.get("logits_max_files", 1000),
+                                                       config.get("logits_max_bytes", 1 << 30), config.get("logits_ttl", 3600))
+
+        ## Optional exact-match response cache for deterministic requests, e.g. {"response_cache": {"max_entries": 1024, "ttl": 3600, "path": "cache.db"}}
+        response_cache = config.get("response_cache", None)
+        self.response_cache = llm_cache.ResponseCache(response_cache.get("max_entries", 1024), response_cache.get("ttl", None), response_cache.get("path", None)) if response_cache else None
         self.prompting_hint = config.get("prompting_hint", "")
 
+        ## Slowest request sampling and on-demand profiling, e.g. {"profiling": {"slowest": 10, "dir": "traces", "max_traces": 20}}
+        profiling = config.get("profiling", {})
+        self.profiler = llm_profiler.Profiler(profiling.get("slowest", 10), profiling.get("dir", None), profiling.get("max_traces", 20), profiling.get("admin_token_env", "LLM_ADMIN_TOKEN"))
+
         if config.get("device", "cpu") == "cuda":
             print("Moving model to cuda")
             self.model.to("cuda:0")
+        self.prepare_cpu_model()
+
+        self.tokenizer_lock = threading.Lock()
+
+        ## Batches are left padded with the end of sequence token. The padding is set once here, as the pipeline reads the
+        ## tokenizer padding side while it runs the batch, changing it per request would race with running batches.
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.tokenizer.padding_side = "left"
+
+        ## One pipeline shared by all request threads: the per-request settings are passed as call kwargs, which the
+        ## pipeline merges into new dicts per call without changing its own state.
+        self.pipe = transformers.pipeline("text-generation", model=self.model, tokenizer=self.tokenizer, device=self.model.device)
+
+        self.get_vocab_cache()
+        self.start_warmup()
     
     def print_kwargs(self, kwargs):
         """
@@ -198,70 +1314,124 @@ class LLM_Server_Pipe_Wrapper(Wrapper):
         for k,v in kwargs.items():
             print(f"{k}: {v}")
 
-    def get_vocab(self):
-        """
-        Get the vocabulary of the language model.
-        Returns:
-            dict: A dictionary containing the vocabulary of the language model.
-        """
-        return self.model.get_vocab()
-    
-
-    def request(self, prompt:list[dict], process_logits:bool=False, run_config:dict={})->dict:
+    def request(self, prompt:list[dict], process_logits:bool=False, run_config:dict={}, session_id:str=None)->dict:
         """
         Request a response from the language model.
         prompt (list[dict]): The prompt to send to the language model.
         process_logits (bool): Whether to process logits and scores from the language model (can add overhead to the request). Default=False
         run_config (dict): Run configuration for the request (including do_sample, etc.)
+        session_id (str): Ignored, the pipeline tokenizes the prompt itself so sessions are only kept by LLM_Server_Wrapper. Default=None
         
         Returns:
-            dict: A dictionary containing the response, logits, and scores from the language model. Logits and scores are only returned if process_logits is True.
+            dict: A dictionary containing the response, usage (prompt and completion tokens), finish reason, logits, and scores from the language model. Logits and scores are only returned if process_logits is True.
+            The response is the newly generated text, cut at the first of the run configuration "stop" sequences; set "return_full_text" to get the prompt back as well.
         """
-        max_length = self.config.get("max_length", None)
-        num_return_sequences = self.config.get("num_return_sequences", 1)
-        output_scores = self.config.get("output_scores", None)
-        max_new_tokens = self.config.get("max_new_tokens", 500)
-        do_sample = run_config.get("do_sample", self.config.get("do_sample", False))
-        temperature = run_config.get("temperature", self.config.get("temperature", 0.0))
         debug_mode = run_config.get("debug_mode", self.config.get("debug_mode", False))
-        
-        
-        ## Handling configuration options. Expand in future to improve tunability of LLMs.
-        kwargs = {}
+        kwargs = self.generation_kwargs(run_config)
 
         kwargs["logits_processor"] = []
-        
-        if self.logits_processor_list:
-            for p in self.logits_processor_list:
-                print("Clearing processor")
-                p.clear()
 
-        if process_logits:      
-            kwargs["logits_processor"] = self.logits_processor_list
-        
-        if max_length:
-            kwargs["max_length"] = max_length
+        ## Processors are created per request so concurrent generations never share logits state.
+        capture = self.capture_processor(run_config, kwargs) if process_logits else None
+        logits_store = LogitStoreProcessor() if process_logits and capture is None else None
 
-        if output_scores:
-            kwargs["output_scores"] = output_scores
+        if capture is not None:
+            kwargs["logits_processor"] = transformers.LogitsProcessorList([capture,])
+        elif logits_store is not None:
+            kwargs["logits_processor"] = transformers.LogitsProcessorList([logits_store,])
 
-       
-        kwargs["max_new_tokens"] = max_new_tokens
-        kwargs["num_return_sequences"] = num_return_sequences
-        kwargs["do_sample"] = do_sample
-        kwargs["temperature"] = temperature
-  
+        ## The schema constraint runs first so captured scores are the constrained ones.
+        constraint = self.json_schema_processor(run_config)
+        if constraint is not None:
+            kwargs["logits_processor"] = transformers.LogitsProcessorList([constraint,] + list(kwargs["logits_processor"]))
 
         if debug_mode:
             self.print_kwargs(kwargs)
             print("Process Logits: ", process_logits)
             print(prompt)
 
-        ## Using transformers pipelines for text generation instead of directly calling generate method.
-        pipe = transformers.pipeline("text-generation", model=self.model, tokenizer=self.tokenizer, device=self.model.device)
-        out = pipe(prompt, **kwargs)
+        with self.profiler.record(process_logits, self.profile_requested(run_config)) as record:
+            record.kwargs = {k: v for k, v in kwargs.items() if k != "logits_processor"}
+
+            ## Profiled requests always run generate, so they skip the response cache.
+            cache_key = self.response_cache_key(prompt, process_logits, {**kwargs, "json_schema": run_config.get("json_schema", None), "json_max_whitespace": run_config.get("json_max_whitespace", None)}) if not record.profile else None
+            if cache_key is not None:
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    return cached
+
+            out = self.generate_text(prompt, kwargs)
         
-        return {"response":out[0]["generated_text"], "logits":self.logits_store.logits, "scores": self.logits_store.scores}
+            if capture is not None:
+                res = {**out, **self.capture_response(capture, run_config)}
+            elif logits_store is not None:
+                res = {**out, "logits":logits_store.logits, "scores": logits_store.scores}
+            else:
+                res = {**out, "logits":[], "scores":[]}
+
+            if constraint is not None:
+                res["json"] = constraint.values()[0] if constraint.values() else None
+            if cache_key is not None:
+                self.response_cache.put(cache_key, res)
+            if record.trace_id is not None:
+                res = {**res, "profile": {"trace_id": record.trace_id, "top_ops": record.top_ops}}
+
+            return res
+
+    def pipe_result(self, prompt, text:str, row:int, criteria:StopSequenceCriteria, return_full_text:bool)->dict:
+        """
+        Build the response from the newly generated text of the pipeline, cut at the first stop sequence.
+        With return_full_text the prompt is put back in front as the pipeline would (chat prompts get an assistant message).
+        """
+        text = criteria.trim(text)
+        if return_full_text:
+            text = prompt + text if isinstance(prompt, str) else list(prompt) + [{"role": "assistant", "content": text}]
+        return criteria.result(row, text)
+
+    def generate_text(self, prompt:list[dict], kwargs:dict)->dict:
+        """
+        Run the prompt through the text generation pipeline and return the first generated text.
+        Returns:
+            dict: The newly generated text (or the full text if requested), usage and finish reason.
+        """
+        kwargs, criteria, return_full_text = self.output_options(kwargs)
+
+        ## Using transformers pipelines for text generation instead of directly calling generate method.
+        out = self.timed_generate(lambda kw: self.pipe(prompt, return_full_text=False, **kw), kwargs)
+
+        return self.pipe_result(prompt, out[0]["generated_text"], 0, criteria, return_full_text)
+
+    def generate_texts(self, prompts:list, kwargs:dict)->list[dict]:
+        """
+        Run a batch of prompts through the text generation pipeline in one padded batch and return the first generated text for each.
+        Returns:
+            list[dict]: The newly generated text (or the full text if requested), usage and finish reason for each prompt.
+        """
+        kwargs, criteria, return_full_text = self.output_options(kwargs, pad_token_id=self.tokenizer.pad_token_id)
+        out = self.timed_generate(lambda kw: self.pipe(prompts, batch_size=len(prompts), return_full_text=False, **kw), kwargs)
+
+        ## The pipeline returns num_return_sequences texts per prompt - keep the first one for each prompt.
+        step = kwargs.get("num_return_sequences", 1)
+        return [self.pipe_result(prompt, o[0]["generated_text"], i*step, criteria, return_full_text) for i, (prompt, o) in enumerate(zip(prompts, out))]
+
+    def stream(self, prompt:list[dict], run_config:dict={}):
+        """
+        Stream a response from the language model, yielding text as each token is generated.
+        prompt (list[dict]): The prompt to send to the language model.
+        run_config (dict): Run configuration for the request (including do_sample, etc.)
+
+        Returns:
+            Iterator[str]: Newly generated text chunks (the prompt is not repeated).
+        """
+        kwargs = self.generation_kwargs(run_config)
+        kwargs["num_return_sequences"] = 1
+        kwargs["streamer"] = transformers.TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        constraint = self.json_schema_processor(run_config)
+        if constraint is not None:
+            kwargs["logits_processor"] = transformers.LogitsProcessorList([constraint,])
+        kwargs, criteria, _ = self.output_options(kwargs)
+
+        return criteria.stream(self.iterate_streamer(lambda: self.timed_generate(lambda kw: self.pipe(prompt, **kw), kwargs), kwargs["streamer"]))
     
     def info(self):
         """
@@ -272,23 +1442,32 @@ class LLM_Server_Pipe_Wrapper(Wrapper):
         return {
             "name": self.name,
             "config": self.config,
-            "prompting_hint":self.prompting_hint
+            "prompting_hint":self.prompting_hint,
+            "ready": self.ready,
+            "warmup_error": self.warmup_error,
+            "response_cache": self.response_cache.info() if self.response_cache is not None else None,
+            "logits_files": self.logits_files.info(),
+            "quantization": self.quantization,
+            "profiler": self.profiler.info(),
         }
     
 
 
 class LLM_Server:
     """
-    Main LLM Server class for serving a language model.
+    Main LLM Server class for serving one or more language models.
     """
-    def __init__(self, wrapped_model:Wrapper, port:int=5000):
+    def __init__(self, wrapped_model:Wrapper=None, port:int=5000, registry:llm_registry.ModelRegistry=None):
         """
-        Initiate the server with a wrapped language model.
+        Initiate the server with a wrapped language model and/or a registry of models.
         Parameters:
-            wrapped_model (LLM_Server_Wrapper): The wrapped language model to serve.
+            wrapped_model (LLM_Server_Wrapper): The wrapped language model to serve (the default model).
             port (int): The port to serve the language model on. Default=5000
+            registry (llm_registry.ModelRegistry): Registry of models to serve, selected by the "model" field of a request. Default=None
         """
-        self.wrapped_model = wrapped_model
+        self.registry = registry if registry is not None else llm_registry.ModelRegistry()
+        if wrapped_model is not None:
+            self.registry.add(wrapped_model, default=True)
         self.port = port
         self.app = flask.Flask(__name__)
 
@@ -296,11 +1475,58 @@ class LLM_Server:
         def vocab():
             """
             Request handler for the vocab method of the wrapped language model.
+            The full vocabulary is served pre-serialized (gzip compressed if accepted) with an ETag for conditional requests.
+            start/stop query parameters return only the tokens with ids in that range.
+            """
+            model = self.get_model(flask.request.args.get("model", None))
+            if model is None:
+                return "Model is not loaded", 500
+
+            cache = model.get_vocab_cache()
+            start = flask.request.args.get("start", None, type=int)
+            stop = flask.request.args.get("stop", None, type=int)
+            if start is not None or stop is not None:
+                return cache.page(start, stop)
+
+            if cache.etag in flask.request.if_none_match:
+                return flask.Response(status=304, headers={"ETag": f'"{cache.etag}"'})
+
+            headers = {"ETag": f'"{cache.etag}"', "Vary": "Accept-Encoding"}
+            body = cache.json
+            if "gzip" in flask.request.accept_encodings:
+                body = cache.gzip
+                headers["Content-Encoding"] = "gzip"
+            return flask.Response(body, mimetype="application/json", headers=headers)
+
+        @self.app.route("/tokenize", methods=["POST"])
+        def tokenize():
+            """
+            Request handler to tokenize a batch of texts.
+            """
+            data = flask.request.json
+            texts = data.get("texts", None)
+            if texts is None:
+                return "Texts are required", 400
+            model = self.get_model(data.get("model", None))
+            if model is None:
+                return "Model is not loaded", 500
+
+            return {"input_ids": model.tokenize(texts, data.get("add_special_tokens", True))}
+
+        @self.app.route("/detokenize", methods=["POST"])
+        def detokenize():
             """
-            if self.wrapped_model is None:
+            Request handler to convert a batch of token id lists back to texts and tokens.
+            """
+            data = flask.request.json
+            input_ids = data.get("input_ids", None)
+            if input_ids is None:
+                return "Input ids are required", 400
+            model = self.get_model(data.get("model", None))
+            if model is None:
                 return "Model is not loaded", 500
-            
-            return self.wrapped_model.get_vocab()
+
+            return model.detokenize(input_ids, data.get("skip_special_tokens", False))
 
         @self.app.route("/request", methods=["POST"])
         def request():
@@ -313,34 +1539,259 @@ class LLM_Server:
             run_config = data.get("run_config", {})
             if prompt is None:
                 return "Prompt is required", 400
-            if self.wrapped_model is None:
+            model = self.get_model(data.get("model", None))
+            if model is None:
                 return "Model is not loaded", 500
-            
-            return self.wrapped_model.request(prompt, process_logits, run_config)
+            if run_config.get("profile", False):
+                error = self.admin_error(model)
+                if error:
+                    return error
+
+            try:
+                with llm_metrics.metrics.track(model.name):
+                    res = model.request(prompt, process_logits, run_config, data.get("session_id", None))
+            except ValueError as e:
+                ## Invalid run configuration, e.g. max_new_tokens or stop.
+                return str(e), 400
+            with llm_metrics.metrics.stage(model.name, "serialize"):
+                return flask.jsonify(res)
+
+        @self.app.route("/sessions/<session_id>", methods=["DELETE"])
+        def session(session_id):
+            """
+            Request handler to end a conversation session and free its key/value cache.
+            """
+            model = self.get_model(flask.request.args.get("model", None))
+            if model is None:
+                return "Model is not loaded", 500
+            if not model.close_session(session_id):
+                return "Session not found", 404
+            return f"Session closed: {session_id}"
         
+        @self.app.route("/batch", methods=["POST"])
+        def batch():
+            """
+            Request handler for many prompts in one call. Takes "items" (each with prompt, run_config and process_logits)
+            or "prompts" with a shared "run_config". Results are returned in order, with per-item errors.
+            """
+            data = flask.request.json
+            items = data.get("items", None)
+            if items is None and data.get("prompts", None) is not None:
+                items = [{"prompt": prompt, "run_config": data.get("run_config", {}), "process_logits": data.get("process_logits", False)} for prompt in data["prompts"]]
+            if items is None:
+                return "Items or prompts are required", 400
+            model = self.get_model(data.get("model", None))
+            if model is None:
+                return "Model is not loaded", 500
+            ## A run configuration shared by all the prompts is checked up front, items with their own report errors per item.
+            if "prompts" in data and "items" not in data:
+                try:
+                    model.generation_kwargs(data.get("run_config", {}))
+                except ValueError as e:
+                    return str(e), 400
+
+            if any(item.get("run_config", {}).get("profile", False) for item in items):
+                error = self.admin_error(model)
+                if error:
+                    return error
+
+            with llm_metrics.metrics.track(model.name):
+                results = model.request_batch(items)
+                with llm_metrics.metrics.stage(model.name, "serialize"):
+                    return flask.jsonify({"results": results})
+
+        @self.app.route("/stream", methods=["POST"])
+        def stream():
+            """
+            Request handler for streaming responses. Tokens are sent as server-sent events while the model generates.
+            """
+            data = flask.request.json
+            prompt = data["prompt"]
+            run_config = data.get("run_config", {})
+            if prompt is None:
+                return "Prompt is required", 400
+            model = self.get_model(data.get("model", None))
+            if model is None:
+                return "Model is not loaded", 500
+            ## Generation only starts when the chunks are iterated, so an invalid run configuration is reported before the stream.
+            try:
+                chunks = model.stream(prompt, run_config)
+            except ValueError as e:
+                return str(e), 400
+
+            def events():
+                try:
+                    with llm_metrics.metrics.track(model.name):
+                        for text in chunks:
+                            yield f"data: {json.dumps({'token': text})}\n\n"
+                except Exception as e:
+                    yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+                    return
+                yield "event: end\ndata: {}\n\n"
+
+            return flask.Response(flask.stream_with_context(events()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+        @self.app.route("/logits/<array_id>", methods=["GET", "DELETE"])
+        def logits(array_id):
+            """
+            Request handler for binary scores saved with logits_format="npy".
+            Supports HTTP Range requests (bytes) over the .npy file, the client maps decode steps to byte ranges.
+            """
+            model = self.get_model(flask.request.args.get("model", None))
+            if model is None:
+                return "Model is not loaded", 500
+
+            files = model.logits_files
+            if flask.request.method == "DELETE":
+                return ("", 204) if files.delete(array_id) else ("Logits not found", 404)
+
+            path = files.path(array_id)
+            if path is None:
+                return "Logits not found", 404
+            return flask.send_file(path, mimetype="application/octet-stream", conditional=True)
+
+        @self.app.route("/prefix", methods=["POST"])
+        def prefix():
+            """
+            Request handler to register a prompt prefix whose key/value cache is precomputed and reused by later requests.
+            """
+            data = flask.request.json
+            prefix = data.get("prefix", None)
+            if not prefix:
+                return "Prefix is required", 400
+            model = self.get_model(data.get("model", None))
+            if model is None:
+                return "Model is not loaded", 500
+
+            return {"registered": model.register_prefix(prefix)}
+
         @self.app.route("/info", methods=["GET"])
         def info():
             """
-            Request handler for the info method of the wrapped language model.
+            Request handler for the info method of the wrapped language model. Also lists the registered and loaded models.
+            A model that is not loaded is reported as such, asking for info does not load it.
             """
-            if self.wrapped_model is None:
+            name, model = self.peek_model(flask.request.args.get("model", None))
+            if name is None:
                 return "Model is not loaded", 500
-            return self.wrapped_model.info()
+            if model is None:
+                return {"name": name, "loaded": False, "models": self.registry.info()}
+            return {**model.info(), "loaded": True, "models": self.registry.info()}
         
+        @self.app.route("/profiles", methods=["GET"])
+        def profiles():
+            """
+            Request handler for the slowest requests of a model and the ids of its profiler traces.
+            Requires the admin token in the X-Admin-Token header when one is configured.
+            """
+            model = self.get_model(flask.request.args.get("model", None))
+            if model is None:
+                return "Model is not loaded", 500
+            error = self.admin_error(model, required=False)
+            if error:
+                return error
+            return {**model.profiler.info(), "slowest": model.profiler.slowest()}
+
+        @self.app.route("/profiles/<trace_id>", methods=["GET"])
+        def profile(trace_id):
+            """
+            Request handler for downloading a profiler trace (Chrome trace format, open in chrome://tracing or Perfetto).
+            """
+            model = self.get_model(flask.request.args.get("model", None))
+            if model is None:
+                return "Model is not loaded", 500
+            error = self.admin_error(model)
+            if error:
+                return error
+            path = model.profiler.trace_path(trace_id)
+            if path is None:
+                return "Unknown trace id", 404
+            return flask.send_file(path, mimetype="application/json", as_attachment=True, download_name=f"{trace_id}.json")
+
+        @self.app.route("/metrics", methods=["GET"])
+        def metrics():
+            """
+            Request handler for the request metrics of all models, in the Prometheus text format (or JSON with ?format=json).
+            """
+            if flask.request.args.get("format", None) == "json":
+                return llm_metrics.metrics.snapshot()
+            return flask.Response(llm_metrics.metrics.render(), mimetype="text/plain; version=0.0.4")
+
         @self.app.route("/", methods=["GET"])
         def ping():
             """
-            Method to check if the server is running.
+            Method to check if the server is running. Pinging does not load a model that is not loaded yet.
             """
-            if self.wrapped_model is None:
+            name, model = self.peek_model(flask.request.args.get("model", None))
+            if name is None:
                 return "Model is not loaded", 500
-            return f"ping: {self.wrapped_model.name}"
+            if model is None:
+                return f"ping: {name} (not loaded)"
+            if not getattr(model, "ready", True):
+                return f"Model is warming up: {name}", 503
+            return f"ping: {name}"
+
+    @property
+    def wrapped_model(self)->Wrapper:
+        """
+        The default wrapped model.
+        """
+        return self.registry.get(None)
+
+    def get_model(self, name:str=None)->Wrapper:
+        """
+        Get a wrapped model by name (loading it on first use). Aborts the request with 404 if the name is not registered.
+        Parameters:
+            name (str): The model name. Default=None (the default model)
+        """
+        if name is not None and name not in self.registry:
+            flask.abort(404, f"Unknown model: {name}")
+        return self.registry.get(name)
+
+    def peek_model(self, name:str=None)->tuple:
+        """
+        Get a wrapped model by name only if it is loaded (never triggers a load or an eviction). Aborts the request with
+        404 if the name is not registered.
+        Parameters:
+            name (str): The model name. Default=None (the default model)
+        Returns:
+            tuple: The model name (None if no model is registered) and the wrapper (None if it is not loaded).
+        """
+        if name is not None and name not in self.registry:
+            flask.abort(404, f"Unknown model: {name}")
+        name = name or self.registry.default
+        return name, self.registry.peek(name) if name is not None else None
     
+    def admin_error(self, model:Wrapper, required:bool=True):
+        """
+        Check the X-Admin-Token header of the current request against the admin token of a model.
+        Parameters:
+            model (Wrapper): The model the request is for.
+            required (bool): Deny the request if the model has no admin token configured. Default=True
+        Returns:
+            tuple: An error (message, status) if the request is not allowed, otherwise None.
+        """
+        token = model.profiler.admin_token
+        if token is None:
+            return ("Profiling is not enabled (no admin token configured)", 403) if required else None
+        if not hmac.compare_digest(flask.request.headers.get("X-Admin-Token", ""), token):
+            return "Admin token required", 403
+        return None
+
     def start(self):
         """
         Call this method to start the server on the configured port (default=5000)
         """
-        self.app.run(port=self.port)
+        self.app.run(port=self.port, threaded=True)
+
+    def start_async(self, max_workers:int=1, max_queue:int=32, timeout:float=300.0, drain_timeout:float=None):
+        """
+        Start the server in async (ASGI) mode on the configured port, with a bounded request queue and graceful shutdown.
+        Requires uvicorn. See llm_asgi.AsyncLLM_Server for the parameters.
+        """
+        import llm_asgi
+
+        llm_asgi.AsyncLLM_Server(self.registry, self.port, max_workers, max_queue, timeout, drain_timeout).start()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,49 @@
+import argparse
+import copy
+import sys
+import llm_quant
+
+## Fixed prompt set for comparing the greedy outputs of a converted model against the full precision model.
+PROMPTS = [
+    "Generate a SQL query to answer this question: `How many products are in stock?`\n```sql\n",
+    "Generate a SQL query to answer this question: `What is the total quantity sold per product?`\n```sql\n",
+    "Generate a SQL query to answer this question: `Which customers bought more than 5 items?`\n```sql\n",
+    "Generate a SQL query to answer this question: `Who is the top salesperson in each region?`\n```sql\n",
+    "Generate a SQL query to answer this question: `List the products supplied for less than their price.`\n```sql\n",
+    "Generate a SQL query to answer this question: `What was the revenue in March 2024?`\n```sql\n",
+    "Generate a SQL query to answer this question: `Which products have never been sold?`\n```sql\n",
+    "Generate a SQL query to answer this question: `What is the average sale quantity per customer?`\n```sql\n",
+]
+
+## Quality check for CPU inference: the converted model must reproduce the full precision greedy outputs.
+if __name__ == "__main__":
+
+    import transformers
+
+    parser = argparse.ArgumentParser(description="Compare greedy outputs of an int8/bfloat16 CPU model against full precision.")
+    parser.add_argument("--model", default="defog/llama-3-sqlcoder-8b")
+    parser.add_argument("--dtype", default="int8", choices=llm_quant.DTYPES)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--min-exact-match", type=float, default=0.75, help="Fail if fewer prompts than this fraction match exactly")
+    args = parser.parse_args()
+
+    model = transformers.AutoModelForCausalLM.from_pretrained(args.model)
+    tokenizer = transformers.AutoTokenizer.from_pretrained(args.model)
+    model.eval()
+
+    llm_quant.set_threads(args.threads)
+    reference = llm_quant.greedy_outputs(model, tokenizer, PROMPTS, args.max_new_tokens)
+
+    ## The reference model is kept, so the converted model is a copy.
+    converted = llm_quant.quantize_model(copy.deepcopy(model), args.dtype)
+    candidate = llm_quant.greedy_outputs(converted, tokenizer, PROMPTS, args.max_new_tokens)
+
+    result = llm_quant.compare_outputs(reference, candidate)
+    print(f"{args.model} {args.dtype}: exact match {result['exact_match']:.0%}, prefix agreement {result['prefix_agreement']:.0%}")
+    for i in result["mismatches"]:
+        print(f"--- Prompt {i}:\n{PROMPTS[i]}")
+        print(f"full precision: {tokenizer.decode(reference[i], skip_special_tokens=True)!r}")
+        print(f"{args.dtype}: {tokenizer.decode(candidate[i], skip_special_tokens=True)!r}")
+
+    sys.exit(0 if result["exact_match"] >= args.min_exact_match else 1)
@@ -2,23 +2,42 @@ import requests
 import json
 import sqlite3
 import os
+import sql_loader
+import sql_schema
 
 
+## Generation stops at the closing fence of the SQL block.
+SQL_STOP = ["```"]
+
 def extract_sql(text: str)->str:
     """
-    Extract the SQL code from the response from the LLM
+    Extract the SQL code from the response from the LLM. The prompts end with the opening fence, so the response
+    (only the generated text) starts with the SQL; full text responses are split on the fence.
     """
-    return text.split("```sql")[1]
+    if "```sql" in text:
+        text = text.split("```sql")[1]
+    return text.split("```")[0]
 
 def execute_ddl(text: str, cursor: sqlite3.Cursor)->None:
     """
-    Execute the DDL statements given an open cursor
+    Execute the DDL statements given an open cursor, in one transaction
     """
-    for ddl in text.split("\n"):
+    for ddl in sql_loader.iter_statements(text):
         print("Executing (DDL): ", ddl)
-        cursor.execute(ddl)
-    cursor.connection.commit()
-    
+    sql_loader.load(cursor.connection, text)
+
+def load_statements(stmts: str, cursor: sqlite3.Cursor, **kwargs)-> dict:
+    """
+    Bulk load the SQL insert statements returned by the LLM given an open cursor: one transaction, repeated inserts
+    batched with executemany. Failing statements are skipped and printed, see sql_loader.load for the options.
+    """
+    kwargs.setdefault("errors", "skip")
+    report = sql_loader.load(cursor.connection, stmts, **kwargs)
+    for statement, error in report["errors"]:
+        print("Error: ", error, "\nStatement: ", statement)
+    print(sql_loader.format_report(report))
+    return report
+
 
 def execute_statements(stmts: str, cursor: sqlite3.Cursor)-> None:
     """
@@ -61,10 +80,14 @@ def execute_query(query: str, cursor: sqlite3.Cursor)->None:
           if statement != "":
             cursor.execute(statement)
 
-def create_query(question: str, ddl: str)->str:
+def create_query(question: str, ddl: str, schema: sql_schema.SchemaIndex = None)->str:
    """
-   Helper method to create the Question prompt for the LLM using a template
+   Helper method to create the Question prompt for the LLM using a template. With a schema index only the tables
+   relevant to the question (and their join paths) are put in the prompt instead of the whole DDL.
    """
+   if schema is not None:
+      ddl, report = schema.prompt_ddl(question)
+      print(sql_schema.format_report(report))
 
    return f"""<|begin_of_text|><|start_header_id|>user<|end_header_id|>
 
@@ -83,11 +106,25 @@ def request_llm(prompt: str, headers: dict, request_url: str)->None:
     Helper method to send a request to the LLM
     """
     print("Sent Query")
-    response = requests.post(request_url, data=json.dumps({"prompt":prompt}), headers=headers).json()
+    response = requests.post(request_url, data=json.dumps({"prompt":prompt, "run_config": {"stop": SQL_STOP}}), headers=headers).json()
     query = extract_sql(response.get("response"))
     print(query)
     execute_query(query, cur)
 
+def request_llm_batch(prompts: list[str], headers: dict, batch_url: str)->None:
+    """
+    Helper method to send several query prompts to the LLM in one batch request and execute the returned queries in order
+    """
+    print("Sent Queries")
+    response = requests.post(batch_url, data=json.dumps({"prompts":prompts, "run_config": {"stop": SQL_STOP}}), headers=headers).json()
+    for result in response["results"]:
+        if "error" in result:
+          print("Error: ", result["error"])
+          continue
+        query = extract_sql(result.get("response"))
+        print(query)
+        execute_query(query, cur)
+
 
 if __name__ == "__main__":
     
@@ -96,6 +133,7 @@ if __name__ == "__main__":
     DB_NAME = "db/sql_coding.db"
     TARGET_URL = "http://localhost:5000"
     REQUEST_URL = f"{TARGET_URL}/request"
+    BATCH_URL = f"{TARGET_URL}/batch"
     headers = {
         "Content-Type": "application/json",
         "Connection": "keep-alive",
@@ -125,12 +163,15 @@ if __name__ == "__main__":
     question2 = "Tell me which books had the highest sales?"
     question3 = "Tell me the name of the author that has the most sales?"
 
+    ## Index the schema of the database so each prompt only carries the tables relevant to its question
+    schema = sql_schema.SchemaIndex.from_connection(cur.connection)
+
     ## Create the query prompts for the LLM based on the questions and the DDL
-    prompt_query_auth_books = create_query(question1, ddl)
+    prompt_query_auth_books = create_query(question1, ddl, schema)
     
-    prompt_query_book_sales = create_query(question2, ddl)
+    prompt_query_book_sales = create_query(question2, ddl, schema)
 
-    prompt_query_most_sales_author = create_query(question3, ddl)
+    prompt_query_most_sales_author = create_query(question3, ddl, schema)
 
     
     ## create the synthetic data generation prompt
@@ -144,17 +185,15 @@ Generate data to populate the tables Authors (3 records), Books (7 records with
 """
     ## Send the synthetic data generation prompt to the LLM and print the response
     print("Sent Syn Data")
-    response = requests.post(REQUEST_URL, data=json.dumps({"prompt":prompt_create_data, "process_logits": True}), headers=headers).json()
+    response = requests.post(REQUEST_URL, data=json.dumps({"prompt":prompt_create_data, "process_logits": True, "run_config": {"stop": SQL_STOP}}), headers=headers).json()
     syn_data = extract_sql(response.get("response"))
     print(syn_data)
 
-    ## Execute the returned SQL
-    execute_statements(syn_data, cur)
+    ## Load the returned SQL in bulk (execute_statements runs it statement by statement with a human in the loop)
+    load_statements(syn_data, cur)
 
-    ## Now that the tables are populated with the synthetic data, we can ask the LLM the questions, execute the SQL returned and print the results.
-    request_llm(prompt_query_auth_books, headers, REQUEST_URL)
-    request_llm(prompt_query_book_sales, headers, REQUEST_URL)
-    request_llm(prompt_query_most_sales_author, headers, REQUEST_URL)
+    ## Now that the tables are populated with the synthetic data, we can ask the LLM the questions (in one batch), execute the SQL returned and print the results.
+    request_llm_batch([prompt_query_auth_books, prompt_query_book_sales, prompt_query_most_sales_author], headers, BATCH_URL)
 
 
 
@@ -1,22 +1,8 @@
 import llm_server as llm_server
 
-if __name__ == "__main__":
-
-    import transformers
-
-    MODEL_ID = "defog/llama-3-sqlcoder-8b"
-
-    model = transformers.AutoModelForCausalLM.from_pretrained(MODEL_ID)
-    tokenizer = transformers.AutoTokenizer.from_pretrained(MODEL_ID)
-
-    ## Configuration for the server including the prompting hint
-    config = {
-        "prompting_hint":  """<|begin_of_text|><|start_header_id|>user<|end_header_id|>
-
-Generate a SQL query to answer this question: `{question}`
-
-DDL statements:
-
+## Schema of the SQL coding database. Clients index it (sql_schema.SchemaIndex.from_ddl) and fill {ddl} in the
+## prompting hint with the tables relevant to each question rather than the whole schema.
+SCHEMA_DDL = """
 CREATE TABLE products (
   product_id INTEGER PRIMARY KEY, -- Unique ID for each product
   name VARCHAR(50), -- Name of the product
@@ -54,13 +40,35 @@ CREATE TABLE product_suppliers (
 -- sales.product_id can be joined with products.product_id
 -- sales.customer_id can be joined with customers.customer_id
 -- sales.salesperson_id can be joined with salespeople.salesperson_id
--- product_suppliers.product_id can be joined with products.product_id<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+-- product_suppliers.product_id can be joined with products.product_id"""
+
+if __name__ == "__main__":
+
+    import transformers
+
+    MODEL_ID = "defog/llama-3-sqlcoder-8b"
+
+    model = transformers.AutoModelForCausalLM.from_pretrained(MODEL_ID)
+    tokenizer = transformers.AutoTokenizer.from_pretrained(MODEL_ID)
+
+    ## Configuration for the server including the prompting hint (the sqlcoder template, question before the DDL)
+    config = {
+        "prompting_hint":  """<|begin_of_text|><|start_header_id|>user<|end_header_id|>
+
+Generate a SQL query to answer this question: `{question}`
+
+DDL statements:
+{ddl}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
 
 The following SQL query best answers the question `{question}`:
 ```sql
-"""
+""",
+        ## Cache the key/values of the fixed prompt prefix (the prompting hint up to the question, which every client prompt
+        ## starts with, and any prefixes registered via /prefix)
+        "prefix_cache": {"max_bytes": 4 * 1024**3},
     }
-    ## Create the server
-    server = llm_server.LLM_Server(llm_server.LLM_Server_Pipe_Wrapper(MODEL_ID, tokenizer, model,  config))   
+    ## Create the server. LLM_Server_Wrapper rather than LLM_Server_Pipe_Wrapper, as the pipeline tokenizes the prompt
+    ## itself and cannot reuse the prefix cache.
+    server = llm_server.LLM_Server(llm_server.LLM_Server_Wrapper(MODEL_ID, tokenizer, model,  config))   
 
     server.start()
\ No newline at end of file
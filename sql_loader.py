@@ -0,0 +1,293 @@
+import argparse
+import functools
+import re
+import sqlite3
+import time
+
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+SYNCHRONOUS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+_NAME = r"(?:[\w$]+|\"(?:[^\"]|\"\")*\"|\[[^\]]*\]|`[^`]*`)"
+## Leading whitespace and comments of a statement.
+_LEADING = r"(?:\s|--[^\n]*\n|/\*.*?\*/)*"
+## INSERT [OR ...] INTO [schema.]table [(columns)] VALUES, the rows are parsed separately.
+INSERT_PATTERN = re.compile(rf"{_LEADING}(INSERT(?:\s+OR\s+\w+)?\s+INTO\s+{_NAME}(?:\s*\.\s*{_NAME})?\s*(?:\([^)]*\))?\s*VALUES)\s*", re.IGNORECASE | re.DOTALL)
+## A literal value: string, blob, number or keyword. Each alternative is a non-empty group so findall tells them apart.
+LITERAL_PATTERN = re.compile(
+    r"('(?:[^']|'')*')|([xX]'(?:[0-9a-fA-F]{2})*')|([-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?)|\b(NULL|TRUE|FALSE)\b",
+    re.IGNORECASE,
+)
+## The VALUES list with every literal replaced by ? and whitespace removed: rows of the same arity.
+ROWS_PATTERN = re.compile(r"(\(\?(?:,\?)*\))(?:,\1)*;?")
+## Complete tokens up to the next semicolon: quoted strings and identifiers, comments and anything else. An unterminated
+## token stops the match before its opening character.
+SCAN_PATTERN = re.compile(r"""(?:[^'"`\[;/-]+|'(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|--[^\n]*\n|/\*.*?\*/|/(?!\*)|-(?!-))*""", re.DOTALL)
+## A string, integer, real or NULL value in a repeated INSERT. A number without a dot or exponent is an integer.
+REPEAT_VALUE = r"\s*(?:'((?:[^']|'')*)'|([-+]?\d+)(?![\d.eE])|([-+]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?)|((?i:NULL)))\s*"
+MAX_INTEGER = 2 ** 63 - 1
+
+
+def iter_statements(sql):
+    """
+    Split SQL text into complete statements. Semicolons inside quoted strings, identifiers, comments and trigger bodies
+    do not end a statement.
+    Parameters:
+        sql (str | Iterable[str]): The SQL text, or chunks of it (e.g. an open file) so large scripts are not read at once.
+    Returns:
+        Iterator[str]: The statements, including their terminating semicolon.
+    """
+    if isinstance(sql, str):
+        sql = [sql]
+
+    buffer = ""
+    pos = 0
+    for chunk in sql:
+        buffer += chunk
+        start = 0
+        while True:
+            pos = SCAN_PATTERN.match(buffer, pos).end()
+            ## A trailing - or / may start a comment that continues in the next chunk.
+            if pos == len(buffer) and buffer[pos - 1:pos] in ("-", "/"):
+                pos -= 1
+            if pos == len(buffer) or buffer[pos] != ";":
+                break
+            pos += 1
+            ## Only trigger bodies have semicolons that do not end the statement, sqlite3 decides those.
+            if sqlite3.complete_statement(buffer[start:pos]):
+                statement = buffer[start:pos].strip()
+                start = pos
+                if statement != ";":
+                    yield statement
+        ## The scan resumes where it stopped, long statements over many chunks are scanned once.
+        buffer = buffer[start:]
+        pos -= start
+    if buffer.strip():
+        yield buffer.strip()
+
+
+def parse_insert(statement:str):
+    """
+    Split an INSERT ... VALUES statement with literal values into a parameterized statement and its rows.
+    Parameters:
+        statement (str): A single SQL statement.
+    Returns:
+        tuple: The parameterized statement and the rows (tuples of values), or None if the statement is not an INSERT of
+        literal values (expressions, sub-queries, upserts and the like are executed as they are).
+    """
+    match = INSERT_PATTERN.match(statement)
+    if match is None:
+        return None
+
+    values = statement[match.end():]
+    ## Literals are found and checked with regular expressions (rather than token by token) to keep parsing cheaper
+    ## than executing the statement.
+    skeleton = "".join(LITERAL_PATTERN.sub("?", values).split())
+    shape = ROWS_PATTERN.fullmatch(skeleton)
+    if shape is None:
+        return None
+
+    literals = []
+    for string, blob, number, keyword in LITERAL_PATTERN.findall(values):
+        if string:
+            literals.append(string[1:-1].replace("''", "'"))
+        elif number:
+            value = _number(number)
+            if value is None:
+                return None
+            literals.append(value)
+        elif blob:
+            literals.append(bytes.fromhex(blob[2:-1]))
+        else:
+            literals.append(KEYWORDS[keyword.upper()])
+
+    arity = shape.group(1).count("?")
+    header = " ".join(match.group(1).split())
+    return f"{header} ({', '.join('?' * arity)})", [tuple(literals[i:i + arity]) for i in range(0, len(literals), arity)]
+
+
+KEYWORDS = {"NULL": None, "TRUE": 1, "FALSE": 0}
+
+def _number(text:str):
+    if "." in text or "e" in text or "E" in text:
+        return float(text)
+    value = int(text)
+    ## Integers beyond 64 bits are stored as REAL by SQLite, which a parameter cannot reproduce.
+    return value if abs(value) <= MAX_INTEGER else None
+
+
+@functools.lru_cache(maxsize=64)
+def _repeat_pattern(statement:str, arity:int):
+    ## Single row INSERTs written like the parameterized statement, for the common literals (a miss takes parse_insert).
+    header = statement[:statement.rindex(" (")]
+    return re.compile(_LEADING + r"\s+".join(map(re.escape, header.split())) + r"\s*\(" + ",".join([REPEAT_VALUE] * arity) + r"\)\s*;?\s*", re.DOTALL)
+
+
+def _repeat_row(groups:tuple)->tuple:
+    ## None if an integer does not fit 64 bits, the statement then takes parse_insert (and is executed as it is).
+    row = []
+    for i in range(0, len(groups), 4):
+        string, integer, real, _ = groups[i:i + 4]
+        if string is not None:
+            row.append(string.replace("''", "'"))
+        elif integer is not None:
+            value = _number(integer)
+            if value is None:
+                return None
+            row.append(value)
+        elif real is not None:
+            row.append(float(real))
+        else:
+            row.append(None)
+    return tuple(row)
+
+
+def load(connection:sqlite3.Connection, sql, journal_mode:str=None, synchronous:str="OFF", batch_size:int=10000, errors:str="raise")->dict:
+    """
+    Load generated SQL into a database in a single transaction. Runs of INSERT statements of literal values into the
+    same table and columns are executed as parameterized executemany batches; other statements are executed as they are.
+    Pending changes on the connection are committed first, the pragmas are restored afterwards.
+    Parameters:
+        connection (sqlite3.Connection): The database connection.
+        sql (str | Iterable[str]): The SQL text, or chunks of it (e.g. an open file).
+        journal_mode (str): journal_mode pragma for the load, one of JOURNAL_MODES. Default=None (unchanged)
+        synchronous (str): synchronous pragma for the load, one of SYNCHRONOUS. Default=OFF (the commit is not fsynced)
+        batch_size (int): Maximum number of rows per executemany call. Default=10000
+        errors (str): "raise" to roll back the whole load on the first error, "skip" to skip failing statements and rows. Default=raise
+    Returns:
+        dict: statements, rows (rows changed), batches, errors (failing statement or row and message), seconds and rows_per_second.
+    """
+    if journal_mode is not None and journal_mode.upper() not in JOURNAL_MODES:
+        raise ValueError(f"journal_mode must be one of {JOURNAL_MODES}")
+    if synchronous is not None and str(synchronous).upper() not in SYNCHRONOUS:
+        raise ValueError(f"synchronous must be one of {SYNCHRONOUS}")
+    if errors not in ("raise", "skip"):
+        raise ValueError("errors must be raise or skip")
+
+    if connection.in_transaction:
+        connection.commit()
+    isolation_level = connection.isolation_level
+    previous_journal = connection.execute("PRAGMA journal_mode").fetchone()[0]
+    previous_synchronous = connection.execute("PRAGMA synchronous").fetchone()[0]
+
+    report = {"statements": 0, "rows": 0, "batches": 0, "errors": []}
+    start = time.perf_counter()
+    ## Transactions are managed here rather than by the sqlite3 module.
+    connection.isolation_level = None
+    try:
+        if journal_mode is not None:
+            connection.execute(f"PRAGMA journal_mode={journal_mode.upper()}")
+        if synchronous is not None:
+            connection.execute(f"PRAGMA synchronous={str(synchronous).upper()}")
+
+        cursor = connection.cursor()
+        cursor.execute("BEGIN")
+        try:
+            pending, rows, repeat = None, [], None
+            for statement in iter_statements(sql):
+                report["statements"] += 1
+                ## Generated statements mostly repeat the one before with other values, a precompiled match is enough.
+                match = repeat.fullmatch(statement) if repeat is not None else None
+                row = _repeat_row(match.groups()) if match is not None else None
+                if row is not None:
+                    rows.append(row)
+                else:
+                    insert = parse_insert(statement)
+                    if insert is not None and insert[0] == pending:
+                        rows += insert[1]
+                    else:
+                        if pending is not None:
+                            _execute_batch(cursor, pending, rows, batch_size, errors, report)
+                        pending, rows, repeat = None, [], None
+                        if insert is None:
+                            _execute(cursor, statement, errors, report)
+                            continue
+                        pending, rows = insert
+                        repeat = _repeat_pattern(pending, len(rows[0]))
+
+                if len(rows) >= batch_size:
+                    _execute_batch(cursor, pending, rows, batch_size, errors, report)
+                    rows = []
+
+            if rows:
+                _execute_batch(cursor, pending, rows, batch_size, errors, report)
+            cursor.execute("COMMIT")
+        except BaseException:
+            if connection.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise
+    finally:
+        connection.execute(f"PRAGMA synchronous={previous_synchronous}")
+        if journal_mode is not None and journal_mode.upper() != previous_journal.upper():
+            connection.execute(f"PRAGMA journal_mode={previous_journal}")
+        connection.isolation_level = isolation_level
+
+    report["seconds"] = time.perf_counter() - start
+    report["rows_per_second"] = report["rows"] / report["seconds"] if report["seconds"] > 0 else None
+    return report
+
+
+def _execute(cursor:sqlite3.Cursor, statement:str, errors:str, report:dict):
+    ## A failing statement is rolled back on its own by SQLite, the transaction stays open.
+    try:
+        cursor.execute(statement)
+    except sqlite3.Error as e:
+        if errors == "raise":
+            raise
+        report["errors"].append((statement, str(e)))
+        return
+    report["rows"] += max(cursor.rowcount, 0)
+
+
+def _execute_batch(cursor:sqlite3.Cursor, statement:str, rows:list, batch_size:int, errors:str, report:dict):
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        report["batches"] += 1
+        if errors == "raise":
+            cursor.executemany(statement, batch)
+            report["rows"] += max(cursor.rowcount, 0)
+            continue
+
+        ## A failing row leaves the rows before it inserted, so the batch is undone and retried row by row.
+        cursor.execute("SAVEPOINT batch")
+        try:
+            cursor.executemany(statement, batch)
+            report["rows"] += max(cursor.rowcount, 0)
+        except sqlite3.Error:
+            cursor.execute("ROLLBACK TO batch")
+            for row in batch:
+                try:
+                    cursor.execute(statement, row)
+                    report["rows"] += max(cursor.rowcount, 0)
+                except sqlite3.Error as e:
+                    report["errors"].append((f"{statement} {row}", str(e)))
+        cursor.execute("RELEASE batch")
+
+
+def format_report(report:dict)->str:
+    """
+    Format a load report as a one line summary.
+    """
+    rate = f"{report['rows_per_second']:,.0f} rows/s" if report["rows_per_second"] is not None else "n/a rows/s"
+    return (f"Loaded {report['rows']:,} rows from {report['statements']:,} statements ({report['batches']:,} batches) "
+            f"in {report['seconds']:.2f}s: {rate}, {len(report['errors'])} errors")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Bulk load a SQL file (e.g. generated synthetic data) into a SQLite database.")
+    parser.add_argument("database")
+    parser.add_argument("sql", nargs="+", help="SQL files, loaded in order with one transaction each")
+    parser.add_argument("--journal-mode", default=None, choices=JOURNAL_MODES, type=str.upper)
+    parser.add_argument("--synchronous", default="OFF", choices=SYNCHRONOUS, type=str.upper)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--errors", default="raise", choices=["raise", "skip"])
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(args.database)
+    for path in args.sql:
+        with open(path) as f:
+            report = load(connection, f, args.journal_mode, args.synchronous, args.batch_size, args.errors)
+        for statement, error in report["errors"]:
+            print(f"Error: {error}\nStatement: {statement}")
+        print(f"{path}: {format_report(report)}")
+    connection.close()
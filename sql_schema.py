@@ -0,0 +1,241 @@
+import collections
+import math
+import re
+import sqlite3
+import sql_loader
+
+## Join hints written as comments in DDL, e.g. "-- sales.product_id can be joined with products.product_id"
+JOIN_HINT_PATTERN = re.compile(r"--\s*(\w+)\.(\w+)\s+can be joined with\s+(\w+)\.(\w+)", re.IGNORECASE)
+## Weight of a question term found in a table name, column name or comment.
+FIELD_WEIGHTS = {"table": 3.0, "column": 2.0, "comment": 1.0}
+
+
+def terms(text:str)->list[str]:
+    """
+    Split text (a question, or snake_case / camelCase names and comments) into lower case terms with plurals folded.
+    """
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text)
+    res = []
+    for word in re.findall(r"[A-Za-z]+|\d+", text):
+        word = word.lower()
+        if len(word) > 4 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        res.append(word)
+    return res
+
+
+def approximate_tokens(text:str)->int:
+    """
+    Approximate token count of a text (words and punctuation) when no tokenizer is at hand.
+    """
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+def _quote(name:str)->str:
+    return "\"" + name.replace("\"", "\"\"") + "\""
+
+
+class SchemaIndex(object):
+    """
+    Lexical index over the tables, columns and comments of a SQLite schema. Prompts get the DDL of the tables relevant
+    to a question plus the tables that join them (over foreign keys and join hints) instead of the whole schema.
+
+    Methods:
+        from_connection: Introspect a database (sqlite_master and foreign keys).
+        from_ddl: Index DDL text, loaded into an in-memory database.
+        score: Score the tables against a question.
+        select: Select the tables relevant to a question and their join paths.
+        ddl: Get the DDL of tables with their join hints.
+        prompt_ddl: Get the DDL for a question and the token savings against the whole schema.
+    """
+    def __init__(self, tables:dict, joins:list):
+        """
+        Parameters:
+            tables (dict): {table: {"sql": CREATE statement, "columns": [column names], "comments": {column or None: comment}}}, in schema order.
+            joins (list): Joins as (table, column, table, column) tuples.
+        """
+        self.tables = tables
+        self.joins = [join for join in joins if join[0] in tables and join[2] in tables]
+        self.neighbours = collections.defaultdict(set)
+        for table, _, other, _ in self.joins:
+            if table != other:
+                self.neighbours[table].add(other)
+                self.neighbours[other].add(table)
+
+        ## Inverted index, per term: the tables with it and its highest weight over their name, columns and comments.
+        ## Join columns name the other table (e.g. sales.product_id) and are left out, join paths bring those tables in.
+        join_columns = {(table, column) for table, column, _, _ in self.joins} | {(other, column) for _, _, other, column in self.joins}
+        self.postings = collections.defaultdict(dict)
+        for table, entry in tables.items():
+            weights = {}
+            fields = [("comment", comment) for column, comment in entry["comments"].items() if (table, column) not in join_columns]
+            fields += [("column", column) for column in entry["columns"] if (table, column) not in join_columns] + [("table", table)]
+            for field, text in fields:
+                for term in terms(text):
+                    weights[term] = max(weights.get(term, 0.0), FIELD_WEIGHTS[field])
+            for term, weight in weights.items():
+                self.postings[term][table] = weight
+
+        self.idf = {term: math.log(1.0 + len(tables) / len(postings)) for term, postings in self.postings.items()}
+        self.full_ddl = self.ddl(list(tables))
+
+    @classmethod
+    def from_connection(cls, connection:sqlite3.Connection, extra_joins:list=None):
+        """
+        Introspect the tables of a database: CREATE statements (with their comments) from sqlite_master, columns and foreign keys.
+        Parameters:
+            connection (sqlite3.Connection): The database connection.
+            extra_joins (list): Joins that are not declared as foreign keys, as (table, column, table, column) tuples. Default=None
+        """
+        tables = {}
+        joins = list(extra_joins or [])
+        rows = connection.execute("SELECT name, sql FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY rowid").fetchall()
+        for name, sql in rows:
+            info = connection.execute(f"PRAGMA table_info({_quote(name)})").fetchall()
+            columns = [row[1] for row in info]
+            tables[name] = {"sql": sql, "columns": columns, "comments": cls.comments(sql, columns)}
+
+        for name in tables:
+            for row in connection.execute(f"PRAGMA foreign_key_list({_quote(name)})").fetchall():
+                other, column, other_column = row[2], row[3], row[4]
+                if other_column is None and other in tables:
+                    ## A reference without columns is to the primary key.
+                    keys = [info[1] for info in connection.execute(f"PRAGMA table_info({_quote(other)})").fetchall() if info[5]]
+                    other_column = keys[0] if keys else "rowid"
+                joins.append((name, column, other, other_column))
+        return cls(tables, joins)
+
+    @classmethod
+    def from_ddl(cls, ddl:str):
+        """
+        Index DDL text (e.g. the schema of a prompting hint) by loading it into an in-memory database. Comments of the
+        form "-- a.x can be joined with b.y" are used as joins too.
+        """
+        connection = sqlite3.connect(":memory:")
+        try:
+            sql_loader.load(connection, ddl)
+            return cls.from_connection(connection, [match.groups() for match in JOIN_HINT_PATTERN.finditer(ddl)])
+        finally:
+            connection.close()
+
+    @staticmethod
+    def comments(sql:str, columns:list)->dict:
+        """
+        Get the -- comments of a CREATE TABLE statement, by column (a comment on a line that starts with the column name)
+        or under None for the table.
+        """
+        res = {}
+        lookup = {column.lower(): column for column in columns}
+        for line in (sql or "").split("\n"):
+            code, _, comment = line.partition("--")
+            if not comment.strip():
+                continue
+            words = re.findall(r"[\w$]+", code)
+            column = lookup.get(words[0].lower(), None) if words else None
+            res[column] = (res.get(column, "") + " " + comment.strip()).strip()
+        return res
+
+    def score(self, question:str)->dict:
+        """
+        Score the tables against a question: the sum over the question terms of their idf times their weight in the table.
+        Returns:
+            dict: {table: score} for the tables with a positive score.
+        """
+        res = collections.defaultdict(float)
+        for term in set(terms(question)):
+            for table, weight in self.postings.get(term, {}).items():
+                res[table] += self.idf[term] * weight
+        return dict(res)
+
+    def select(self, question:str, max_tables:int=8, min_ratio:float=0.3, max_hops:int=3)->list[str]:
+        """
+        Select the tables relevant to a question and the tables on the shortest join paths between them.
+        Parameters:
+            question (str): The question.
+            max_tables (int): Maximum number of tables selected by score (join path tables come on top). Default=8
+            min_ratio (float): Minimum score relative to the best table. Default=0.3
+            max_hops (int): Maximum length of a join path added between selected tables. Default=3
+        Returns:
+            list[str]: The tables in schema order; all of them if no table matches the question.
+        """
+        scores = self.score(question)
+        if not scores:
+            return list(self.tables)
+        best = max(scores.values())
+        ranked = sorted((table for table in scores if scores[table] >= min_ratio * best), key=lambda table: -scores[table])[:max_tables]
+
+        selected = {ranked[0]}
+        for table in ranked[1:]:
+            selected.update(self.join_path(selected, table, max_hops))
+        return [table for table in self.tables if table in selected]
+
+    def join_path(self, sources:set, target:str, max_hops:int)->list[str]:
+        """
+        Get the shortest join path (breadth first over the joins) from any of the source tables to the target table.
+        Returns:
+            list[str]: The tables on the path including the target, or just the target if there is no path within max_hops.
+        """
+        parents = {source: None for source in sources}
+        frontier = list(sources)
+        for _ in range(max_hops):
+            if target in parents:
+                break
+            next_frontier = []
+            for table in frontier:
+                for other in sorted(self.neighbours[table]):
+                    if other not in parents:
+                        parents[other] = table
+                        next_frontier.append(other)
+            frontier = next_frontier
+        if target not in parents:
+            return [target]
+
+        path = []
+        table = target
+        while table is not None and table not in sources:
+            path.append(table)
+            table = parents[table]
+        return path
+
+    def ddl(self, tables:list)->str:
+        """
+        Get the CREATE statements of tables with the joins between them as comments.
+        """
+        statements = [self.tables[table]["sql"].strip() + ";" for table in tables]
+        selected = set(tables)
+        hints = [f"-- {table}.{column} can be joined with {other}.{other_column}"
+                 for table, column, other, other_column in self.joins if table in selected and other in selected]
+        return "\n\n".join(statements) + ("\n\n" + "\n".join(hints) if hints else "")
+
+    def prompt_ddl(self, question:str, count_tokens=approximate_tokens, **kwargs)->tuple[str, dict]:
+        """
+        Get the DDL to put in the prompt for a question, and the tokens it saves against the whole schema.
+        Parameters:
+            question (str): The question.
+            count_tokens (callable): Token count of a text, e.g. lambda text: len(tokenizer.encode(text)). Default=approximate_tokens
+            kwargs: Options of select.
+        Returns:
+            tuple: The DDL and a report with the tables, full_tokens, selected_tokens, saved_tokens and saved_ratio.
+        """
+        tables = self.select(question, **kwargs)
+        ddl = self.ddl(tables)
+        full_tokens = count_tokens(self.full_ddl)
+        selected_tokens = count_tokens(ddl)
+        return ddl, {
+            "tables": tables,
+            "total_tables": len(self.tables),
+            "full_tokens": full_tokens,
+            "selected_tokens": selected_tokens,
+            "saved_tokens": full_tokens - selected_tokens,
+            "saved_ratio": (full_tokens - selected_tokens) / full_tokens if full_tokens else 0.0,
+        }
+
+
+def format_report(report:dict)->str:
+    """
+    Format a prompt_ddl report as a one line summary.
+    """
+    return (f"Schema: {len(report['tables'])}/{report['total_tables']} tables ({', '.join(report['tables'])}), "
+            f"{report['selected_tokens']:,}/{report['full_tokens']:,} tokens, saved {report['saved_tokens']:,} ({report['saved_ratio']:.0%})")